@@ -1,20 +1,37 @@
 import streamlit as st
 import pandas as pd
-# numpy は現在未使用（K-Means廃止により）
+import numpy as np
+import io
+import os
 import re
 import math
 import json
+import time
+import zlib
+import base64
+import hashlib
+import uuid
+import random
+import sqlite3
+import threading
+import multiprocessing
+import multiprocessing.connection
 import folium
 import googlemaps
 import polyline
 import requests
 import xml.etree.ElementTree as ET
 import unicodedata
+from array import array
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
 from streamlit_folium import st_folium
 from streamlit_sortables import sort_items
 from ortools.constraint_solver import routing_enums_pb2
 from ortools.constraint_solver import pywrapcp
-from datetime import datetime, timedelta
+from route_solver import (
+    register_transit_matrix, add_search_cutoff_callback, solve_tsp_with_strategy, tsp_strategy_worker,
+)
+from datetime import datetime, timedelta, timezone
 # K-Meansクラスタリングは廃止（Global TSP & Time Slicing 方式に変更）
 
 # Supabase（オプション - 保存機能用）
@@ -24,6 +41,14 @@ try:
 except ImportError:
     SUPABASE_AVAILABLE = False
 
+# Supabaseの接続プール設定（httpx_client を指定できるsupabaseのみ、古い版はライブラリ既定の接続を使う）
+try:
+    from supabase import ClientOptions
+    import httpx
+    SUPABASE_HTTPX_CLIENT_SUPPORTED = "httpx_client" in getattr(ClientOptions, "__dataclass_fields__", {})
+except ImportError:
+    SUPABASE_HTTPX_CLIENT_SUPPORTED = False
+
 # ========================================
 # ページ設定（最初に配置する必要あり）
 # ========================================
@@ -133,6 +158,50 @@ except Exception:
     DEFAULT_API_KEY = ""
     DEFAULT_MAP_ID = ""
 
+# HTTP接続プール設定（プロセス全体で共有するクライアントのkeep-alive接続数）
+HTTP_POOL_CONNECTIONS = 4  # 接続先ホストごとのプール数
+HTTP_POOL_MAXSIZE = 8  # 1ホストあたりの同時接続数の上限（並列リクエスト数以上にする）
+
+
+@st.cache_resource(show_spinner=False)
+def get_http_session():
+    """keep-alive接続を使い回すrequestsセッション（プロセス全体で共有）"""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE
+    )
+    session.mount("https://", adapter)
+    return session
+
+
+@st.cache_resource(show_spinner=False)
+def get_gmaps_client(api_key, retry_over_query_limit=True):
+    """Google Maps APIクライアントを取得（APIキーごとに1回だけ作成し、接続プールを共有）
+
+    Args:
+        api_key: Google Maps APIキー
+        retry_over_query_limit: OVER_QUERY_LIMIT 時にクライアント側で自動リトライするか
+    """
+    return googlemaps.Client(
+        key=api_key,
+        retry_over_query_limit=retry_over_query_limit,
+        requests_session=get_http_session()
+    )
+
+
+@st.cache_resource(show_spinner=False)
+def create_supabase_client(url, key):
+    """Supabaseクライアントを作成（URL・キーごとに1回だけ、keep-alive接続を共有）"""
+    if not SUPABASE_HTTPX_CLIENT_SUPPORTED:
+        return create_client(url, key)
+    return create_client(url, key, options=ClientOptions(httpx_client=httpx.Client(
+        limits=httpx.Limits(
+            max_connections=HTTP_POOL_MAXSIZE,
+            max_keepalive_connections=HTTP_POOL_MAXSIZE
+        )
+    )))
+
+
 # Supabase設定
 def get_supabase_client():
     """Supabaseクライアントを取得（設定がない場合はNone）"""
@@ -142,48 +211,192 @@ def get_supabase_client():
         url = st.secrets.get("SUPABASE_URL", "")
         key = st.secrets.get("SUPABASE_KEY", "")
         if url and key:
-            return create_client(url, key)
+            return create_supabase_client(url, key)
     except Exception:
         pass
     return None
 
-def save_schedule(name, selected_points, num_days, day_routes=None, selected_df=None, optimize_mode="distance", timetables=None, calendar_texts=None):
-    """スケジュールを保存（選択状態＋計算結果を統合）"""
+def records_to_columns(records):
+    """行のリスト（dictのリスト）を列ごとのリストに変換（列名は1回だけ持つ）"""
+    columns = {}
+    for record in records:
+        for key in record:
+            columns.setdefault(key, None)
+    return {key: [record.get(key) for record in records] for key in columns}
+
+
+def columns_to_records(columns):
+    """records_to_columns の逆変換"""
+    keys = list(columns)
+    return [dict(zip(keys, values)) for values in zip(*columns.values())]
+
+
+def to_json_scalar(value):
+    """json.dumps で直接扱えない値（numpyの数値など）を変換"""
+    return value.item() if hasattr(value, "item") else str(value)
+
+
+def pack_schedule_plan(selected_df=None, timetables=None):
+    """訪問先データとタイムテーブルをスケジュール保存用に圧縮
+
+    行ごとのdict（列名を毎行繰り返す）ではなく列ごとのリストにまとめ、
+    JSON を zlib 圧縮して base64 文字列にする。
+
+    Returns:
+        dict: {"version", "data"}（JSONBにそのまま保存できる形式）
+    """
+    payload = {}
+    if selected_df is not None:
+        payload["selected_df"] = (
+            selected_df.to_dict(orient="list") if hasattr(selected_df, "to_dict")
+            else records_to_columns(selected_df)
+        )
+    if timetables is not None:
+        payload["timetables"] = [{
+            "day_num": tt["day_num"],
+            "metrics": tt["metrics"],
+            "timetable": records_to_columns(tt["timetable"]),
+        } for tt in timetables]
+
+    text = json.dumps(payload, ensure_ascii=False, separators=(",", ":"), default=to_json_scalar)
+    return {
+        "version": SCHEDULE_PLAN_FORMAT_VERSION,
+        "data": base64.b64encode(zlib.compress(text.encode("utf-8"), 9)).decode("ascii"),
+    }
+
+
+def unpack_schedule_plan(sch_data):
+    """保存データから訪問先データとタイムテーブルを取得（旧形式のJSONB列にも対応）
+
+    Returns:
+        (訪問先データフレーム, タイムテーブルのリスト)（保存されていないものは None）
+    """
+    packed = sch_data.get("plan_data")
+    if packed and packed.get("version") == SCHEDULE_PLAN_FORMAT_VERSION:
+        try:
+            payload = json.loads(zlib.decompress(base64.b64decode(packed["data"])).decode("utf-8"))
+        except (ValueError, TypeError, zlib.error):
+            payload = None
+        if payload is not None:
+            selected_df = payload.get("selected_df")
+            timetables = payload.get("timetables")
+            return (
+                pd.DataFrame(selected_df) if selected_df else None,
+                [{
+                    "day_num": tt["day_num"],
+                    "metrics": tt["metrics"],
+                    "timetable": columns_to_records(tt["timetable"]),
+                } for tt in timetables] if timetables is not None else None,
+            )
+
+    # 旧形式（selected_df・timetables 列に行ごとのJSONBで保存）
+    selected_df = sch_data.get("selected_df")
+    return (pd.DataFrame(selected_df) if selected_df else None), sch_data.get("timetables")
+
+
+def make_schedule_row(name, selected_points, num_days, day_routes=None, selected_df=None, optimize_mode="distance", timetables=None, calendar_texts=None, travel_matrices=None):
+    """route_schedules に保存する行を作成（JSONにできる値のみ、書き込みキューにそのまま積める）
+
+    IDはここで決めておき、再送しても同じ行への upsert になるようにする。
+    訪問先データとタイムテーブルは plan_data 列に圧縮して保存する。
+    travel_matrices は pack_travel_matrices の結果。
+    """
+    data = {
+        "id": str(uuid.uuid4()),
+        "name": name,
+        "selected_points": selected_points,
+        "num_days": num_days,
+        "optimize_mode": optimize_mode
+    }
+    # 計算結果がある場合は追加
+    if day_routes is not None:
+        data["day_routes"] = [[int(idx) for idx in route] for route in day_routes]
+    if selected_df is not None or timetables is not None:
+        data["plan_data"] = pack_schedule_plan(selected_df, timetables)
+    if calendar_texts is not None:
+        data["calendar_texts"] = calendar_texts
+    if travel_matrices is not None:
+        data["travel_matrices"] = travel_matrices
+    return data
+
+
+def insert_schedule_row(data):
+    """make_schedule_row の行を保存（plan_data・travel_matrices 列がない旧SQLのテーブルには旧形式で保存）
+
+    IDで upsert するため、送信済みの行を再送しても重複しない。
+
+    Returns:
+        (保存したID, エラー)
+    """
     supabase = get_supabase_client()
     if not supabase:
         return None, "Supabase未設定"
     try:
-        data = {
-            "name": name,
-            "selected_points": selected_points,
-            "num_days": num_days,
-            "optimize_mode": optimize_mode
-        }
-        # 計算結果がある場合は追加
-        if day_routes is not None:
-            data["day_routes"] = day_routes
-        if selected_df is not None:
-            data["selected_df"] = selected_df.to_dict(orient="records") if hasattr(selected_df, 'to_dict') else selected_df
-        if timetables is not None:
-            data["timetables"] = timetables
-        if calendar_texts is not None:
-            data["calendar_texts"] = calendar_texts
-
-        result = supabase.table("route_schedules").insert(data).execute()
+        try:
+            result = supabase.table("route_schedules").upsert(data, on_conflict="id").execute()
+        except Exception as e:
+            if not any(column in data and column in str(e) for column in ("plan_data", "travel_matrices")):
+                raise
+            data = dict(data)
+            data.pop("travel_matrices", None)
+            if "plan_data" in data:
+                selected_df, timetables = unpack_schedule_plan({"plan_data": data.pop("plan_data")})
+                if selected_df is not None:
+                    data["selected_df"] = selected_df.to_dict(orient="records")
+                if timetables is not None:
+                    data["timetables"] = timetables
+            result = supabase.table("route_schedules").upsert(data, on_conflict="id").execute()
         return result.data[0]["id"], None
     except Exception as e:
         return None, str(e)
 
-def load_schedules():
-    """保存されたスケジュール一覧を取得"""
+
+def save_schedule(name, selected_points, num_days, day_routes=None, selected_df=None, optimize_mode="distance", timetables=None, calendar_texts=None, travel_matrices=None):
+    """スケジュールを保存（選択状態＋計算結果を統合、画面からは書き込みキュー経由で保存する）"""
+    return insert_schedule_row(make_schedule_row(
+        name, selected_points, num_days, day_routes, selected_df,
+        optimize_mode, timetables, calendar_texts, travel_matrices
+    ))
+
+def load_schedules(name_prefix="", cursor=None, limit=None):
+    """保存されたスケジュール一覧を取得（一覧表示用の列のみ、新しい順）
+
+    計算結果などの大きな列は取得せず、開くときに load_schedule_by_id で取得する。
+    ページ送りは (created_at, id) のキーセットで行う（OFFSET は使わない）。
+
+    Args:
+        name_prefix: 保存名の前方一致検索（空なら全件）
+        cursor: 前ページの最後の行の {"created_at", "id"}（Noneなら先頭ページ）
+        limit: 1ページの件数（省略時は SCHEDULE_LIST_PAGE_SIZE）
+
+    Returns:
+        (スケジュールのリスト, 次ページのカーソル（最終ページならNone）, エラー)
+    """
     supabase = get_supabase_client()
     if not supabase:
-        return [], "Supabase未設定"
+        return [], None, "Supabase未設定"
+    limit = limit or SCHEDULE_LIST_PAGE_SIZE
     try:
-        result = supabase.table("route_schedules").select("*").order("created_at", desc=True).limit(20).execute()
-        return result.data, None
+        query = supabase.table("route_schedules").select("id, name, created_at, num_days")
+        if name_prefix:
+            # LIKE のワイルドカードをエスケープして前方一致（idx_route_schedules_name_prefix を使用）
+            escaped = re.sub(r"([\\%_])", r"\\\1", name_prefix)
+            query = query.like("name", f"{escaped}%")
+        if cursor:
+            query = query.or_(
+                f'created_at.lt."{cursor["created_at"]}",'
+                f'and(created_at.eq."{cursor["created_at"]}",id.lt.{cursor["id"]})'
+            )
+        # 次ページの有無を判定するため1件多く取得
+        result = query.order("created_at", desc=True).order("id", desc=True).limit(limit + 1).execute()
+        rows = result.data
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = {"created_at": rows[-1]["created_at"], "id": rows[-1]["id"]}
+        return rows, next_cursor, None
     except Exception as e:
-        return [], str(e)
+        return [], None, str(e)
 
 def load_schedule_by_id(schedule_id):
     """IDでスケジュールを取得"""
@@ -209,23 +422,37 @@ def delete_schedule(schedule_id):
     except Exception as e:
         return False, str(e)
 
-def save_history(execution_date, schedule_id=None, notes="", status="completed"):
-    """実行履歴を保存"""
+def make_history_row(execution_date, schedule_id=None, notes="", status="completed"):
+    """route_history に保存する行を作成（IDはここで決め、再送しても重複しないようにする）"""
+    return {
+        "id": str(uuid.uuid4()),
+        "execution_date": execution_date,
+        "schedule_id": schedule_id,
+        "actual_notes": notes,
+        "status": status
+    }
+
+
+def insert_history_row(data):
+    """make_history_row の行を保存（IDで upsert するため、再送しても重複しない）
+
+    Returns:
+        (保存したID, エラー)
+    """
     supabase = get_supabase_client()
     if not supabase:
         return None, "Supabase未設定"
     try:
-        data = {
-            "execution_date": execution_date,
-            "schedule_id": schedule_id,
-            "actual_notes": notes,
-            "status": status
-        }
-        result = supabase.table("route_history").insert(data).execute()
+        result = supabase.table("route_history").upsert(data, on_conflict="id").execute()
         return result.data[0]["id"], None
     except Exception as e:
         return None, str(e)
 
+
+def save_history(execution_date, schedule_id=None, notes="", status="completed"):
+    """実行履歴を保存（画面からは書き込みキュー経由で保存する）"""
+    return insert_history_row(make_history_row(execution_date, schedule_id, notes, status))
+
 def load_history():
     """実行履歴一覧を取得"""
     supabase = get_supabase_client()
@@ -244,6 +471,11 @@ WORK_HOURS_PER_DAY = 8.0
 TRAVEL_TIME_BIAS_BASE = 1.10  # 通常時: +10%余裕
 TRAVEL_TIME_BIAS_WINTER = 1.50  # 冬季: +50%（積雪・凍結考慮）
 WINTER_MONTHS = [12, 1, 2, 3]  # 冬季月（12月〜3月）
+TRAVEL_BIAS_MODES = {
+    "auto": "自動（月で判定）",
+    "normal": "通常",
+    "winter": "冬季",
+}
 
 # 対象レイヤー（表記ゆれ対応）
 TARGET_LAYERS_RAW = [
@@ -318,13 +550,91 @@ VISIT_FORBIDDEN_START_MINUTE = 30
 VISIT_FORBIDDEN_END_HOUR = 13
 VISIT_FORBIDDEN_END_MINUTE = 0
 
+# ローカルキャッシュ（SQLite）設定
+# 環境変数 ROUTE_APP_CACHE_DIR で保存先を変更可能（Cloud Run等で永続ボリュームを使う場合）
+LOCAL_CACHE_DIR = os.environ.get(
+    "ROUTE_APP_CACHE_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache")
+)
+LOCAL_CACHE_DB_PATH = os.path.join(LOCAL_CACHE_DIR, "route_cache.sqlite3")
+
+# 移動時間キャッシュ設定
+TRAVEL_CACHE_COORD_DECIMALS = 5  # 座標の丸め桁数（小数点以下5桁 ≒ 1m）
+TRAVEL_CACHE_TTL_DAYS = 30  # キャッシュの有効期間（日）
+TRAVEL_CACHE_MAX_ENTRIES = 100000  # ローカルキャッシュの最大件数（超過分は最終利用が古い順に削除）
+TRAVEL_CACHE_SUPABASE_TABLE = "travel_time_cache"  # 共有キャッシュ用テーブル（Supabase設定時のみ使用）
+TRAVEL_CACHE_SUPABASE_MAX_ROWS = 1000  # Supabase 1リクエストあたりの最大取得行数
+
+# ルート形状（ポリライン）キャッシュ設定
+ROUTE_GEOMETRY_CACHE_TTL_DAYS = 90  # キャッシュの有効期間（日）
+ROUTE_GEOMETRY_CACHE_MAX_BYTES = 20 * 1024 * 1024  # 保存するポリラインの合計サイズの上限（超過分は最終利用が古い順に削除）
+
+# 昼食候補レストラン（Places API）設定
+RESTAURANT_SEARCH_RADIUS_METERS = 2000
+RESTAURANT_CACHE_GEOHASH_PRECISION = 6  # ジオハッシュの桁数（6桁 ≒ 1.2km×0.6km のセル単位で検索結果を共有）
+RESTAURANT_CACHE_TTL_DAYS = 7  # キャッシュの有効期間（日）
+PLACES_MAX_WORKERS = 4  # 並列リクエスト数の上限
+
+# Supabase書き込みキュー設定（保存はローカルの記録に積んでから裏で送信）
+SUPABASE_WRITE_MAX_ATTEMPTS = 8  # 送信失敗時の最大試行回数（超えたら失敗として残す）
+SUPABASE_WRITE_BACKOFF_SECONDS = 2.0  # リトライ待機時間の基準値（指数バックオフ＋ジッター）
+SUPABASE_WRITE_MAX_BACKOFF_SECONDS = 300.0  # リトライ待機時間の上限
+SUPABASE_WRITE_DONE_RETENTION_DAYS = 7  # 送信済みの記録を残す日数
+
+# マイマップ（KML）の取得設定
+MYMAP_REFRESH_SECONDS = 600  # 前回の更新確認からこの秒数を過ぎたら、保存済みデータを返しつつ裏で更新確認
+MYMAP_FETCH_TIMEOUT_SECONDS = 30
+
+# Distance Matrix API設定
+DISTANCE_MATRIX_CHUNK_SIZE = 8  # 1リクエストあたりの出発地・目的地の最大数
+SCHEDULE_LIST_PAGE_SIZE = 20  # サイドバーの保存一覧1ページあたりの件数
+SCHEDULE_PLAN_FORMAT_VERSION = 1  # スケジュールに保存する訪問先・タイムテーブルの形式
+SCHEDULE_MATRIX_FORMAT_VERSION = 1  # スケジュールに保存する行列の形式（変更時は旧データを再構築扱いにする）
+UNREACHABLE_VALUE = 999999  # ルートが見つからない区間の値
+# 経路がない区間として（UNREACHABLE_VALUEで）キャッシュする要素のステータス（離島・座標の誤りなど）
+DISTANCE_MATRIX_UNREACHABLE_STATUSES = ("ZERO_RESULTS", "NOT_FOUND")
+DISTANCE_MATRIX_MAX_WORKERS = 4  # 同時に送信するリクエスト数
+DISTANCE_MATRIX_ELEMENTS_PER_SECOND = 1000  # 送信レートの上限（要素数/秒、APIのクォータに合わせる）
+DISTANCE_MATRIX_MAX_RETRIES = 5  # OVER_QUERY_LIMIT 時の最大リトライ回数
+DISTANCE_MATRIX_BACKOFF_SECONDS = 0.5  # リトライ待機時間の基準値（指数バックオフ＋ジッター）
+
+# Directions API設定
+DIRECTIONS_MAX_WAYPOINTS = 25  # 1リクエストあたりの経由地の上限（出発地・目的地を除く）
+
 # ルートカラー
 ROUTE_COLORS = ["blue", "red", "green", "orange", "purple"]
 
+# 結果地図の設定
+MAP_SIMPLIFY_ZOOM = 14  # この拡大率で1ピクセル未満になる形状の細部は省略（Douglas–Peucker）
+MAP_COORD_DECIMALS = 5  # GeoJSONに書き出す座標の桁数
+
 # VRP設定
 MAX_DAILY_WORK_MINUTES = 600
 MAX_DAILY_WORK_SECONDS = MAX_DAILY_WORK_MINUTES * 60
 
+# TSP探索設定
+TSP_TIME_LIMIT_SECONDS = 10  # 戦略ごとの探索時間上限（大規模・じっくりモード）
+TSP_STRATEGIES = [
+    ("PATH_CHEAPEST_ARC", "GUIDED_LOCAL_SEARCH"),
+    ("CHRISTOFIDES", "SIMULATED_ANNEALING"),
+    ("SAVINGS", "GUIDED_LOCAL_SEARCH"),
+]
+TSP_PARALLEL_WORKERS = 3  # 戦略を並列に解くプロセス数の上限（CPU数でさらに制限）
+TSP_STOP_OTHERS_ON_CONVERGENCE = True  # 1つの戦略が収束したら他の戦略の探索を打ち切る
+TSP_PARALLEL_TIMEOUT_MARGIN_SECONDS = 15  # ワーカーからの応答を待つ余裕時間
+
+# 探索時間の配分（ノード数と改善の止まり具合で決める）
+SOLVER_BUDGET_MODES = {
+    "adaptive": "自動（規模に応じて短縮）",
+    "thorough": "じっくり（常に最大時間まで探索）",
+}
+TSP_EXACT_MAX_NODES = 13  # これ以下のノード数（depot含む）は動的計画法で厳密解を求める
+TSP_MEDIUM_MAX_NODES = 20  # これ以下のノード数は改善が止まった時点で打ち切る
+TSP_MEDIUM_TIME_LIMIT_SECONDS = 5  # 中規模の探索時間上限
+TSP_NO_IMPROVEMENT_SECONDS = 1.0  # 中規模: この秒数だけ改善がなければ打ち切る
+VRP_TIME_LIMIT_SECONDS = 20  # 複数日VRPの探索時間上限
+VRP_NO_IMPROVEMENT_SECONDS = 3.0  # 複数日VRP（中規模以下）: 改善がなければ打ち切る秒数
+
 
 # ========================================
 # ユーティリティ関数
@@ -478,7 +788,7 @@ def can_have_meeting(location_name, layer=None):
     return True
 
 
-def reorder_office_genba_pairs(route_indices, visit_df, name_col):
+def reorder_office_genba_pairs(route_indices, visit_df, name_col, site_table=None):
     """
     ルート内の同一場所ペアを事務所→現場の順に並べ替える
     TSP順序を維持しつつ、現場を対応する事務所の直後に移動する
@@ -487,6 +797,7 @@ def reorder_office_genba_pairs(route_indices, visit_df, name_col):
         route_indices: 訪問先インデックスのリスト
         visit_df: 訪問先データフレーム
         name_col: 名前カラム名
+        site_table: 訪問先属性テーブル（Noneの場合はvisit_dfから作成）
 
     Returns:
         並べ替え後のインデックスリスト
@@ -494,24 +805,21 @@ def reorder_office_genba_pairs(route_indices, visit_df, name_col):
     if not route_indices or not name_col:
         return route_indices
 
+    if site_table is None:
+        site_table = build_site_table(visit_df, name_col)
+
     result = list(route_indices)
 
-    # 各訪問先の基本名とタイプを取得
-    idx_info = {}
+    # 各訪問先の基本名とタイプでグループ化
     base_name_groups = {}
     for idx in result:
-        name = visit_df.iloc[idx][name_col]
-        base_name = get_base_location_name(name)
-        is_office = is_office_location(name)
-        is_genba = is_genba_only(name)
-        idx_info[idx] = {"base_name": base_name, "is_office": is_office, "is_genba": is_genba}
-
+        base_name = site_table.base_names[idx]
         if base_name:
             if base_name not in base_name_groups:
                 base_name_groups[base_name] = {"offices": [], "genbas": []}
-            if is_office:
+            if site_table.is_office[idx]:
                 base_name_groups[base_name]["offices"].append(idx)
-            elif is_genba:
+            elif site_table.is_genba[idx]:
                 base_name_groups[base_name]["genbas"].append(idx)
 
     # 現場を対応する事務所の直後に移動
@@ -604,19 +912,28 @@ def adjust_for_lunch_break(arrival_time, stay_minutes, point_name):
     return arrival_time, 0, False
 
 
+# 固定地点マスタの名前を含むかどうかの判定（複数含む場合は FIXED_LOCATIONS の定義順を優先）
+# 各選択肢が先読みで文字列全体を探すため、名前中の出現位置ではなく選択肢の順で決まる
+FIXED_LOCATION_PATTERN = re.compile(
+    "^(?:" + "|".join(f"(?=.*?({re.escape(name)}))" for name in FIXED_LOCATIONS) + ")",
+    re.DOTALL
+)
+
+
 def override_coordinates(df, name_col):
-    """マスターデータで座標を強制上書き"""
+    """マスターデータで座標を強制上書き（df を直接書き換える）"""
     if name_col is None:
         return df
 
-    df = df.copy()
-    for idx, row in df.iterrows():
-        location_name = str(row[name_col]) if pd.notna(row[name_col]) else ""
-        for master_name, master_data in FIXED_LOCATIONS.items():
-            if master_name in location_name:
-                df.at[idx, "lat"] = master_data["lat"]
-                df.at[idx, "lon"] = master_data["lon"]
-                break
+    names = df[name_col].fillna("").astype(str)
+    # 一致した固定地点（グループは FIXED_LOCATIONS の順、一致したグループだけが値を持つ）
+    hits = names.str.extract(FIXED_LOCATION_PATTERN).notna().to_numpy()
+    mask = hits.any(axis=1)
+    if mask.any():
+        master_index = hits[mask].argmax(axis=1)
+        masters = list(FIXED_LOCATIONS.values())
+        df.loc[mask, "lat"] = np.array([data["lat"] for data in masters])[master_index]
+        df.loc[mask, "lon"] = np.array([data["lon"] for data in masters])[master_index]
     return df
 
 
@@ -632,290 +949,2051 @@ def check_naming_rule(df, name_col):
     return invalid_rows[name_col].tolist() if not invalid_rows.empty else []
 
 
-# ========================================
-# Google Maps API関連
-# ========================================
+def filter_layers(layer_normalized, pattern):
+    """カテゴリ型のレイヤー列から pattern を含むレイヤーの行を選ぶ（判定はカテゴリごとに1回）"""
+    categories = layer_normalized.cat.categories
+    return layer_normalized.isin(categories[categories.str.contains(pattern, regex=True)])
 
-@st.cache_data(ttl=600)
-def fetch_data_from_mymap(map_id):
-    """GoogleマイマップからKMLデータを取得"""
-    try:
-        url = f"https://www.google.com/maps/d/kml?mid={map_id}&forcekml=1"
-        response = requests.get(url, timeout=30)
-        response.raise_for_status()
 
-        namespaces = {'kml': 'http://www.opengis.net/kml/2.2'}
-        root = ET.fromstring(response.content)
-
-        data = []
-        folders = root.findall('.//kml:Folder', namespaces)
-        if not folders:
-            folders = root.findall('.//Folder')
-
-        for folder in folders:
-            folder_name_elem = folder.find('kml:name', namespaces)
-            if folder_name_elem is None:
-                folder_name_elem = folder.find('name')
-            layer_name = folder_name_elem.text if folder_name_elem is not None else ""
-
-            placemarks = folder.findall('kml:Placemark', namespaces)
-            if not placemarks:
-                placemarks = folder.findall('Placemark')
-
-            for pm in placemarks:
-                name_elem = pm.find('kml:name', namespaces)
-                if name_elem is None:
-                    name_elem = pm.find('name')
-                name = name_elem.text if name_elem is not None else ""
-
-                desc_elem = pm.find('kml:description', namespaces)
-                if desc_elem is None:
-                    desc_elem = pm.find('description')
-                description = desc_elem.text if desc_elem is not None else ""
-
-                coord_elem = pm.find('.//kml:coordinates', namespaces)
-                if coord_elem is None:
-                    coord_elem = pm.find('.//coordinates')
-
-                if coord_elem is not None and coord_elem.text:
-                    coord_text = coord_elem.text.strip()
-                    parts = coord_text.split(',')
-                    if len(parts) >= 2:
-                        try:
-                            lon = float(parts[0].strip())
-                            lat = float(parts[1].strip())
-                            data.append({
-                                'name': name,
-                                'description': description,
-                                'layer': layer_name,
-                                'lat': lat,
-                                'lon': lon
-                            })
-                        except ValueError:
-                            continue
+def preprocess_map_data(map_df):
+    """マイマップのデータを訪問先選択用に前処理
 
-        if not data:
-            return None, "KMLからデータを抽出できませんでした"
+    固定地点の座標上書き、レイヤー名の正規化（NFKC、カテゴリ型）、対象レイヤーの抽出、
+    対象レイヤーごとの分割（場所名順）までをまとめて行う。
 
-        return pd.DataFrame(data), None
+    Returns:
+        dict: {"name_col", "map_df", "existing_layers", "layer_frames": [(対象レイヤー, データフレーム), ...]}
+    """
+    # 入力（キャッシュ済みのKML解析結果など）は書き換えない
+    map_df = map_df.copy()
+    name_col = get_name_column(map_df)
+    override_coordinates(map_df, name_col)
 
-    except Exception as e:
-        return None, f"エラー: {e}"
+    # レイヤーカラムがない場合は追加
+    if "layer" not in map_df.columns:
+        map_df["layer"] = "その他"
 
+    # レイヤー名を正規化（全角→半角、前後の空白削除）
+    layer = map_df["layer"].fillna("その他").replace("", "その他").astype(str)
+    map_df["layer"] = layer.astype("category")
+    map_df["layer_normalized"] = layer.str.normalize("NFKC").str.strip().astype("category")
 
-def get_travel_time_bias():
-    """現在の月に基づいて移動時間バイアスを計算"""
-    current_month = datetime.now().month
+    existing_layers = map_df["layer_normalized"].cat.categories.tolist()
 
-    if current_month in WINTER_MONTHS:
-        return TRAVEL_TIME_BIAS_WINTER  # 冬季: +50%
-    else:
-        return TRAVEL_TIME_BIAS_BASE  # 通常: +10%
+    # 対象レイヤーのデータのみ抽出
+    target_pattern = "|".join(re.escape(target) for target in TARGET_LAYERS_NORMALIZED)
+    filtered_df = map_df[filter_layers(map_df["layer_normalized"], target_pattern)]
+
+    # 社長宅を除外
+    if name_col:
+        filtered_df = filtered_df[~filtered_df[name_col].str.contains("社長宅", na=False)]
 
+    # 表示用：実際のレイヤー名でグループ化（O2/02の重複を避ける）
+    layer_frames = []
+    displayed_layers = set()
+    for target in TARGET_LAYERS_NORMALIZED:
+        layer_df = filtered_df[filter_layers(filtered_df["layer_normalized"], re.escape(target))]
 
-def create_distance_matrix_google_batched(locations_tuple, api_key, progress_callback=None):
-    """Google Maps Distance Matrix APIで所要時間行列と距離行列を作成（バイアス適用）
+        if len(layer_df) == 0:
+            continue
 
-    Returns:
-        time_matrix: 移動時間行列（秒）
-        dist_matrix: 距離行列（メートル）
-        error: エラーメッセージ（成功時はNone）
-    """
-    try:
-        import time as time_module
-        gmaps = googlemaps.Client(key=api_key)
-        locations = list(locations_tuple)
-        n = len(locations)
-        CHUNK_SIZE = 8
+        # 実際のレイヤー名を取得（重複チェック用）
+        actual_layer_name = layer_df["layer"].iloc[0]
+        if actual_layer_name in displayed_layers:
+            continue  # 既に表示済みのレイヤーはスキップ
+        displayed_layers.add(actual_layer_name)
 
-        # バイアスを取得
-        bias = get_travel_time_bias()
+        # 場所名で並び替え（あいうえお順）
+        if name_col and name_col in layer_df.columns:
+            layer_df = layer_df.sort_values(by=name_col, key=lambda x: x.str.lower()).reset_index(drop=True)
 
-        time_matrix = [[0] * n for _ in range(n)]
-        dist_matrix = [[0] * n for _ in range(n)]  # 距離行列を追加
-        origin_chunks = [locations[i:i + CHUNK_SIZE] for i in range(0, n, CHUNK_SIZE)]
-        dest_chunks = [locations[i:i + CHUNK_SIZE] for i in range(0, n, CHUNK_SIZE)]
+        layer_frames.append((target, layer_df))
 
-        total_requests = len(origin_chunks) * len(dest_chunks)
-        current_request = 0
+    return {
+        "name_col": name_col,
+        "map_df": map_df,
+        "existing_layers": existing_layers,
+        "layer_frames": layer_frames,
+    }
 
-        for orig_idx, origin_chunk in enumerate(origin_chunks):
-            for dest_idx, dest_chunk in enumerate(dest_chunks):
-                current_request += 1
 
-                if progress_callback:
-                    progress = current_request / total_requests
-                    bias_info = f"（冬季モード）" if datetime.now().month in WINTER_MONTHS else ""
-                    progress_callback(progress, f"距離行列取得中{bias_info}... ({current_request}/{total_requests})")
+@st.cache_resource(max_entries=4, show_spinner=False)
+def preprocess_map_data_cached(content_hash, _map_df):
+    """KML本文のハッシュが同じ間は前処理結果を使い回す（rerunのたびの前処理を省略）
 
-                result = gmaps.distance_matrix(
-                    origins=origin_chunk,
-                    destinations=dest_chunk,
-                    mode="driving",
-                    language="ja"
-                )
+    返すデータフレームはセッション間で共有するため、呼び出し側で変更しないこと。
+    """
+    return preprocess_map_data(_map_df)
 
-                if result["status"] != "OK":
-                    raise Exception(f"Distance Matrix API エラー: {result['status']}")
 
-                for i, row in enumerate(result["rows"]):
-                    for j, element in enumerate(row["elements"]):
-                        global_i = orig_idx * CHUNK_SIZE + i
-                        global_j = dest_idx * CHUNK_SIZE + j
+# ========================================
+# 移動時間・距離行列
+# ========================================
 
-                        if element["status"] == "OK":
-                            # バイアスを適用した移動時間
-                            raw_duration = element["duration"]["value"]
-                            time_matrix[global_i][global_j] = int(raw_duration * bias)
-                            # 距離（メートル）
-                            dist_matrix[global_i][global_j] = element["distance"]["value"]
-                        else:
-                            time_matrix[global_i][global_j] = 999999
-                            dist_matrix[global_i][global_j] = 999999
+class TravelMatrix:
+    """移動時間・距離行列（int32のndarray＋地点キー→行番号の対応表）
 
-                if current_request < total_requests:
-                    time_module.sleep(0.1)
+    - M[i, j] でPythonのintとして要素を取得
+    - M.submatrix(indices) で部分行列を取得（np.ix_ によるファンシーインデックス）
+    - M.keys[i] は行 i の地点キー（部分行列では元の地点のキーを引き継ぐ）
+    """
 
-        return time_matrix, dist_matrix, None
+    __slots__ = ("values", "keys", "index")
 
-    except Exception as e:
-        return None, None, f"エラー: {str(e)}"
+    def __init__(self, values, keys=None):
+        self.values = np.ascontiguousarray(values, dtype=np.int32)
+        if self.values.ndim != 2 or self.values.shape[0] != self.values.shape[1]:
+            raise ValueError(f"正方行列ではありません: {self.values.shape}")
+        self.keys = tuple(keys) if keys is not None else tuple(range(self.values.shape[0]))
+        # 同一座標が複数ある場合は最初の行を返す
+        self.index = {}
+        for i, key in enumerate(self.keys):
+            self.index.setdefault(key, i)
 
+    def __len__(self):
+        return self.values.shape[0]
 
-@st.cache_data
-def get_route_polyline(origin, destination, api_key):
-    """Google Directions APIでルートのポリラインを取得"""
-    try:
-        gmaps = googlemaps.Client(key=api_key)
-        result = gmaps.directions(origin=origin, destination=destination, mode="driving")
+    def __getitem__(self, pos):
+        i, j = pos
+        return int(self.values[i, j])
 
-        if result and len(result) > 0:
-            encoded_polyline = result[0]["overview_polyline"]["points"]
-            decoded = polyline.decode(encoded_polyline)
-            return decoded, None
-        else:
-            return None, "ルートが見つかりません"
+    def index_of(self, key):
+        """地点キーから行番号を取得"""
+        return self.index[key]
 
-    except Exception as e:
-        return None, f"Directions API エラー: {str(e)}"
+    def submatrix(self, indices):
+        """指定した行番号の部分行列を取得"""
+        idx = np.asarray(indices, dtype=np.intp)
+        return TravelMatrix(self.values[np.ix_(idx, idx)], [self.keys[i] for i in idx])
 
+    def tolist(self):
+        """入れ子リストに変換（OR-Tools等への受け渡し用）"""
+        return self.values.tolist()
 
-def geocode_address(address, api_key):
-    """Google Geocoding APIで住所から緯度経度を取得"""
-    try:
-        gmaps = googlemaps.Client(key=api_key)
-        result = gmaps.geocode(address, language="ja")
 
-        if result and len(result) > 0:
-            location = result[0]["geometry"]["location"]
-            formatted_address = result[0].get("formatted_address", address)
-            return {
-                "lat": location["lat"],
-                "lon": location["lng"],
-                "formatted_address": formatted_address
-            }, None
-        else:
-            return None, "住所が見つかりませんでした"
-    except Exception as e:
-        return None, str(e)
+def as_travel_matrix(matrix):
+    """入れ子リスト・ndarray・TravelMatrix のいずれも TravelMatrix に変換"""
+    if isinstance(matrix, TravelMatrix):
+        return matrix
+    return TravelMatrix(matrix)
+
+
+# ========================================
+# ローカルキャッシュ（SQLite）
+# ========================================
+
+LOCAL_CACHE_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS travel_time_cache (
+        origin_key TEXT NOT NULL,
+        dest_key TEXT NOT NULL,
+        mode TEXT NOT NULL,
+        duration INTEGER NOT NULL,
+        distance INTEGER NOT NULL,
+        fetched_at REAL NOT NULL,
+        last_used_at REAL NOT NULL,
+        PRIMARY KEY (origin_key, dest_key, mode)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_travel_time_cache_last_used ON travel_time_cache(last_used_at)",
+    """
+    CREATE TABLE IF NOT EXISTS route_geometry_cache (
+        route_key TEXT PRIMARY KEY,
+        encoded_polyline TEXT NOT NULL,
+        size_bytes INTEGER NOT NULL,
+        fetched_at REAL NOT NULL,
+        last_used_at REAL NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_route_geometry_cache_last_used ON route_geometry_cache(last_used_at)",
+    """
+    CREATE TABLE IF NOT EXISTS restaurant_cache (
+        cell TEXT PRIMARY KEY,
+        restaurants TEXT NOT NULL,
+        fetched_at REAL NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS supabase_write_queue (
+        job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        status TEXT NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt_at REAL NOT NULL,
+        last_error TEXT,
+        result_id TEXT,
+        created_at REAL NOT NULL,
+        updated_at REAL NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_supabase_write_queue_due ON supabase_write_queue(status, next_attempt_at)",
+    """
+    CREATE TABLE IF NOT EXISTS mymap_source (
+        map_id TEXT PRIMARY KEY,
+        etag TEXT,
+        last_modified TEXT,
+        content_hash TEXT NOT NULL,
+        revision INTEGER NOT NULL,
+        last_diff TEXT,
+        checked_at REAL NOT NULL,
+        updated_at REAL NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS mymap_placemarks (
+        map_id TEXT NOT NULL,
+        position INTEGER NOT NULL,
+        name TEXT,
+        description TEXT,
+        layer TEXT,
+        lat REAL NOT NULL,
+        lon REAL NOT NULL,
+        PRIMARY KEY (map_id, position)
+    )
+    """,
+]
 
 
-@st.cache_data(ttl=3600)
-def find_nearby_restaurant(lat, lon, api_key):
-    """Google Places APIで近くのレストランを検索"""
+@st.cache_resource
+def init_local_cache_db():
+    """ローカルキャッシュDBを初期化してパスを返す（プロセスごとに1回だけ実行）"""
+    os.makedirs(LOCAL_CACHE_DIR, exist_ok=True)
+    conn = sqlite3.connect(LOCAL_CACHE_DB_PATH, timeout=10)
     try:
-        gmaps = googlemaps.Client(key=api_key)
-        result = gmaps.places_nearby(
-            location=(lat, lon),
-            radius=2000,
-            type="restaurant",
-            language="ja"
-        )
+        # WALモード: 複数セッションからの同時読み書きに対応
+        conn.execute("PRAGMA journal_mode=WAL")
+        for statement in LOCAL_CACHE_SCHEMA:
+            conn.execute(statement)
+        conn.commit()
+    finally:
+        conn.close()
+    return LOCAL_CACHE_DB_PATH
 
-        if result and "results" in result and len(result["results"]) > 0:
-            restaurants = [r for r in result["results"]
-                          if "convenience_store" not in r.get("types", [])]
-            restaurants = sorted(restaurants, key=lambda x: x.get("rating", 0), reverse=True)
 
-            top_restaurants = []
-            for r in restaurants[:3]:
-                top_restaurants.append({
-                    "name": r.get("name", "不明"),
-                    "address": r.get("vicinity", ""),
-                    "rating": r.get("rating", 0),
-                    "lat": r["geometry"]["location"]["lat"],
-                    "lon": r["geometry"]["location"]["lng"]
-                })
-            return top_restaurants, None
-        else:
-            return [], "近くにレストランが見つかりませんでした"
+def open_local_cache_db():
+    """ローカルキャッシュDBに接続（呼び出し側でcloseすること）
 
-    except Exception as e:
-        return [], f"Places API エラー: {str(e)}"
+    キャッシュ用ディレクトリを作成できない場合（読み取り専用など）も sqlite3.Error として送出し、
+    呼び出し側の「キャッシュなしで続行」の処理に合わせる。
+    """
+    try:
+        return sqlite3.connect(init_local_cache_db(), timeout=10)
+    except OSError as e:
+        raise sqlite3.OperationalError(f"ローカルキャッシュを開けません: {e}") from e
 
 
 # ========================================
-# VRP最適化
+# 移動時間キャッシュ（出発地→目的地）
 # ========================================
 
-def solve_vrp_multi_day(time_matrix, num_days, depot_idx=0, stay_times=None):
-    """VRPで複数日に分割して最適化"""
-    n = len(time_matrix)
+def make_location_key(lat, lon):
+    """座標を丸めてキャッシュキーを作成（例: "39.29462_141.11325"）"""
+    digits = TRAVEL_CACHE_COORD_DECIMALS
+    return f"{float(lat):.{digits}f}_{float(lon):.{digits}f}"
 
-    if n <= 1:
-        return [[]], [0]
 
-    if stay_times is None:
-        stay_times = [DEFAULT_STAY_DURATION * 60] * n
-        stay_times[depot_idx] = 0
+def load_cached_travel_times(location_keys, mode="driving"):
+    """ローカルキャッシュから移動時間・距離を取得
 
-    manager = pywrapcp.RoutingIndexManager(n, num_days, depot_idx)
-    routing = pywrapcp.RoutingModel(manager)
+    Args:
+        location_keys: 地点キーのリスト（全ペアを検索）
+        mode: 移動手段
 
-    def time_plus_stay_callback(from_index, to_index):
-        from_node = manager.IndexToNode(from_index)
-        to_node = manager.IndexToNode(to_index)
-        travel_time = time_matrix[from_node][to_node]
-        stay_time = stay_times[to_node] if to_node != depot_idx else 0
-        return travel_time + stay_time
+    Returns:
+        dict: {(出発地キー, 目的地キー): (所要時間秒, 距離メートル)}
+    """
+    keys = sorted(set(location_keys))
+    if not keys:
+        return {}
+
+    now = time.time()
+    cutoff = now - TRAVEL_CACHE_TTL_DAYS * 86400
+    # 地点キーは一時テーブルに入れて結合する（IN (?, ...) だと地点数が多いと変数の上限を超える）
+    where = ("mode = ? AND fetched_at >= ? "
+             "AND origin_key IN (SELECT key FROM temp.lookup_location_keys) "
+             "AND dest_key IN (SELECT key FROM temp.lookup_location_keys)")
+    params = [mode, cutoff]
 
-    transit_callback_index = routing.RegisterTransitCallback(time_plus_stay_callback)
-    routing.SetArcCostEvaluatorOfAllVehicles(transit_callback_index)
+    try:
+        conn = open_local_cache_db()
+        try:
+            conn.execute("CREATE TEMP TABLE IF NOT EXISTS lookup_location_keys (key TEXT PRIMARY KEY)")
+            conn.executemany("INSERT INTO temp.lookup_location_keys (key) VALUES (?)", [(key,) for key in keys])
+            rows = conn.execute(
+                f"SELECT origin_key, dest_key, duration, distance FROM travel_time_cache WHERE {where}",
+                params
+            ).fetchall()
+            # LRU: 利用した行の最終利用時刻を更新
+            if rows:
+                conn.execute(f"UPDATE travel_time_cache SET last_used_at = ? WHERE {where}", [now] + params)
+                conn.commit()
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return {}
+
+    return {(o, d): (duration, distance) for o, d, duration, distance in rows}
+
+
+def save_cached_travel_times(cells, mode="driving"):
+    """移動時間・距離をローカルキャッシュに保存（期限切れ削除・件数上限での削除も実施）
 
-    vehicle_capacities = [MAX_DAILY_WORK_SECONDS] * num_days
-    routing.AddDimensionWithVehicleCapacity(
-        transit_callback_index,
-        0,
-        vehicle_capacities,
-        True,
-        "WorkTime"
-    )
+    Args:
+        cells: {(出発地キー, 目的地キー): (所要時間秒, 距離メートル)}
+        mode: 移動手段
+    """
+    if not cells:
+        return
 
-    time_dimension = routing.GetDimensionOrDie("WorkTime")
-    time_dimension.SetGlobalSpanCostCoefficient(100)
+    now = time.time()
+    rows = [(o, d, mode, int(duration), int(distance), now, now)
+            for (o, d), (duration, distance) in cells.items()]
 
-    for i in range(num_days):
-        routing.AddVariableMinimizedByFinalizer(
-            time_dimension.CumulVar(routing.End(i))
-        )
+    try:
+        conn = open_local_cache_db()
+        try:
+            conn.executemany(
+                "INSERT OR REPLACE INTO travel_time_cache "
+                "(origin_key, dest_key, mode, duration, distance, fetched_at, last_used_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                rows
+            )
+            # TTL: 期限切れを削除
+            conn.execute("DELETE FROM travel_time_cache WHERE fetched_at < ?",
+                         (now - TRAVEL_CACHE_TTL_DAYS * 86400,))
+            # LRU: 上限を超えた分を最終利用が古い順に削除
+            count = conn.execute("SELECT COUNT(*) FROM travel_time_cache").fetchone()[0]
+            if count > TRAVEL_CACHE_MAX_ENTRIES:
+                conn.execute(
+                    "DELETE FROM travel_time_cache WHERE rowid IN "
+                    "(SELECT rowid FROM travel_time_cache ORDER BY last_used_at LIMIT ?)",
+                    (count - TRAVEL_CACHE_MAX_ENTRIES,)
+                )
+            conn.commit()
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        pass
 
-    search_parameters = pywrapcp.DefaultRoutingSearchParameters()
-    search_parameters.first_solution_strategy = (
-        routing_enums_pb2.FirstSolutionStrategy.PATH_CHEAPEST_ARC
-    )
-    search_parameters.local_search_metaheuristic = (
-        routing_enums_pb2.LocalSearchMetaheuristic.GUIDED_LOCAL_SEARCH
-    )
-    search_parameters.time_limit.seconds = 20
 
-    solution = routing.SolveWithParameters(search_parameters)
+def load_remote_travel_times(location_keys, mode="driving"):
+    """Supabaseの共有キャッシュから移動時間・距離を取得（未設定時は空）
 
-    if solution:
-        routes = []
-        route_times = []
+    Returns:
+        dict: {(出発地キー, 目的地キー): (所要時間秒, 距離メートル)}
+    """
+    supabase = get_supabase_client()
+    keys = sorted(set(location_keys))
+    if not supabase or not keys:
+        return {}
 
-        for vehicle_id in range(num_days):
-            route = []
+    cutoff = (datetime.now(timezone.utc) - timedelta(days=TRAVEL_CACHE_TTL_DAYS)).isoformat()
+    # 1リクエストの取得行数が上限を超えないよう出発地を分割
+    origins_per_request = max(1, TRAVEL_CACHE_SUPABASE_MAX_ROWS // len(keys))
+
+    cells = {}
+    try:
+        for start in range(0, len(keys), origins_per_request):
+            origin_keys = keys[start:start + origins_per_request]
+            result = (
+                supabase.table(TRAVEL_CACHE_SUPABASE_TABLE)
+                .select("origin_key, dest_key, duration, distance")
+                .eq("mode", mode)
+                .in_("origin_key", origin_keys)
+                .in_("dest_key", keys)
+                .gte("fetched_at", cutoff)
+                .execute()
+            )
+            for row in result.data:
+                cells[(row["origin_key"], row["dest_key"])] = (row["duration"], row["distance"])
+    except Exception:
+        # 共有キャッシュは任意機能のため、失敗してもAPI取得で継続
+        return cells
+    return cells
+
+
+def save_remote_travel_times(cells, mode="driving"):
+    """移動時間・距離をSupabaseの共有キャッシュに保存（未設定時は何もしない）"""
+    supabase = get_supabase_client()
+    if not supabase or not cells:
+        return
+
+    fetched_at = datetime.now(timezone.utc).isoformat()
+    rows = [{
+        "origin_key": o,
+        "dest_key": d,
+        "mode": mode,
+        "duration": int(duration),
+        "distance": int(distance),
+        "fetched_at": fetched_at
+    } for (o, d), (duration, distance) in cells.items()]
+
+    try:
+        for start in range(0, len(rows), 500):
+            supabase.table(TRAVEL_CACHE_SUPABASE_TABLE).upsert(
+                rows[start:start + 500], on_conflict="origin_key,dest_key,mode"
+            ).execute()
+    except Exception:
+        pass
+
+
+# ========================================
+# ルート形状キャッシュ（地図表示用ポリライン）
+# ========================================
+
+def make_route_geometry_key(stops, mode="driving"):
+    """訪問順の地点（丸めた座標）からルート形状のキャッシュキーを作成"""
+    route_text = mode + "|" + "|".join(make_location_key(lat, lon) for lat, lon in stops)
+    return hashlib.sha256(route_text.encode("utf-8")).hexdigest()
+
+
+def load_cached_route_geometry(route_key):
+    """ローカルキャッシュからルート形状を取得
+
+    Returns:
+        座標のリスト。未保存・期限切れの場合は None
+    """
+    now = time.time()
+    try:
+        conn = open_local_cache_db()
+        try:
+            row = conn.execute(
+                "SELECT encoded_polyline FROM route_geometry_cache WHERE route_key = ? AND fetched_at >= ?",
+                (route_key, now - ROUTE_GEOMETRY_CACHE_TTL_DAYS * 86400)
+            ).fetchone()
+            if row:
+                conn.execute("UPDATE route_geometry_cache SET last_used_at = ? WHERE route_key = ?", (now, route_key))
+                conn.commit()
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return None
+
+    return polyline.decode(row[0]) if row else None
+
+
+def save_cached_route_geometry(route_key, points):
+    """ルート形状をエンコード済みポリラインでローカルキャッシュに保存（期限切れ・容量超過分も削除）"""
+    encoded = polyline.encode(points)
+    now = time.time()
+    try:
+        conn = open_local_cache_db()
+        try:
+            conn.execute(
+                "INSERT OR REPLACE INTO route_geometry_cache "
+                "(route_key, encoded_polyline, size_bytes, fetched_at, last_used_at) VALUES (?, ?, ?, ?, ?)",
+                (route_key, encoded, len(encoded), now, now)
+            )
+            # TTL: 期限切れを削除
+            conn.execute("DELETE FROM route_geometry_cache WHERE fetched_at < ?",
+                         (now - ROUTE_GEOMETRY_CACHE_TTL_DAYS * 86400,))
+            # LRU: 合計サイズが上限を超えた分を最終利用が古い順に削除
+            conn.execute(
+                "DELETE FROM route_geometry_cache WHERE route_key IN ("
+                "SELECT route_key FROM (SELECT route_key, SUM(size_bytes) OVER "
+                "(ORDER BY last_used_at DESC, route_key) AS total_bytes FROM route_geometry_cache) "
+                "WHERE total_bytes > ?)",
+                (ROUTE_GEOMETRY_CACHE_MAX_BYTES,)
+            )
+            conn.commit()
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        pass
+
+
+def plan_distance_matrix_requests(missing_pairs, chunk_size=DISTANCE_MATRIX_CHUNK_SIZE):
+    """未取得のセルだけをDistance Matrix APIで取得するためのリクエスト計画を作成
+
+    未取得の目的地がほぼ同じ出発地（差が自分自身の1件まで）を chunk_size 件ずつまとめ、
+    そのまとまりの目的地を chunk_size 件ずつに分割する。
+    （例: 初回は全区間、1地点追加時は「新地点→全地点」「全地点→新地点」の区間だけを取得）
+
+    Args:
+        missing_pairs: 未取得の(出発地キー, 目的地キー)の集合
+        chunk_size: 1リクエストあたりの出発地・目的地の最大数
+
+    Returns:
+        list: [(出発地キーのリスト, 目的地キーのリスト), ...]
+    """
+    dests_by_origin = {}
+    for origin_key, dest_key in missing_pairs:
+        dests_by_origin.setdefault(origin_key, set()).add(dest_key)
+
+    # 未取得の目的地が多い出発地から順に、無駄な要素が増えないまとまりに割り当てる
+    origin_groups = []  # [(出発地キーのリスト, 目的地キーの集合), ...]
+    for origin_key in sorted(dests_by_origin, key=lambda k: (-len(dests_by_origin[k]), k)):
+        dest_keys = dests_by_origin[origin_key]
+        for group_origins, group_dests in origin_groups:
+            if len(group_origins) >= chunk_size:
+                continue
+            union = group_dests | dest_keys
+            if len(union) <= len(dest_keys) + 1 and len(union) <= len(group_dests) + 1:
+                group_origins.append(origin_key)
+                group_dests |= dest_keys
+                break
+        else:
+            origin_groups.append(([origin_key], set(dest_keys)))
+
+    requests_plan = []
+    for group_origins, group_dests in origin_groups:
+        dest_keys = sorted(group_dests)
+        for j in range(0, len(dest_keys), chunk_size):
+            requests_plan.append((group_origins, dest_keys[j:j + chunk_size]))
+    return requests_plan
+
+
+# ========================================
+# マイマップ地点ストア（SQLite）
+# ========================================
+
+def read_mymap_source(conn, map_id):
+    """mymap_source の1行を dict で返す（未保存の場合は None）"""
+    row = conn.execute(
+        "SELECT etag, last_modified, content_hash, revision, last_diff, checked_at, updated_at "
+        "FROM mymap_source WHERE map_id = ?",
+        (map_id,)
+    ).fetchone()
+    if row is None:
+        return None
+    etag, last_modified, content_hash, revision, last_diff, checked_at, updated_at = row
+    return {
+        "etag": etag,
+        "last_modified": last_modified,
+        "content_hash": content_hash,
+        "revision": revision,
+        "last_diff": json.loads(last_diff) if last_diff else None,
+        "checked_at": checked_at,
+        "updated_at": updated_at,
+    }
+
+
+def load_mymap_source(map_id):
+    """保存済みのマイマップの取得情報（検証用ヘッダー・ハッシュ・リビジョン・前回の差分）を読み込む
+
+    Returns:
+        dict。未保存の場合は None
+    """
+    try:
+        conn = open_local_cache_db()
+        try:
+            return read_mymap_source(conn, map_id)
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return None
+
+
+def load_stored_mymap(map_id):
+    """保存済みのマイマップ地点と取得情報を読み込む
+
+    裏での更新と重なっても地点とハッシュが食い違わないよう、1つのトランザクションで読む。
+
+    Returns:
+        (地点の列dict（parse_mymap_kml と同じ形式）, 取得情報dict)。未保存の場合は (None, None)
+    """
+    try:
+        conn = open_local_cache_db()
+        try:
+            conn.execute("BEGIN")
+            source = read_mymap_source(conn, map_id)
+            rows = conn.execute(
+                "SELECT name, description, layer, lat, lon FROM mymap_placemarks "
+                "WHERE map_id = ? ORDER BY position",
+                (map_id,)
+            ).fetchall()
+            conn.rollback()
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return None, None
+
+    if source is None:
+        return None, None
+
+    names, descriptions, layers, lats, lons = zip(*rows) if rows else ((),) * 5
+    placemarks = {
+        "name": list(names),
+        "description": list(descriptions),
+        "layer": list(layers),
+        "lat": array("d", lats),
+        "lon": array("d", lons),
+    }
+    return placemarks, source
+
+
+def save_stored_mymap(map_id, placemarks, etag, last_modified, content_hash, diff):
+    """マイマップ地点を保存し、リビジョンを1つ進める（地点は丸ごと入れ替え）"""
+    now = time.time()
+    try:
+        conn = open_local_cache_db()
+        try:
+            row = conn.execute("SELECT revision FROM mymap_source WHERE map_id = ?", (map_id,)).fetchone()
+            revision = (row[0] + 1) if row else 1
+            conn.execute("DELETE FROM mymap_placemarks WHERE map_id = ?", (map_id,))
+            conn.executemany(
+                "INSERT INTO mymap_placemarks (map_id, position, name, description, layer, lat, lon) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(map_id, position, name, description, layer, lat, lon)
+                 for position, (name, description, layer, lat, lon) in enumerate(zip(
+                     placemarks["name"], placemarks["description"], placemarks["layer"],
+                     placemarks["lat"], placemarks["lon"]
+                 ))]
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO mymap_source "
+                "(map_id, etag, last_modified, content_hash, revision, last_diff, checked_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (map_id, etag, last_modified, content_hash, revision,
+                 json.dumps(diff, ensure_ascii=False) if diff else None, now, now)
+            )
+            conn.commit()
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        pass
+
+
+def touch_stored_mymap(map_id, etag=None, last_modified=None):
+    """内容に変更がなかった場合に、更新確認の時刻（と検証用ヘッダー）だけを更新"""
+    try:
+        conn = open_local_cache_db()
+        try:
+            conn.execute(
+                "UPDATE mymap_source SET checked_at = ?, "
+                "etag = COALESCE(?, etag), last_modified = COALESCE(?, last_modified) "
+                "WHERE map_id = ?",
+                (time.time(), etag, last_modified, map_id)
+            )
+            conn.commit()
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        pass
+
+
+def diff_placemarks(old_placemarks, new_placemarks):
+    """地点を「名前＋座標」で突き合わせて差分を求める
+
+    座標が変わった地点は削除＋追加として扱う（座標をキーにした移動時間・ルートのキャッシュは
+    その地点の分だけが無効になり、変わっていない地点のキャッシュはそのまま使われる）。
+
+    Returns:
+        dict: {"added": [名前...], "removed": [名前...], "changed": [名前...]}
+              changed はレイヤー・説明文だけが変わった地点
+    """
+    def index(placemarks):
+        return {
+            (name, make_location_key(lat, lon)): (layer, description)
+            for name, description, layer, lat, lon in zip(
+                placemarks["name"], placemarks["description"], placemarks["layer"],
+                placemarks["lat"], placemarks["lon"]
+            )
+        }
+
+    old_index = index(old_placemarks)
+    new_index = index(new_placemarks)
+    return {
+        "added": sorted(name for name, _ in new_index.keys() - old_index.keys()),
+        "removed": sorted(name for name, _ in old_index.keys() - new_index.keys()),
+        "changed": sorted(
+            name for name, location_key in new_index.keys() & old_index.keys()
+            if old_index[(name, location_key)] != new_index[(name, location_key)]
+        ),
+    }
+
+
+def refresh_mymap_store(map_id):
+    """マイマップのKMLを条件付きで取得し、変更があれば地点ストアを更新
+
+    ETag / Last-Modified があれば条件付きリクエスト（304なら本文を取得しない）、
+    本文を取得した場合もハッシュが前回と同じなら解析・保存を省略する。
+
+    Returns:
+        (地点の列dict, 差分dict, エラー)。変更がない場合の差分は None
+    """
+    old_placemarks, source = load_stored_mymap(map_id)
+    headers = {}
+    if source:
+        if source["etag"]:
+            headers["If-None-Match"] = source["etag"]
+        if source["last_modified"]:
+            headers["If-Modified-Since"] = source["last_modified"]
+
+    try:
+        url = f"https://www.google.com/maps/d/kml?mid={map_id}&forcekml=1"
+        response = get_http_session().get(url, headers=headers, timeout=MYMAP_FETCH_TIMEOUT_SECONDS)
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if response.status_code == 304 and old_placemarks is not None:
+            touch_stored_mymap(map_id, etag, last_modified)
+            return old_placemarks, None, None
+        response.raise_for_status()
+
+        content_hash = hashlib.sha256(response.content).hexdigest()
+        if source and source["content_hash"] == content_hash:
+            touch_stored_mymap(map_id, etag, last_modified)
+            return old_placemarks, None, None
+
+        placemarks = parse_mymap_kml(response.content)
+    except Exception as e:
+        if source:
+            # 取得に失敗しても保存済みデータで継続（次回の確認は MYMAP_REFRESH_SECONDS 後）
+            touch_stored_mymap(map_id)
+        return old_placemarks, None, f"エラー: {e}"
+
+    if not placemarks["name"]:
+        # 地点のないKMLでも確認時刻は更新する（更新しないと再実行のたびに裏で取得し直す）
+        touch_stored_mymap(map_id, etag, last_modified)
+        return old_placemarks, None, "KMLからデータを抽出できませんでした"
+
+    diff = diff_placemarks(old_placemarks, placemarks) if old_placemarks is not None else None
+    save_stored_mymap(map_id, placemarks, etag, last_modified, content_hash, diff)
+    return placemarks, diff, None
+
+
+@st.cache_resource
+def get_mymap_refresh_state():
+    """裏で実行中のマイマップ更新確認（プロセス内で共有、同じマップの多重実行を防ぐ）"""
+    return {"lock": threading.Lock(), "running": set()}
+
+
+def start_mymap_background_refresh(map_id):
+    """マイマップの更新確認を別スレッドで開始（実行中なら何もしない）"""
+    state = get_mymap_refresh_state()
+    with state["lock"]:
+        if map_id in state["running"]:
+            return
+        state["running"].add(map_id)
+
+    def run():
+        try:
+            refresh_mymap_store(map_id)
+        finally:
+            with state["lock"]:
+                state["running"].discard(map_id)
+
+    threading.Thread(target=run, daemon=True).start()
+
+
+# ========================================
+# Supabase書き込みキュー（write-behind）
+# ========================================
+
+# 書き込みの種類 → 保存処理（行のdictを受け取り (ID, エラー) を返す）
+SUPABASE_WRITE_HANDLERS = {
+    "schedule": insert_schedule_row,
+    "history": insert_history_row,
+}
+
+
+def enqueue_supabase_write(kind, row):
+    """Supabaseへの書き込みをローカルの記録（SQLite）に積み、裏のスレッドで送信する
+
+    記録に書いた時点で戻る（画面はSupabaseの応答を待たない）。
+    送信に失敗した書き込みは再起動後も記録に残り、バックオフしながら再送する。
+
+    Args:
+        kind: 書き込みの種類（SUPABASE_WRITE_HANDLERS のキー）
+        row: 保存する行（make_schedule_row / make_history_row の結果）
+
+    Returns:
+        (ジョブID, エラー)
+    """
+    now = time.time()
+    try:
+        conn = open_local_cache_db()
+        try:
+            cursor = conn.execute(
+                "INSERT INTO supabase_write_queue "
+                "(kind, payload, status, attempts, next_attempt_at, created_at, updated_at) "
+                "VALUES (?, ?, 'pending', 0, ?, ?, ?)",
+                (kind, json.dumps(row, ensure_ascii=False, default=to_json_scalar), now, now, now)
+            )
+            job_id = cursor.lastrowid
+            # 送信済みの古い記録を削除
+            conn.execute("DELETE FROM supabase_write_queue WHERE status = 'done' AND updated_at < ?",
+                         (now - SUPABASE_WRITE_DONE_RETENTION_DAYS * 86400,))
+            conn.commit()
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        return None, f"保存の記録に失敗しました: {e}"
+
+    start_supabase_write_worker()
+    return job_id, None
+
+
+def load_supabase_write_jobs(job_ids):
+    """書き込みジョブの状態を取得
+
+    Returns:
+        dict: {ジョブID: {"kind", "status", "attempts", "last_error", "result_id"}}
+        （status は pending / done / failed）
+    """
+    job_ids = list(job_ids)
+    if not job_ids:
+        return {}
+    try:
+        conn = open_local_cache_db()
+        try:
+            placeholders = ",".join("?" * len(job_ids))
+            rows = conn.execute(
+                f"SELECT job_id, kind, status, attempts, last_error, result_id "
+                f"FROM supabase_write_queue WHERE job_id IN ({placeholders})",
+                job_ids
+            ).fetchall()
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return {}
+    return {
+        job_id: {"kind": kind, "status": status, "attempts": attempts,
+                 "last_error": last_error, "result_id": result_id}
+        for job_id, kind, status, attempts, last_error, result_id in rows
+    }
+
+
+def retry_supabase_write(job_id):
+    """失敗した書き込みジョブを再送待ちに戻す"""
+    now = time.time()
+    try:
+        conn = open_local_cache_db()
+        try:
+            conn.execute(
+                "UPDATE supabase_write_queue SET status = 'pending', attempts = 0, "
+                "next_attempt_at = ?, updated_at = ? WHERE job_id = ? AND status = 'failed'",
+                (now, now, job_id)
+            )
+            conn.commit()
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return
+    start_supabase_write_worker()
+
+
+def claim_due_supabase_write():
+    """送信時刻になった書き込みジョブを1件取得
+
+    Returns:
+        (ジョブ, 次に送信時刻になるまでの秒数)。ジョブがない場合は (None, 秒数 or None)
+    """
+    now = time.time()
+    conn = open_local_cache_db()
+    try:
+        row = conn.execute(
+            "SELECT job_id, kind, payload, attempts FROM supabase_write_queue "
+            "WHERE status = 'pending' AND next_attempt_at <= ? ORDER BY job_id LIMIT 1",
+            (now,)
+        ).fetchone()
+        if row:
+            return {"job_id": row[0], "kind": row[1], "payload": row[2], "attempts": row[3]}, 0.0
+        next_row = conn.execute(
+            "SELECT MIN(next_attempt_at) FROM supabase_write_queue WHERE status = 'pending'"
+        ).fetchone()
+    finally:
+        conn.close()
+    if next_row[0] is None:
+        return None, None
+    return None, max(0.0, next_row[0] - now)
+
+
+def finish_supabase_write(job, result_id, error):
+    """書き込みジョブの結果を記録（失敗時はバックオフして再送待ち、上限を超えたら失敗）"""
+    now = time.time()
+    attempts = job["attempts"] + 1
+    conn = open_local_cache_db()
+    try:
+        if error is None:
+            conn.execute(
+                "UPDATE supabase_write_queue SET status = 'done', attempts = ?, last_error = NULL, "
+                "result_id = ?, updated_at = ? WHERE job_id = ?",
+                (attempts, None if result_id is None else str(result_id), now, job["job_id"])
+            )
+        else:
+            status = "failed" if attempts >= SUPABASE_WRITE_MAX_ATTEMPTS else "pending"
+            backoff = min(SUPABASE_WRITE_MAX_BACKOFF_SECONDS,
+                          SUPABASE_WRITE_BACKOFF_SECONDS * (2 ** (attempts - 1)))
+            conn.execute(
+                "UPDATE supabase_write_queue SET status = ?, attempts = ?, last_error = ?, "
+                "next_attempt_at = ?, updated_at = ? WHERE job_id = ?",
+                (status, attempts, str(error), now + backoff * random.uniform(0.5, 1.0), now, job["job_id"])
+            )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+@st.cache_resource
+def get_supabase_write_worker_state():
+    """書き込みキューの送信スレッドの状態（プロセス内で共有、スレッドは1本だけ）"""
+    return {"lock": threading.Lock(), "thread": None, "wake": threading.Event(), "resumed": False}
+
+
+def run_supabase_write_worker(state):
+    """送信時刻になったジョブを順に送信し、送信待ちがなくなったら終了する"""
+    while True:
+        try:
+            job, wait_seconds = claim_due_supabase_write()
+        except sqlite3.Error:
+            job, wait_seconds = None, SUPABASE_WRITE_BACKOFF_SECONDS
+
+        if job is None:
+            if wait_seconds is None:
+                with state["lock"]:
+                    # 終了直前に積まれたジョブがあれば続ける（積んだ側はスレッド実行中と判断している）
+                    try:
+                        job, wait_seconds = claim_due_supabase_write()
+                    except sqlite3.Error:
+                        wait_seconds = SUPABASE_WRITE_BACKOFF_SECONDS
+                    if job is None and wait_seconds is None:
+                        state["thread"] = None
+                        return
+            if job is None:
+                state["wake"].wait(timeout=min(wait_seconds, SUPABASE_WRITE_MAX_BACKOFF_SECONDS))
+                state["wake"].clear()
+                continue
+
+        handler = SUPABASE_WRITE_HANDLERS.get(job["kind"])
+        try:
+            if handler is None:
+                result_id, error = None, f"不明な書き込みの種類: {job['kind']}"
+            else:
+                result_id, error = handler(json.loads(job["payload"]))
+        except Exception as e:
+            result_id, error = None, str(e)
+        try:
+            finish_supabase_write(job, result_id, error)
+        except sqlite3.Error:
+            time.sleep(SUPABASE_WRITE_BACKOFF_SECONDS)
+
+
+def start_supabase_write_worker():
+    """送信スレッドを開始（実行中なら起こすだけ）"""
+    state = get_supabase_write_worker_state()
+    with state["lock"]:
+        thread = state["thread"]
+        if thread is not None and thread.is_alive():
+            state["wake"].set()
+            return
+        thread = threading.Thread(target=run_supabase_write_worker, args=(state,), daemon=True)
+        state["thread"] = thread
+        thread.start()
+
+
+def resume_supabase_writes():
+    """前回のプロセスで送信しきれなかった書き込みの送信を再開（プロセスごとに1回だけ）"""
+    state = get_supabase_write_worker_state()
+    with state["lock"]:
+        if state["resumed"]:
+            return
+        state["resumed"] = True
+    start_supabase_write_worker()
+
+
+# ========================================
+# Google Maps API関連
+# ========================================
+
+def parse_mymap_kml(content):
+    """マイマップのKMLから地点（フォルダ＝レイヤー）を抽出
+
+    iterparse で読み進め、地点を読み終えるたびに要素を破棄する（木全体を保持しない）。
+    名前空間はルート要素から1回だけ求める（名前空間なしのKMLにも対応）。
+    対象はフォルダ直下の地点で、座標は地点内の最初の coordinates の1点目。
+
+    Returns:
+        dict: {"name", "description", "layer": リスト, "lat", "lon": array("d")}（フォルダの出現順）
+    """
+    folders = []  # フォルダの出現順: {"layer": レイヤー名, "rows": [(名前, 説明, 緯度, 経度), ...]}
+    open_folders = []  # 開いているフォルダ: (要素, foldersのインデックス)
+    path = []  # ルートから現在の要素までの要素
+    tags = None
+    placemark = None  # 読み込み中の地点: {"elem", "folder", "name", "description", "coordinates"}
+
+    for event, elem in ET.iterparse(io.BytesIO(content), events=("start", "end")):
+        if event == "start":
+            if tags is None:
+                namespace = elem.tag[:elem.tag.index("}") + 1] if elem.tag.startswith("{") else ""
+                tags = {key: namespace + key for key in ("Folder", "Placemark", "name", "description", "coordinates")}
+            parent = path[-1] if path else None
+            path.append(elem)
+            if elem.tag == tags["Folder"]:
+                open_folders.append((elem, len(folders)))
+                folders.append({"rows": []})
+            elif elem.tag == tags["Placemark"] and open_folders and parent is open_folders[-1][0]:
+                placemark = {"elem": elem, "folder": open_folders[-1][1]}
+            continue
+
+        path.pop()
+        parent = path[-1] if path else None
+        tag = elem.tag
+
+        if placemark is not None:
+            if tag == tags["coordinates"]:
+                placemark.setdefault("coordinates", elem.text)
+            elif parent is placemark["elem"] and tag in (tags["name"], tags["description"]):
+                placemark.setdefault("name" if tag == tags["name"] else "description", elem.text)
+            elif elem is placemark["elem"]:
+                coord_text = placemark.get("coordinates")
+                if coord_text:
+                    parts = coord_text.strip().split(',')
+                    if len(parts) >= 2:
+                        try:
+                            lon = float(parts[0].strip())
+                            lat = float(parts[1].strip())
+                            folders[placemark["folder"]]["rows"].append(
+                                (placemark.get("name", ""), placemark.get("description", ""), lat, lon)
+                            )
+                        except ValueError:
+                            pass
+                placemark = None
+                # 読み終えた地点は破棄（説明文のHTMLが長くてもメモリに溜めない）
+                elem.clear()
+                parent.remove(elem)
+        elif tag == tags["name"] and open_folders and parent is open_folders[-1][0]:
+            folders[open_folders[-1][1]].setdefault("layer", elem.text)
+        elif tag == tags["Folder"]:
+            open_folders.pop()
+            elem.clear()
+
+    columns = {"name": [], "description": [], "layer": [], "lat": array("d"), "lon": array("d")}
+    for folder in folders:
+        for name, description, lat, lon in folder["rows"]:
+            columns["name"].append(name)
+            columns["description"].append(description)
+            columns["layer"].append(folder.get("layer", ""))
+            columns["lat"].append(lat)
+            columns["lon"].append(lon)
+    return columns
+
+
+def fetch_data_from_mymap(map_id):
+    """GoogleマイマップからKMLデータを取得
+
+    保存済みの地点があればそれを返し（古ければ裏で更新確認、次回のrerunで反映）、
+    初回のみKMLの取得を待つ。
+
+    Returns:
+        (データフレーム, KML本文のハッシュ, エラー)
+        ハッシュは保存済みデータを返した場合のみ（前処理のメモ化キーに使う）
+    """
+    placemarks, source = load_stored_mymap(map_id)
+    content_hash = source["content_hash"] if source else None
+    if placemarks is None:
+        placemarks, _, error = refresh_mymap_store(map_id)
+        if error:
+            return None, None, error
+    elif time.time() - source["checked_at"] >= MYMAP_REFRESH_SECONDS:
+        start_mymap_background_refresh(map_id)
+
+    if not placemarks["name"]:
+        return None, None, "KMLからデータを抽出できませんでした"
+
+    return pd.DataFrame({
+        "name": placemarks["name"],
+        "description": placemarks["description"],
+        "layer": placemarks["layer"],
+        # array("d") はコピーせずに float64 の列にする
+        "lat": np.frombuffer(placemarks["lat"], dtype=np.float64),
+        "lon": np.frombuffer(placemarks["lon"], dtype=np.float64),
+    }), content_hash, None
+
+
+def get_travel_time_bias(bias_mode="auto"):
+    """移動時間バイアスを取得
+
+    Args:
+        bias_mode: "auto"=現在の月で判定、"normal"=通常、"winter"=冬季
+    """
+    if bias_mode == "winter":
+        return TRAVEL_TIME_BIAS_WINTER
+    if bias_mode == "normal":
+        return TRAVEL_TIME_BIAS_BASE
+
+    current_month = datetime.now().month
+
+    if current_month in WINTER_MONTHS:
+        return TRAVEL_TIME_BIAS_WINTER  # 冬季: +50%
+    else:
+        return TRAVEL_TIME_BIAS_BASE  # 通常: +10%
+
+
+def apply_travel_time_bias(raw_time_matrix, bias):
+    """バイアス適用前の移動時間行列にバイアスを一括適用
+
+    APIの所要時間はバイアス適用前の値で保持し、最適化・タイムテーブル作成の直前に
+    この関数で換算する（季節を切り替えても行列の再取得は不要）。
+    到達不能（UNREACHABLE_VALUE）の区間はそのまま残す。
+
+    Returns:
+        TravelMatrix: バイアス適用後の移動時間行列（秒）
+    """
+    raw_matrix = as_travel_matrix(raw_time_matrix)
+    raw = raw_matrix.values
+    biased = np.where(raw >= UNREACHABLE_VALUE, raw, (raw * bias).astype(np.int32))
+    return TravelMatrix(biased, raw_matrix.keys)
+
+
+def schedule_matrix_locations(visit_df):
+    """行列の地点座標（O2本社・社長宅＋訪問先の順）を返す（座標がない訪問先は None）"""
+    locations = [
+        (O2_HONSHA["lat"], O2_HONSHA["lon"]),  # index 0: O2本社
+        (SHACHO_HOME["lat"], SHACHO_HOME["lon"]),  # index 1: 社長宅
+    ]
+    for _, row in visit_df.iterrows():
+        lat = row.get("lat") or row.get("latitude") or row.get("緯度")
+        lng = row.get("lng") or row.get("lon") or row.get("longitude") or row.get("経度")
+        if lat and lng:
+            locations.append((float(lat), float(lng)))
+        else:
+            locations.append(None)
+    return locations
+
+
+def make_matrix_fingerprint(keys):
+    """行列の地点キーの並びからフィンガープリントを作成（保存した行列と訪問先の対応確認用）"""
+    return hashlib.sha256("|".join(keys).encode("utf-8")).hexdigest()
+
+
+def pack_travel_matrices(time_matrix_raw, dist_matrix):
+    """移動時間行列（バイアス適用前）と距離行列をスケジュール保存用に圧縮
+
+    2つの行列を int32（リトルエンディアン）で連結して zlib 圧縮し、base64 文字列にする。
+    地点キーの並びのフィンガープリントを付け、読み込み時に訪問先と一致するか確認する。
+
+    Returns:
+        dict: {"version", "size", "fingerprint", "data"}（JSONBにそのまま保存できる形式）
+        地点キーを持たない行列（入れ子リストから作った行列など）は None（保存しない）
+    """
+    time_matrix_raw = as_travel_matrix(time_matrix_raw)
+    dist_matrix = as_travel_matrix(dist_matrix)
+    # 行番号だけのキーでは読み込み時に訪問先の座標と照合できない
+    if not all(isinstance(key, str) for key in time_matrix_raw.keys):
+        return None
+    payload = (time_matrix_raw.values.astype("<i4").tobytes()
+               + dist_matrix.values.astype("<i4").tobytes())
+    return {
+        "version": SCHEDULE_MATRIX_FORMAT_VERSION,
+        "size": len(time_matrix_raw),
+        "fingerprint": make_matrix_fingerprint(time_matrix_raw.keys),
+        "data": base64.b64encode(zlib.compress(payload, 6)).decode("ascii"),
+    }
+
+
+def unpack_travel_matrices(packed, locations):
+    """保存した行列を復元（形式・地点数・フィンガープリントが一致しない場合は (None, None)）
+
+    Args:
+        packed: pack_travel_matrices の結果
+        locations: 現在の訪問先から求めた行列の地点座標（schedule_matrix_locations）
+
+    Returns:
+        (移動時間行列（バイアス適用前）, 距離行列)
+    """
+    if not packed or packed.get("version") != SCHEDULE_MATRIX_FORMAT_VERSION:
+        return None, None
+    if any(location is None for location in locations):
+        return None, None
+
+    keys = [make_location_key(lat, lon) for lat, lon in locations]
+    size = len(keys)
+    if packed.get("size") != size or packed.get("fingerprint") != make_matrix_fingerprint(keys):
+        return None, None
+
+    try:
+        values = np.frombuffer(zlib.decompress(base64.b64decode(packed["data"])), dtype="<i4")
+    except (ValueError, TypeError, zlib.error):
+        return None, None
+    if values.size != 2 * size * size:
+        return None, None
+
+    values = values.reshape(2, size, size)
+    return TravelMatrix(values[0], keys), TravelMatrix(values[1], keys)
+
+
+class TokenBucket:
+    """トークンバケット方式のレート制限（スレッドセーフ）
+
+    OVER_QUERY_LIMIT を受けたら slow_down() でレートを半減し、
+    成功のたびに speed_up() で元のレートまで少しずつ戻す。
+    """
+
+    def __init__(self, rate, capacity=None, min_rate=None):
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.min_rate = float(min_rate) if min_rate else self.max_rate / 16
+        self.capacity = float(capacity) if capacity else self.max_rate
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, amount=1):
+        """トークンを amount 個取得できるまで待機"""
+        amount = min(float(amount), self.capacity)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait_seconds = (amount - self.tokens) / self.rate
+            time.sleep(wait_seconds)
+
+    def slow_down(self):
+        """レートを半減（下限あり）"""
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+
+    def speed_up(self):
+        """レートを1割ずつ元に戻す"""
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate * 1.1)
+
+
+def fetch_distance_matrix_chunk(gmaps, origins, destinations, mode, rate_limiter):
+    """Distance Matrix APIを1回呼び出す（OVER_QUERY_LIMIT はジッター付き指数バックオフでリトライ）
+
+    Returns:
+        dict: APIのレスポンス
+    """
+    for attempt in range(DISTANCE_MATRIX_MAX_RETRIES + 1):
+        rate_limiter.acquire(len(origins) * len(destinations))
+        try:
+            result = gmaps.distance_matrix(
+                origins=origins,
+                destinations=destinations,
+                mode=mode,
+                language="ja"
+            )
+            status = result["status"]
+        except googlemaps.exceptions.ApiError as e:
+            if e.status != "OVER_QUERY_LIMIT":
+                raise
+            status = e.status
+
+        if status != "OVER_QUERY_LIMIT":
+            if status != "OK":
+                raise Exception(f"Distance Matrix API エラー: {status}")
+            rate_limiter.speed_up()
+            return result
+
+        if attempt < DISTANCE_MATRIX_MAX_RETRIES:
+            rate_limiter.slow_down()
+            backoff = DISTANCE_MATRIX_BACKOFF_SECONDS * (2 ** attempt)
+            time.sleep(backoff * (0.5 + random.random()))
+
+    raise Exception("Distance Matrix API エラー: OVER_QUERY_LIMIT（リトライ上限）")
+
+
+def lookup_cached_travel_cells(location_keys, pairs, mode="driving"):
+    """キャッシュから指定区間の移動時間・距離を取得（ローカル → 共有の順に参照）
+
+    Args:
+        location_keys: 検索対象の地点キーのリスト
+        pairs: 必要な(出発地キー, 目的地キー)の集合
+
+    Returns:
+        dict: {(出発地キー, 目的地キー): (所要時間秒, 距離メートル)}（見つかった区間のみ）
+    """
+    cells = {pair: value for pair, value in load_cached_travel_times(location_keys, mode).items()
+             if pair in pairs}
+    missing_pairs = pairs - set(cells)
+
+    if missing_pairs:
+        remote_cells = load_remote_travel_times(location_keys, mode)
+        remote_cells = {pair: value for pair, value in remote_cells.items() if pair in missing_pairs}
+        if remote_cells:
+            cells.update(remote_cells)
+            save_cached_travel_times(remote_cells, mode)
+
+    return cells
+
+
+def collect_distance_matrix_cells(origin_keys, dest_keys, result):
+    """Distance Matrix APIの結果をキャッシュに保存する区間のdictに変換
+
+    経路が見つからない区間（DISTANCE_MATRIX_UNREACHABLE_STATUSES）も UNREACHABLE_VALUE として含め、
+    次回以降の計算で同じ区間を再取得しないようにする。
+
+    Returns:
+        dict: {(出発地キー, 目的地キー): (所要時間秒, 距離メートル)}
+    """
+    cells = {}
+    for origin_key, row in zip(origin_keys, result["rows"]):
+        for dest_key, element in zip(dest_keys, row["elements"]):
+            if element["status"] == "OK":
+                cells[(origin_key, dest_key)] = (
+                    element["duration"]["value"],
+                    element["distance"]["value"]
+                )
+            elif element["status"] in DISTANCE_MATRIX_UNREACHABLE_STATUSES:
+                cells[(origin_key, dest_key)] = (UNREACHABLE_VALUE, UNREACHABLE_VALUE)
+    return cells
+
+
+def fetch_travel_cells(missing_pairs, coords_by_key, api_key, mode="driving", progress_callback=None):
+    """未取得の区間だけをDistance Matrix APIで並列取得し、キャッシュに保存
+
+    Args:
+        missing_pairs: 取得する(出発地キー, 目的地キー)の集合
+        coords_by_key: 地点キー → (緯度, 経度)
+        api_key: Google Maps APIキー
+        mode: 移動手段
+        progress_callback: 進捗表示用コールバック（progress, message）
+
+    Returns:
+        dict: {(出発地キー, 目的地キー): (所要時間秒, 距離メートル)}（経路がない区間は UNREACHABLE_VALUE）
+    """
+    requests_plan = plan_distance_matrix_requests(missing_pairs)
+    total_requests = len(requests_plan)
+    fetched_cells = {}
+
+    if progress_callback and total_requests == 0:
+        progress_callback(1.0, "距離行列をキャッシュから取得しました")
+
+    try:
+        if total_requests > 0:
+            workers = min(DISTANCE_MATRIX_MAX_WORKERS, total_requests)
+            # OVER_QUERY_LIMIT のリトライは fetch_distance_matrix_chunk 側で制御
+            gmaps = get_gmaps_client(api_key, retry_over_query_limit=False)
+            rate_limiter = TokenBucket(DISTANCE_MATRIX_ELEMENTS_PER_SECOND)
+
+            # 複数チャンクを並列取得（進捗表示はメインスレッドで完了順に更新）
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = {
+                    executor.submit(
+                        fetch_distance_matrix_chunk,
+                        gmaps,
+                        [coords_by_key[k] for k in origin_keys],
+                        [coords_by_key[k] for k in dest_keys],
+                        mode,
+                        rate_limiter
+                    ): (origin_keys, dest_keys)
+                    for origin_keys, dest_keys in requests_plan
+                }
+                collected = set()
+                try:
+                    for current_request, future in enumerate(as_completed(futures), start=1):
+                        origin_keys, dest_keys = futures[future]
+                        fetched_cells.update(collect_distance_matrix_cells(origin_keys, dest_keys, future.result()))
+                        collected.add(future)
+
+                        if progress_callback:
+                            progress = current_request / total_requests
+                            progress_callback(progress, f"距離行列取得中... ({current_request}/{total_requests})")
+                except Exception:
+                    # 1件でも失敗したら未送信のリクエストは取り消す
+                    for future in futures:
+                        future.cancel()
+                    # 送信済みのリクエストは完了を待ち、成功した分はキャッシュに残す（課金済みのため）
+                    wait([future for future in futures if not future.cancelled()])
+                    for future, (origin_keys, dest_keys) in futures.items():
+                        if future in collected or future.cancelled() or future.exception() is not None:
+                            continue
+                        try:
+                            fetched_cells.update(collect_distance_matrix_cells(origin_keys, dest_keys, future.result()))
+                        except (KeyError, TypeError):
+                            continue
+                    raise
+    finally:
+        # 途中でエラーになっても取得済みの区間はキャッシュに残す
+        if fetched_cells:
+            save_cached_travel_times(fetched_cells, mode)
+            save_remote_travel_times(fetched_cells, mode)
+
+    return fetched_cells
+
+
+def create_distance_matrix_google_batched(locations_tuple, api_key, progress_callback=None, mode="driving"):
+    """Google Maps Distance Matrix APIで所要時間行列と距離行列を作成
+
+    ローカルキャッシュ（SQLite）→ 共有キャッシュ（Supabase）→ API の順に参照し、
+    キャッシュにない区間だけをAPIで取得する。
+    移動時間はバイアス適用前の値を返す（適用は apply_travel_time_bias で行う）。
+
+    Returns:
+        time_matrix: 移動時間行列（TravelMatrix・秒・バイアス適用前）
+        dist_matrix: 距離行列（TravelMatrix・メートル）
+        error: エラーメッセージ（成功時はNone）
+    """
+    try:
+        locations = list(locations_tuple)
+
+        # 座標を丸めたキーで管理（同一座標は1地点として扱う）
+        keys = [make_location_key(lat, lon) for lat, lon in locations]
+        coords_by_key = {}
+        for key, location in zip(keys, locations):
+            coords_by_key.setdefault(key, location)
+        unique_keys = list(coords_by_key.keys())
+
+        # キャッシュから取得し、未取得の区間だけAPIで取得
+        all_pairs = {(o, d) for o in unique_keys for d in unique_keys if o != d}
+        cells = lookup_cached_travel_cells(unique_keys, all_pairs, mode)
+        cells.update(fetch_travel_cells(
+            all_pairs - set(cells), coords_by_key, api_key, mode, progress_callback
+        ))
+
+        # 重複のない地点で行列を作り、ファンシーインデックスで全地点に展開
+        key_index = {key: i for i, key in enumerate(unique_keys)}
+        unique_count = len(unique_keys)
+        unique_time = np.full((unique_count, unique_count), UNREACHABLE_VALUE, dtype=np.int32)
+        unique_dist = np.full((unique_count, unique_count), UNREACHABLE_VALUE, dtype=np.int32)
+        np.fill_diagonal(unique_time, 0)
+        np.fill_diagonal(unique_dist, 0)
+        for (origin_key, dest_key), (duration, distance) in cells.items():
+            i, j = key_index[origin_key], key_index[dest_key]
+            if i != j:
+                # 移動時間（秒・バイアス適用前）、距離（メートル）
+                unique_time[i, j] = duration
+                unique_dist[i, j] = distance
+
+        rows = np.array([key_index[key] for key in keys], dtype=np.intp)
+        time_matrix = TravelMatrix(unique_time[np.ix_(rows, rows)], keys)
+        dist_matrix = TravelMatrix(unique_dist[np.ix_(rows, rows)], keys)
+
+        return time_matrix, dist_matrix, None
+
+    except Exception as e:
+        return None, None, f"エラー: {str(e)}"
+
+
+def extend_distance_matrix(time_matrix, dist_matrix, locations_tuple, new_location, api_key, mode="driving"):
+    """既存の行列に1地点を追加（新地点との往復 2N 区間だけをキャッシュ／APIから取得）
+
+    Args:
+        time_matrix: 既存の移動時間行列（バイアス適用前）
+        dist_matrix: 既存の距離行列
+        locations_tuple: 既存の行列の地点座標（行列と同じ並び）
+        new_location: 追加する地点の(緯度, 経度)
+
+    Returns:
+        time_matrix: 末尾に新地点を加えた移動時間行列（TravelMatrix・バイアス適用前）
+        dist_matrix: 末尾に新地点を加えた距離行列（TravelMatrix）
+        error: エラーメッセージ（成功時はNone）
+    """
+    try:
+        locations = list(locations_tuple)
+        new_location = tuple(new_location)
+        keys = [make_location_key(lat, lon) for lat, lon in locations]
+        new_key = make_location_key(*new_location)
+
+        coords_by_key = {new_key: new_location}
+        for key, location in zip(keys, locations):
+            coords_by_key.setdefault(key, location)
+        other_keys = [key for key in coords_by_key if key != new_key]
+
+        needed_pairs = {(new_key, key) for key in other_keys} | {(key, new_key) for key in other_keys}
+        cells = lookup_cached_travel_cells(list(coords_by_key), needed_pairs, mode)
+        cells.update(fetch_travel_cells(needed_pairs - set(cells), coords_by_key, api_key, mode))
+
+        n = len(locations)
+        extended = []
+        for matrix, value_index in ((as_travel_matrix(time_matrix), 0), (as_travel_matrix(dist_matrix), 1)):
+            values = np.full((n + 1, n + 1), UNREACHABLE_VALUE, dtype=np.int32)
+            values[:n, :n] = matrix.values
+            values[n, n] = 0
+            for i, key in enumerate(keys):
+                if key == new_key:
+                    values[i, n] = values[n, i] = 0
+                    continue
+                if (key, new_key) in cells:
+                    values[i, n] = cells[(key, new_key)][value_index]
+                if (new_key, key) in cells:
+                    values[n, i] = cells[(new_key, key)][value_index]
+            extended.append(TravelMatrix(values, keys + [new_key]))
+
+        return extended[0], extended[1], None
+
+    except Exception as e:
+        return None, None, f"エラー: {str(e)}"
+
+
+def make_day_route_stops(visit_indices, visit_df):
+    """1日の行程の地点を順に並べる（O2本社→社長宅→訪問先...→社長宅→O2本社）
+
+    座標は移動時間キャッシュと同じ桁数で丸める（キャッシュのキーを安定させるため）。
+
+    Returns:
+        tuple: ((緯度, 経度), ...)
+    """
+    digits = TRAVEL_CACHE_COORD_DECIMALS
+    o2 = (round(O2_HONSHA["lat"], digits), round(O2_HONSHA["lon"], digits))
+    shacho = (round(SHACHO_HOME["lat"], digits), round(SHACHO_HOME["lon"], digits))
+    lats = visit_df["lat"].to_numpy()
+    lons = visit_df["lon"].to_numpy()
+    visits = tuple((round(float(lats[idx]), digits), round(float(lons[idx]), digits)) for idx in visit_indices)
+    return (o2, shacho) + visits + (shacho, o2)
+
+
+@st.cache_data(max_entries=200)
+def get_day_route_polyline(stops, api_key):
+    """Google Directions APIで1日の行程（経由地つき）のポリラインを取得
+
+    地点を順番どおりの経由地として送り、経由地の上限を超える場合は
+    前のリクエストの目的地を次の出発地にして分割する。
+    取得した形状はローカルキャッシュ（SQLite）にも保存し、再起動後や他のセッションでも使い回す。
+
+    Args:
+        stops: 訪問順の地点 ((緯度, 経度), ...)（make_day_route_stops）
+        api_key: Google Maps APIキー
+
+    Returns:
+        (座標のリスト, エラー)
+    """
+    if len(stops) < 2:
+        return None, "地点が足りません"
+
+    route_key = make_route_geometry_key(stops)
+    cached = load_cached_route_geometry(route_key)
+    if cached:
+        return cached, None
+
+    points = []
+    try:
+        gmaps = get_gmaps_client(api_key)
+        chunk = DIRECTIONS_MAX_WAYPOINTS + 1
+        for start in range(0, len(stops) - 1, chunk):
+            end = min(start + chunk, len(stops) - 1)
+            result = gmaps.directions(
+                origin=stops[start],
+                destination=stops[end],
+                waypoints=list(stops[start + 1:end]) or None,
+                mode="driving"
+            )
+            if not result:
+                return None, "ルートが見つかりません"
+            decoded = polyline.decode(result[0]["overview_polyline"]["points"])
+            # 分割したルートのつなぎ目の重複点を除く
+            points.extend(decoded[1:] if points else decoded)
+    except Exception as e:
+        return None, f"Directions API エラー: {str(e)}"
+
+    save_cached_route_geometry(route_key, points)
+    return points, None
+
+
+def geocode_address(address, api_key):
+    """Google Geocoding APIで住所から緯度経度を取得"""
+    try:
+        gmaps = get_gmaps_client(api_key)
+        result = gmaps.geocode(address, language="ja")
+
+        if result and len(result) > 0:
+            location = result[0]["geometry"]["location"]
+            formatted_address = result[0].get("formatted_address", address)
+            return {
+                "lat": location["lat"],
+                "lon": location["lng"],
+                "formatted_address": formatted_address
+            }, None
+        else:
+            return None, "住所が見つかりませんでした"
+    except Exception as e:
+        return None, str(e)
+
+
+def make_manual_visit_row(visit, name_col):
+    """手動追加の訪問先を selected_df と同じ形式の1行のデータフレームに変換"""
+    return pd.DataFrame([{
+        name_col if name_col else "name": visit["name"],
+        "lat": visit["lat"],
+        "lon": visit["lon"],
+        "layer": "手動追加",
+        "layer_normalized": "手動追加",
+        "description": f"手動追加（{visit['stay_minutes']}分）",
+        "manual_stay_minutes": visit["stay_minutes"]
+    }])
+
+
+GEOHASH_BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+
+def encode_geohash(lat, lon, precision=RESTAURANT_CACHE_GEOHASH_PRECISION):
+    """座標をジオハッシュ（セルID）に変換"""
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    bit_count = 0
+    use_lon = True
+    while len(chars) < precision:
+        value, value_range = (lon, lon_range) if use_lon else (lat, lat_range)
+        mid = (value_range[0] + value_range[1]) / 2
+        bits <<= 1
+        if value >= mid:
+            bits |= 1
+            value_range[0] = mid
+        else:
+            value_range[1] = mid
+        use_lon = not use_lon
+        bit_count += 1
+        if bit_count == 5:
+            chars.append(GEOHASH_BASE32[bits])
+            bits = 0
+            bit_count = 0
+    return "".join(chars)
+
+
+def decode_geohash_center(cell):
+    """ジオハッシュのセル中心の座標を返す"""
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    use_lon = True
+    for char in cell:
+        bits = GEOHASH_BASE32.index(char)
+        for shift in range(4, -1, -1):
+            value_range = lon_range if use_lon else lat_range
+            mid = (value_range[0] + value_range[1]) / 2
+            if (bits >> shift) & 1:
+                value_range[0] = mid
+            else:
+                value_range[1] = mid
+            use_lon = not use_lon
+    return (lat_range[0] + lat_range[1]) / 2, (lon_range[0] + lon_range[1]) / 2
+
+
+def load_cached_restaurants(cells):
+    """ローカルキャッシュからセルごとのレストラン検索結果を取得（期限切れは除く）
+
+    Returns:
+        dict: {セルID: レストランのリスト}
+    """
+    cells = list(cells)
+    if not cells:
+        return {}
+
+    cutoff = time.time() - RESTAURANT_CACHE_TTL_DAYS * 86400
+    found = {}
+    try:
+        conn = open_local_cache_db()
+        try:
+            for start in range(0, len(cells), 500):
+                chunk = cells[start:start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = conn.execute(
+                    f"SELECT cell, restaurants FROM restaurant_cache "
+                    f"WHERE cell IN ({placeholders}) AND fetched_at >= ?",
+                    (*chunk, cutoff)
+                ).fetchall()
+                for cell, restaurants in rows:
+                    found[cell] = json.loads(restaurants)
+        finally:
+            conn.close()
+    except (sqlite3.Error, ValueError):
+        return {}
+    return found
+
+
+def save_cached_restaurants(restaurants_by_cell):
+    """セルごとのレストラン検索結果をローカルキャッシュに保存（期限切れも削除）"""
+    if not restaurants_by_cell:
+        return
+
+    now = time.time()
+    try:
+        conn = open_local_cache_db()
+        try:
+            conn.executemany(
+                "INSERT OR REPLACE INTO restaurant_cache (cell, restaurants, fetched_at) VALUES (?, ?, ?)",
+                [(cell, json.dumps(restaurants, ensure_ascii=False), now)
+                 for cell, restaurants in restaurants_by_cell.items()]
+            )
+            # TTL: 期限切れを削除
+            conn.execute("DELETE FROM restaurant_cache WHERE fetched_at < ?",
+                         (now - RESTAURANT_CACHE_TTL_DAYS * 86400,))
+            conn.commit()
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        pass
+
+
+def find_nearby_restaurant(gmaps, lat, lon):
+    """Google Places APIで近くのレストランを検索（評価順に最大3件）"""
+    try:
+        result = gmaps.places_nearby(
+            location=(lat, lon),
+            radius=RESTAURANT_SEARCH_RADIUS_METERS,
+            type="restaurant",
+            language="ja"
+        )
+
+        if result and "results" in result and len(result["results"]) > 0:
+            restaurants = [r for r in result["results"]
+                          if "convenience_store" not in r.get("types", [])]
+            restaurants = sorted(restaurants, key=lambda x: x.get("rating", 0), reverse=True)
+
+            top_restaurants = []
+            for r in restaurants[:3]:
+                top_restaurants.append({
+                    "name": r.get("name", "不明"),
+                    "address": r.get("vicinity", ""),
+                    "rating": r.get("rating", 0),
+                    "lat": r["geometry"]["location"]["lat"],
+                    "lon": r["geometry"]["location"]["lng"]
+                })
+            return top_restaurants, None
+        else:
+            return [], "近くにレストランが見つかりませんでした"
+
+    except Exception as e:
+        return [], f"Places API エラー: {str(e)}"
+
+
+def prefetch_nearby_restaurants(points, api_key):
+    """昼食候補地点の近くのレストランをまとめて取得
+
+    地点はジオハッシュのセル単位にまとめ、キャッシュにないセルだけを
+    セル中心からの検索で並列に取得する（近い訪問先同士は結果を共有）。
+
+    Args:
+        points: (緯度, 経度) のリスト
+        api_key: Google Maps APIキー
+
+    Returns:
+        dict: {セルID: レストランのリスト}（APIエラーのセルは含まない）
+    """
+    cells = {encode_geohash(lat, lon) for lat, lon in points}
+    restaurants_by_cell = load_cached_restaurants(cells)
+    missing_cells = sorted(cells - restaurants_by_cell.keys())
+    if not missing_cells or not api_key:
+        return restaurants_by_cell
+
+    try:
+        gmaps = get_gmaps_client(api_key)
+    except ValueError:
+        # APIキーの形式が不正な場合は取得済みの結果だけを返す
+        return restaurants_by_cell
+    fetched = {}
+    with ThreadPoolExecutor(max_workers=min(PLACES_MAX_WORKERS, len(missing_cells))) as executor:
+        futures = {
+            executor.submit(find_nearby_restaurant, gmaps, *decode_geohash_center(cell)): cell
+            for cell in missing_cells
+        }
+        for future in as_completed(futures):
+            restaurants, error = future.result()
+            # 見つからなかった結果はキャッシュし、APIエラーは次回再取得する
+            if error is None or not error.startswith("Places API エラー"):
+                fetched[futures[future]] = restaurants
+
+    save_cached_restaurants(fetched)
+    restaurants_by_cell.update(fetched)
+    return restaurants_by_cell
+
+
+def lookup_nearby_restaurants(restaurants_by_cell, lat, lon):
+    """取得済みの検索結果から地点のセルのレストランを返す（APIは呼ばない）"""
+    if not restaurants_by_cell:
+        return []
+    return restaurants_by_cell.get(encode_geohash(lat, lon), [])
+
+
+# ========================================
+# 訪問先属性テーブル
+# ========================================
+
+class SiteTable:
+    """訪問先ごとの属性を事前計算した表（struct-of-arrays、インデックスはvisit_dfの行番号）
+
+    selected_df の確定時に1回だけ作り、最適化・タイムテーブル作成では
+    iloc や名前の文字列判定の代わりに整数インデックスで参照する。
+    """
+
+    __slots__ = (
+        "names", "layers", "lats", "lons", "stay_minutes", "base_names", "base_ids",
+        "is_office", "is_genba", "is_kitaeroom", "is_o2_task", "is_fujisawa", "can_meet",
+    )
+
+    def __len__(self):
+        return len(self.names)
+
+    def same_location(self, idx1, idx2):
+        """2つの訪問先が同じ場所（事務所と現場のペア）かどうか（is_same_location と同じ判定）"""
+        return self.base_names[idx1] == self.base_names[idx2] and self.base_names[idx1] != ""
+
+
+def build_site_table(visit_df, name_col):
+    """訪問先データフレームから SiteTable を作成
+
+    滞在時間は説明文（手動追加の滞在時間）も考慮して求める。
+    """
+    count = len(visit_df)
+    if name_col:
+        names = visit_df[name_col].tolist()
+    else:
+        names = [f"訪問先{idx + 1}" for idx in range(count)]
+    layers = visit_df["layer"].tolist() if "layer" in visit_df.columns else [None] * count
+    descriptions = visit_df["description"].tolist() if "description" in visit_df.columns else [None] * count
+
+    table = SiteTable()
+    table.names = names
+    table.layers = layers
+    table.lats = visit_df["lat"].tolist() if "lat" in visit_df.columns else [None] * count
+    table.lons = visit_df["lon"].tolist() if "lon" in visit_df.columns else [None] * count
+    table.stay_minutes = [
+        get_stay_duration(name, layer, description)
+        for name, layer, description in zip(names, layers, descriptions)
+    ]
+    table.base_names = [get_base_location_name(name) for name in names]
+    base_id_of = {}
+    table.base_ids = [base_id_of.setdefault(base_name, len(base_id_of)) for base_name in table.base_names]
+    table.is_office = [is_office_location(name) for name in names]
+    table.is_genba = [is_genba_only(name) for name in names]
+    table.is_kitaeroom = [is_kitaeroom(name) for name in names]
+    table.is_o2_task = [is_o2_honsha_task(name) for name in names]
+    table.is_fujisawa = [is_fujisawa_souko(name) for name in names]
+    table.can_meet = [can_have_meeting(name, layer) for name, layer in zip(names, layers)]
+    return table
+
+
+# ========================================
+# 行程シミュレーション（整数秒）
+# ========================================
+
+def parse_clock_seconds(clock_text):
+    """「HH:MM」形式の時刻を0時からの経過秒に変換"""
+    hour, minute = clock_text.split(":")
+    return int(hour) * 3600 + int(minute) * 60
+
+
+def seconds_to_datetime(seconds):
+    """0時からの経過秒を今日の日付のdatetimeに変換"""
+    return datetime.combine(datetime.today(), datetime.min.time()) + timedelta(seconds=int(seconds))
+
+
+class DayScheduleSimulator:
+    """1日の行程を0時からの経過秒（整数）でシミュレーション
+
+    行列・滞在時間・固定の時刻を事前に展開しておき、候補ルートを1パスで評価する。
+    （Time Slicing・きたえるーむの配置日選び・Gap Filling・タイムテーブルの出発時刻調整で共用）
+
+    行程: O2本社 →（社長宅ピックアップ）→ 訪問先... →（社長宅送り届け）→ O2本社
+    - 最初の訪問先への到着は DEPARTURE_MIN_TIME 出発で計算し、FIRST_VISIT_MIN_ARRIVAL_TIME より早ければ繰り下げ
+    - 最初の訪問先では打ち合わせ（MEETING_DURATION）を行う
+    """
+
+    __slots__ = (
+        "travel", "stay", "kitaeroom", "shacho_idx",
+        "leave_for_first", "return_to_o2", "min_first_arrival",
+        "lunch_start", "lunch_duration", "meeting", "kitaeroom_time",
+    )
+
+    def __init__(self, time_matrix_all, site_table, o2_idx=0, shacho_idx=1):
+        """
+        Args:
+            time_matrix_all: 全地点の移動時間行列（O2, 社長宅, 訪問先...）
+            site_table: 訪問先属性テーブル（build_site_table）
+            o2_idx: O2本社のインデックス（通常0）
+            shacho_idx: 社長宅のインデックス（通常1）
+        """
+        self.travel = as_travel_matrix(time_matrix_all).tolist()
+        self.stay = [int(minutes) * 60 for minutes in site_table.stay_minutes]
+        self.kitaeroom = site_table.is_kitaeroom
+        self.shacho_idx = shacho_idx
+
+        shacho_stay = SHACHO_HOME["stay_min"] * 60
+        # 最初の訪問先へは「出発時刻 + O2→社長宅 + 社長宅滞在 + 社長宅→訪問先」で到着
+        self.leave_for_first = (
+            parse_clock_seconds(DEPARTURE_MIN_TIME) + self.travel[o2_idx][shacho_idx] + shacho_stay
+        )
+        # 訪問先を出てから帰社するまで（訪問先→社長宅 + 社長宅滞在 + 社長宅→O2）
+        shacho_to_o2 = self.travel[shacho_idx][o2_idx]
+        self.return_to_o2 = [
+            self.travel[visit_idx + 2][shacho_idx] + shacho_stay + shacho_to_o2
+            for visit_idx in range(len(self.stay))
+        ]
+        self.min_first_arrival = parse_clock_seconds(FIRST_VISIT_MIN_ARRIVAL_TIME)
+        self.lunch_start = LUNCH_START_HOUR * 3600 + LUNCH_START_MINUTE * 60
+        self.lunch_duration = LUNCH_DURATION * 60
+        self.meeting = MEETING_DURATION * 60
+        self.kitaeroom_time = parse_clock_seconds(KITAEROOM_RECOMMENDED_TIME)
+
+    def first_arrival(self, first_visit_idx):
+        """最初の訪問先への到着時刻（秒）"""
+        arrival = self.leave_for_first + self.travel[self.shacho_idx][first_visit_idx + 2]
+        return max(arrival, self.min_first_arrival)
+
+    def simulate(self, route, lunch=False, kitaeroom_wait=False):
+        """訪問順に到着・出発時刻を計算
+
+        Args:
+            route: 訪問先インデックスのリスト（visit_dfの行番号）
+            lunch: Trueなら出発時刻が昼休み開始以降になった最初の訪問先で昼休みを加算
+            kitaeroom_wait: Trueならきたえるーむに17:00より早く着いた場合は17:00まで待機
+
+        Returns:
+            dict:
+                first_arrival: 最初の訪問先への到着時刻
+                arrivals / departures / waits: 訪問先ごとの到着・出発時刻と待機秒
+                end_times: その訪問先で1日を終えた場合の帰社時刻
+                lunch_index: 昼休みを加算した訪問先の位置（なければ -1）
+            （時刻はすべて0時からの経過秒）
+        """
+        arrivals = []
+        departures = []
+        waits = []
+        end_times = []
+        lunch_index = -1
+
+        if not route:
+            return {"first_arrival": None, "arrivals": arrivals, "departures": departures,
+                    "waits": waits, "end_times": end_times, "lunch_index": lunch_index}
+
+        travel = self.travel
+        first_arrival = self.first_arrival(route[0])
+        departure = first_arrival
+        prev_matrix_idx = None
+
+        for position, visit_idx in enumerate(route):
+            matrix_idx = visit_idx + 2
+            if position == 0:
+                arrival = first_arrival
+                departure = arrival + self.meeting + self.stay[visit_idx]
+            else:
+                arrival = departure + travel[prev_matrix_idx][matrix_idx]
+                departure = arrival + self.stay[visit_idx]
+
+            wait = 0
+            if kitaeroom_wait and self.kitaeroom[visit_idx]:
+                # 到着した日の17:00（日付をまたいだ場合も到着日の17:00）
+                target = arrival - arrival % 86400 + self.kitaeroom_time
+                if arrival < target:
+                    wait = target - arrival
+                    arrival += wait
+                    departure += wait
+
+            if lunch and lunch_index < 0 and departure >= self.lunch_start:
+                departure += self.lunch_duration
+                lunch_index = position
+
+            arrivals.append(arrival)
+            departures.append(departure)
+            waits.append(wait)
+            end_times.append(departure + self.return_to_o2[visit_idx])
+            prev_matrix_idx = matrix_idx
+
+        return {"first_arrival": first_arrival, "arrivals": arrivals, "departures": departures,
+                "waits": waits, "end_times": end_times, "lunch_index": lunch_index}
+
+
+# ========================================
+# VRP最適化
+# ========================================
+
+def plan_solver_budget(num_nodes, budget_mode="adaptive", warm_start=False):
+    """ノード数に応じた探索時間の配分を決める
+
+    - 小規模（TSP_EXACT_MAX_NODES以下）: Held–Karp で厳密解（探索時間の上限なし）
+    - 中規模（TSP_MEDIUM_MAX_NODES以下）: 改善が止まった時点で打ち切り
+      （じっくりモードでは大規模と同じく最大時間まで探索）
+    - 大規模: 最大時間まで探索
+    - 前回の巡回順序から再開する場合（warm_start）: 規模によらず改善が止まった時点で打ち切り
+
+    Returns:
+        {"tier", "time_limit_seconds", "no_improvement_seconds"} の辞書
+    """
+    if num_nodes <= TSP_EXACT_MAX_NODES:
+        return {"tier": "exact", "time_limit_seconds": 0, "no_improvement_seconds": None}
+    if warm_start and budget_mode == "adaptive":
+        return {
+            "tier": "warm",
+            "time_limit_seconds": TSP_TIME_LIMIT_SECONDS,
+            "no_improvement_seconds": TSP_NO_IMPROVEMENT_SECONDS,
+        }
+    if num_nodes <= TSP_MEDIUM_MAX_NODES and budget_mode == "adaptive":
+        return {
+            "tier": "medium",
+            "time_limit_seconds": TSP_MEDIUM_TIME_LIMIT_SECONDS,
+            "no_improvement_seconds": TSP_NO_IMPROVEMENT_SECONDS,
+        }
+    return {"tier": "large", "time_limit_seconds": TSP_TIME_LIMIT_SECONDS, "no_improvement_seconds": None}
+
+
+def solve_vrp_multi_day(time_matrix, num_days, depot_idx=0, stay_times=None,
+                        budget_mode="adaptive", solver_stats=None):
+    """VRPで複数日に分割して最適化
+
+    solver_stats にリストを渡すと、探索の規模・所要時間を追記する。
+    """
+    started_at = time.monotonic()
+    travel = as_travel_matrix(time_matrix).values.astype(np.int64)
+    n = len(travel)
+
+    if n <= 1:
+        return [[]], [0]
+
+    if stay_times is None:
+        stay_times = [DEFAULT_STAY_DURATION * 60] * n
+        stay_times[depot_idx] = 0
+
+    manager = pywrapcp.RoutingIndexManager(n, num_days, depot_idx)
+    routing = pywrapcp.RoutingModel(manager)
+
+    # 移動時間＋到着先の滞在時間（デポへの帰着は滞在なし）を事前に行列化
+    stay_row = np.asarray(stay_times, dtype=np.int64).copy()
+    stay_row[depot_idx] = 0
+    time_plus_stay_matrix = (travel + stay_row[np.newaxis, :]).tolist()
+
+    transit_callback_index = register_transit_matrix(routing, manager, time_plus_stay_matrix)
+    routing.SetArcCostEvaluatorOfAllVehicles(transit_callback_index)
+
+    vehicle_capacities = [MAX_DAILY_WORK_SECONDS] * num_days
+    routing.AddDimensionWithVehicleCapacity(
+        transit_callback_index,
+        0,
+        vehicle_capacities,
+        True,
+        "WorkTime"
+    )
+
+    time_dimension = routing.GetDimensionOrDie("WorkTime")
+    time_dimension.SetGlobalSpanCostCoefficient(100)
+
+    for i in range(num_days):
+        routing.AddVariableMinimizedByFinalizer(
+            time_dimension.CumulVar(routing.End(i))
+        )
+
+    search_parameters = pywrapcp.DefaultRoutingSearchParameters()
+    search_parameters.first_solution_strategy = (
+        routing_enums_pb2.FirstSolutionStrategy.PATH_CHEAPEST_ARC
+    )
+    search_parameters.local_search_metaheuristic = (
+        routing_enums_pb2.LocalSearchMetaheuristic.GUIDED_LOCAL_SEARCH
+    )
+    search_parameters.time_limit.seconds = VRP_TIME_LIMIT_SECONDS
+
+    # 中規模以下は改善が止まった時点で打ち切る
+    # （VRPには厳密解法がないため、TSPで厳密解となる規模も中規模として扱い・記録する）
+    tier = plan_solver_budget(n, budget_mode)["tier"]
+    if tier == "exact":
+        tier = "medium"
+    no_improvement_seconds = VRP_NO_IMPROVEMENT_SECONDS if tier != "large" else None
+    add_search_cutoff_callback(routing, no_improvement_seconds=no_improvement_seconds)
+
+    solution = routing.SolveWithParameters(search_parameters)
+
+    if solver_stats is not None:
+        solver_stats.append({
+            "solver": "vrp",
+            "nodes": n,
+            "tier": tier,
+            "time_limit_seconds": VRP_TIME_LIMIT_SECONDS,
+            "elapsed_seconds": round(time.monotonic() - started_at, 3),
+            "objective": solution.ObjectiveValue() if solution else None,
+        })
+
+    if solution:
+        routes = []
+        route_times = []
+
+        for vehicle_id in range(num_days):
+            route = []
             index = routing.Start(vehicle_id)
             route_time = 0
 
@@ -940,7 +3018,202 @@ def solve_vrp_multi_day(time_matrix, num_days, depot_idx=0, stay_times=None):
         return routes, [0] * num_days
 
 
-def solve_tsp_optimal_order(time_matrix, depot_idx=0, cost_matrix=None):
+def get_tsp_parallel_workers():
+    """TSPの戦略を並列に解けるプロセス数を返す（1なら逐次実行）"""
+    try:
+        cpu_count = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpu_count = os.cpu_count() or 1
+    return max(1, min(TSP_PARALLEL_WORKERS, cpu_count))
+
+
+def get_tsp_process_context():
+    """TSPの子プロセスを起動する multiprocessing のコンテキストを返す
+
+    Streamlitのサーバーはマルチスレッドのため、fork すると他スレッドが持っていたロックを
+    子プロセスが引き継いでデッドロックしうる。forkserver（なければ spawn）で起動する。
+    forkserver では route_solver（OR-Tools）を事前に import しておき、子プロセスの起動を速くする。
+    """
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        ctx = multiprocessing.get_context("forkserver")
+        ctx.set_forkserver_preload(["route_solver"])
+        return ctx
+    return multiprocessing.get_context("spawn")
+
+
+def solve_tsp_strategies_parallel(cost_matrix, depot_idx, strategies, time_limit_seconds,
+                                  no_improvement_seconds=None, initial_route=None, max_workers=None,
+                                  stop_others_on_convergence=TSP_STOP_OTHERS_ON_CONVERGENCE):
+    """複数の探索戦略を子プロセスで並列に解く
+
+    OR-Tools は探索中にGILを解放しないため、スレッドではなくプロセスで並列化する。
+    子プロセスは route_solver.tsp_strategy_worker を実行し、行列などの引数は pickle で渡す
+    （結果はパイプで返す）。同時に動かすのは max_workers 個までで、1つ終わるごとに次の戦略を起動する。
+
+    Args:
+        cost_matrix: コスト行列（入れ子リスト）
+        depot_idx: 出発地点のインデックス
+        strategies: (初期解の戦略名, 局所探索の戦略名) のリスト
+        time_limit_seconds: 戦略ごとの探索時間の上限
+        no_improvement_seconds: この秒数だけ改善がなければ打ち切る（Noneなら時間上限まで探索）
+        initial_route: 各戦略の初期解とする巡回順序（depotを除く、Noneなら初期解から構築）
+        max_workers: 同時に動かすプロセス数（Noneなら全戦略を同時に起動）
+        stop_others_on_convergence: Trueなら最初に終了した戦略の時点で他の探索も打ち切る
+                                    （まだ起動していない戦略は実行しない）
+
+    Returns:
+        終了した戦略の結果リスト（solve_tsp_with_strategy の戻り値、失敗時は None）
+    """
+    ctx = get_tsp_process_context()
+    stop_event = ctx.Event() if stop_others_on_convergence else None
+    max_workers = min(max_workers or len(strategies), len(strategies))
+    # 子プロセスへ pickle で渡すため、NumPyの値を含まない入れ子リストにしておく
+    cost_matrix = [[int(value) for value in row] for row in cost_matrix]
+
+    pending = list(strategies)
+    workers = {}  # 受信側パイプ → (プロセス, 応答の期限)
+    results = []
+    try:
+        while pending or workers:
+            # 空きがあれば次の戦略を起動（他の戦略が収束済みなら起動しない）
+            while pending and len(workers) < max_workers:
+                if stop_event is not None and stop_event.is_set():
+                    break
+                first_strategy, local_search = pending.pop(0)
+                receiver, sender = ctx.Pipe(duplex=False)
+                process = ctx.Process(
+                    target=tsp_strategy_worker,
+                    args=(sender, cost_matrix, depot_idx, first_strategy, local_search,
+                          time_limit_seconds, stop_event, no_improvement_seconds, initial_route),
+                    daemon=True,
+                )
+                process.start()
+                sender.close()
+                deadline = time.monotonic() + time_limit_seconds + TSP_PARALLEL_TIMEOUT_MARGIN_SECONDS
+                workers[receiver] = (process, deadline)
+
+            if not workers:
+                break
+            remaining = min(deadline for _, deadline in workers.values()) - time.monotonic()
+            if remaining <= 0:
+                break
+            for receiver in multiprocessing.connection.wait(list(workers), timeout=remaining):
+                try:
+                    result = receiver.recv()
+                except EOFError:
+                    result = None
+                results.append(result)
+                receiver.close()
+                process, _ = workers.pop(receiver)
+                process.join()
+
+                # 最初に解を返した戦略が収束したら、他の戦略も手持ちの最良解で終了させる
+                if stop_event is not None and result is not None:
+                    stop_event.set()
+        return results
+    finally:
+        # 応答のないワーカーは強制終了
+        for receiver, (process, _) in workers.items():
+            process.terminate()
+            process.join()
+            receiver.close()
+
+
+def solve_tsp_strategies(cost_matrix, depot_idx, strategies, time_limit_seconds,
+                         no_improvement_seconds=None, initial_route=None):
+    """複数の探索戦略でTSPを解く（可能ならプロセス並列、できなければ逐次）
+
+    Returns:
+        戦略ごとの結果リスト（solve_tsp_with_strategy の戻り値、失敗時は None）
+    """
+    workers = get_tsp_parallel_workers()
+    if workers > 1:
+        try:
+            results = solve_tsp_strategies_parallel(
+                cost_matrix, depot_idx, strategies, time_limit_seconds,
+                no_improvement_seconds=no_improvement_seconds, initial_route=initial_route,
+                max_workers=workers,
+            )
+            if any(result is not None for result in results):
+                return results
+        except Exception:
+            pass
+
+    # 並列実行できない環境（CPUが1つ）や失敗時は逐次実行
+    return [
+        solve_tsp_with_strategy(
+            cost_matrix, depot_idx, first_strategy, local_search, time_limit_seconds,
+            no_improvement_seconds=no_improvement_seconds, initial_route=initial_route,
+        )
+        for first_strategy, local_search in strategies
+    ]
+
+
+def solve_tsp_exact(cost_matrix, depot_idx=0):
+    """小規模TSPを Held–Karp（動的計画法）で厳密に解く（depot発・depot着の巡回路）
+
+    dp[集合, j] = depotを出て「集合」の地点をすべて訪れ、最後にjにいるときの最小コスト。
+    集合をビットマスクで表し、小さいマスクから順に1地点ずつ延ばしていく
+    （計算量 O(2^m × m^2)、m = depot以外の地点数）。
+
+    Returns:
+        (総コスト, depotを除く巡回順序)
+    """
+    cost = as_travel_matrix(cost_matrix).values.astype(np.int64)
+    nodes = np.array([i for i in range(len(cost)) if i != depot_idx], dtype=np.int64)
+    m = len(nodes)
+
+    if m == 0:
+        return 0, []
+
+    between = cost[np.ix_(nodes, nodes)]
+    from_depot = cost[depot_idx, nodes]
+    to_depot = cost[nodes, depot_idx]
+
+    num_masks = 1 << m
+    unreached = np.iinfo(np.int64).max // 4
+    bits = 1 << np.arange(m)
+    positions = np.arange(m)
+
+    dp = np.full((num_masks, m), unreached, dtype=np.int64)
+    parent = np.full((num_masks, m), -1, dtype=np.int64)
+    dp[bits, positions] = from_depot
+
+    for mask in range(1, num_masks - 1):
+        # 最後がjの状態から次にkへ進むときの最小コスト（kごとに最良のjを選ぶ）
+        candidates = dp[mask][:, np.newaxis] + between
+        best_last = candidates.argmin(axis=0)
+        best_cost = candidates[best_last, positions]
+
+        next_nodes = positions[((mask & bits) == 0) & (best_cost < unreached)]
+        if len(next_nodes) == 0:
+            continue
+        next_masks = mask | bits[next_nodes]
+        improved = best_cost[next_nodes] < dp[next_masks, next_nodes]
+        next_nodes = next_nodes[improved]
+        next_masks = next_masks[improved]
+        dp[next_masks, next_nodes] = best_cost[next_nodes]
+        parent[next_masks, next_nodes] = best_last[next_nodes]
+
+    # 全地点を訪れてdepotへ戻る
+    totals = dp[num_masks - 1] + to_depot
+    last = int(totals.argmin())
+    total_cost = int(totals[last])
+
+    route = []
+    mask = num_masks - 1
+    while last != -1:
+        route.append(int(nodes[last]))
+        previous = int(parent[mask, last])
+        mask ^= int(bits[last])
+        last = previous
+    route.reverse()
+
+    return total_cost, route
+
+
+def solve_tsp_optimal_order(time_matrix, depot_idx=0, cost_matrix=None,
+                            budget_mode="adaptive", solver_stats=None, initial_route=None):
     """TSPで最適な巡回順序を1本計算
 
     Args:
@@ -949,11 +3222,18 @@ def solve_tsp_optimal_order(time_matrix, depot_idx=0, cost_matrix=None):
         cost_matrix: コスト行列（最適化に使用）。Noneの場合はtime_matrixを使用
                     - 移動時間優先: time_matrixを渡す
                     - 距離優先: dist_matrixを渡す
+        （行列は入れ子リスト・ndarray・TravelMatrix のいずれでも可）
+        budget_mode: 探索時間の配分（SOLVER_BUDGET_MODES のキー）
+        solver_stats: リストを渡すと、探索の規模・所要時間を追記する
+        initial_route: 前回の巡回順序（depotを除く）。全地点を1回ずつ含む場合のみ初期解として使う
     """
+    started_at = time.monotonic()
+
     # cost_matrixが指定されていない場合はtime_matrixを使用
     if cost_matrix is None:
         cost_matrix = time_matrix
 
+    cost_matrix = as_travel_matrix(cost_matrix).tolist()
     n = len(cost_matrix)
 
     if n <= 1:
@@ -962,52 +3242,40 @@ def solve_tsp_optimal_order(time_matrix, depot_idx=0, cost_matrix=None):
     if n == 2:
         return [i for i in range(n) if i != depot_idx]
 
-    manager = pywrapcp.RoutingIndexManager(n, 1, depot_idx)
-    routing = pywrapcp.RoutingModel(manager)
+    if initial_route is not None and sorted(initial_route) != [i for i in range(n) if i != depot_idx]:
+        initial_route = None
 
-    def distance_callback(from_index, to_index):
-        from_node = manager.IndexToNode(from_index)
-        to_node = manager.IndexToNode(to_index)
-        return cost_matrix[from_node][to_node]
+    budget = plan_solver_budget(n, budget_mode, warm_start=bool(initial_route))
 
-    transit_callback_index = routing.RegisterTransitCallback(distance_callback)
-    routing.SetArcCostEvaluatorOfAllVehicles(transit_callback_index)
+    if budget["tier"] == "exact":
+        results = [solve_tsp_exact(cost_matrix, depot_idx)]
+    else:
+        # 複数の戦略で解を求め、最良のものを選択
+        results = solve_tsp_strategies(
+            cost_matrix, depot_idx, TSP_STRATEGIES, budget["time_limit_seconds"],
+            no_improvement_seconds=budget["no_improvement_seconds"],
+            initial_route=initial_route,
+        )
 
-    # 複数の戦略で解を求め、最良のものを選択
     best_route = None
     best_cost = float('inf')
-
-    strategies = [
-        (routing_enums_pb2.FirstSolutionStrategy.PATH_CHEAPEST_ARC,
-         routing_enums_pb2.LocalSearchMetaheuristic.GUIDED_LOCAL_SEARCH),
-        (routing_enums_pb2.FirstSolutionStrategy.CHRISTOFIDES,
-         routing_enums_pb2.LocalSearchMetaheuristic.SIMULATED_ANNEALING),
-        (routing_enums_pb2.FirstSolutionStrategy.SAVINGS,
-         routing_enums_pb2.LocalSearchMetaheuristic.GUIDED_LOCAL_SEARCH),
-    ]
-
-    for first_strategy, local_search in strategies:
-        search_parameters = pywrapcp.DefaultRoutingSearchParameters()
-        search_parameters.first_solution_strategy = first_strategy
-        search_parameters.local_search_metaheuristic = local_search
-        search_parameters.time_limit.seconds = 10
-
-        solution = routing.SolveWithParameters(search_parameters)
-
-        if solution:
-            # 総コストを計算
-            total_cost = solution.ObjectiveValue()
-
-            if total_cost < best_cost:
-                best_cost = total_cost
-                route = []
-                index = routing.Start(0)
-                while not routing.IsEnd(index):
-                    node = manager.IndexToNode(index)
-                    if node != depot_idx:
-                        route.append(node)
-                    index = solution.Value(routing.NextVar(index))
-                best_route = route
+    for result in results:
+        if result is None:
+            continue
+        total_cost, route = result
+        if total_cost < best_cost:
+            best_cost = total_cost
+            best_route = route
+
+    if solver_stats is not None:
+        solver_stats.append({
+            "solver": "tsp",
+            "nodes": n,
+            "tier": budget["tier"],
+            "time_limit_seconds": budget["time_limit_seconds"],
+            "elapsed_seconds": round(time.monotonic() - started_at, 3),
+            "objective": best_cost if best_route else None,
+        })
 
     if best_route:
         return best_route
@@ -1026,7 +3294,11 @@ def global_tsp_time_slice_allocation(
     daily_end_limit_hour=17,
     daily_end_limit_minute=30,
     dist_matrix_all=None,
-    optimize_mode="time"
+    optimize_mode="time",
+    budget_mode="adaptive",
+    solver_stats=None,
+    initial_order=None,
+    site_table=None
 ):
     """
     Global TSP & Time Slicing 方式（燃費重視・円形ルート対応）
@@ -1051,11 +3323,19 @@ def global_tsp_time_slice_allocation(
         daily_end_limit_minute: 1日の終了時刻上限（分）
         dist_matrix_all: 距離行列（距離優先モード用）
         optimize_mode: 最適化モード（"time"=移動時間優先、"distance"=距離優先）
+        budget_mode: TSPの探索時間の配分（SOLVER_BUDGET_MODES のキー）
+        solver_stats: リストを渡すと、TSPの探索規模・所要時間を追記する
+        initial_order: 前回の訪問順序（visit_dfのインデックス、日をまたいで連結したもの）。
+                       指定時はこの順序をTSPの初期解にする（再計算を短時間で収束させる）
+        site_table: 訪問先属性テーブル（Noneの場合はvisit_dfから作成）
 
     Returns:
         day_routes: 各日の訪問先インデックスリスト
     """
+    time_matrix_all = as_travel_matrix(time_matrix_all)
     n_visits = len(visit_df)
+    if site_table is None:
+        site_table = build_site_table(visit_df, name_col)
 
     if n_visits == 0:
         return [[] for _ in range(num_days)]
@@ -1071,28 +3351,25 @@ def global_tsp_time_slice_allocation(
     kitaeroom_indices = []
 
     for idx in range(n_visits):
-        if name_col:
-            point_name = visit_df.iloc[idx][name_col]
-        else:
-            point_name = ""
-
-        if is_kitaeroom(point_name):
+        if not name_col:
+            # 名前がない場合は全地点を1つの場所として扱う
+            base_name = ""
+        elif site_table.is_kitaeroom[idx]:
             kitaeroom_indices.append(idx)
             continue
-
-        base_name = get_base_location_name(point_name)
-        if not base_name:
-            base_name = point_name  # 基本名が取得できない場合はそのまま
+        else:
+            # 基本名が取得できない場合はそのまま
+            base_name = site_table.base_names[idx] or site_table.names[idx]
 
         if base_name not in location_groups:
             location_groups[base_name] = {"offices": [], "genbas": [], "representative_idx": None}
 
-        if is_office_location(point_name):
+        if name_col and site_table.is_office[idx]:
             location_groups[base_name]["offices"].append(idx)
             # 事務所を代表点として優先
             if location_groups[base_name]["representative_idx"] is None:
                 location_groups[base_name]["representative_idx"] = idx
-        elif is_genba_only(point_name):
+        elif name_col and site_table.is_genba[idx]:
             location_groups[base_name]["genbas"].append(idx)
         else:
             # 事務所でも現場でもない場合（O2グループ、発注先など）
@@ -1125,29 +3402,37 @@ def global_tsp_time_slice_allocation(
     # Step 1: 代表点でGlobal TSP計算
     # ============================================
     # ローカル行列を作成（社長宅 + 代表点）
-    local_size = 1 + len(representative_indices)
-    local_time_matrix = [[0] * local_size for _ in range(local_size)]
-    local_cost_matrix = [[0] * local_size for _ in range(local_size)]
-
-    for i in range(local_size):
-        for j in range(local_size):
-            if i == 0:
-                orig_full_idx = shacho_idx
-            else:
-                orig_full_idx = representative_indices[i - 1] + 2
-            if j == 0:
-                dest_full_idx = shacho_idx
-            else:
-                dest_full_idx = representative_indices[j - 1] + 2
-            local_time_matrix[i][j] = time_matrix_all[orig_full_idx][dest_full_idx]
-            # 最適化モードに応じてコスト行列を設定
-            if optimize_mode == "distance" and dist_matrix_all is not None:
-                local_cost_matrix[i][j] = dist_matrix_all[orig_full_idx][dest_full_idx]
-            else:
-                local_cost_matrix[i][j] = time_matrix_all[orig_full_idx][dest_full_idx]
+    local_full_indices = [shacho_idx] + [idx + 2 for idx in representative_indices]
+    local_time_matrix = time_matrix_all.submatrix(local_full_indices)
+    # 最適化モードに応じてコスト行列を設定
+    if optimize_mode == "distance" and dist_matrix_all is not None:
+        local_cost_matrix = as_travel_matrix(dist_matrix_all).submatrix(local_full_indices)
+    else:
+        local_cost_matrix = local_time_matrix
+
+    # 前回の訪問順序を代表点の順序に変換（初期解用、新しく増えた代表点は末尾へ）
+    initial_route = None
+    if initial_order:
+        local_idx_of_visit = {}
+        for local_idx, base_name in enumerate(base_name_order, start=1):
+            group = location_groups[base_name]
+            for member_idx in group["offices"] + group["genbas"]:
+                local_idx_of_visit[member_idx] = local_idx
+        initial_route = []
+        for visit_idx in initial_order:
+            local_idx = local_idx_of_visit.get(visit_idx)
+            if local_idx is not None and local_idx not in initial_route:
+                initial_route.append(local_idx)
+        initial_route += [
+            local_idx for local_idx in range(1, len(local_full_indices))
+            if local_idx not in initial_route
+        ]
 
     # TSP計算（社長宅をデポとして）
-    tsp_result = solve_tsp_optimal_order(local_time_matrix, depot_idx=0, cost_matrix=local_cost_matrix)
+    tsp_result = solve_tsp_optimal_order(
+        local_time_matrix, depot_idx=0, cost_matrix=local_cost_matrix,
+        budget_mode=budget_mode, solver_stats=solver_stats, initial_route=initial_route
+    )
 
     # ============================================
     # Step 2: TSP結果を展開（事務所→現場の順）
@@ -1177,98 +3462,27 @@ def global_tsp_time_slice_allocation(
     # ============================================
     # Step 4: Time Slicing（時間シミュレーションで日程分割）
     # ============================================
+    simulator = DayScheduleSimulator(time_matrix_all, site_table, o2_idx, shacho_idx)
+    # 終了時刻の上限
+    end_limit = daily_end_limit_hour * 3600 + daily_end_limit_minute * 60
+
     day_routes = [[] for _ in range(num_days)]
     current_day = 0
     cursor = 0
 
-    while cursor < len(tsp_order) and current_day < num_days:
-        day_visits = []
-
-        # その日の最初の訪問先への到着時刻を計算
-        first_candidate_idx = tsp_order[cursor]
-        first_candidate_matrix_idx = first_candidate_idx + 2
-        shacho_to_first = time_matrix_all[shacho_idx][first_candidate_matrix_idx]
-        o2_to_shacho = time_matrix_all[o2_idx][shacho_idx]
-
-        min_departure = datetime.combine(datetime.today(),
-                                         datetime.strptime(DEPARTURE_MIN_TIME, "%H:%M").time())
-        min_arrival = datetime.combine(datetime.today(),
-                                       datetime.strptime(FIRST_VISIT_MIN_ARRIVAL_TIME, "%H:%M").time())
-
-        # 7:00出発時の到着時刻を計算
-        total_travel = o2_to_shacho + SHACHO_HOME["stay_min"] * 60 + shacho_to_first
-        calculated_arrival = min_departure + timedelta(seconds=total_travel)
-
-        # 到着時刻が8:00より早い場合は8:00に調整
-        if calculated_arrival < min_arrival:
-            first_visit_arrival = min_arrival
-        else:
-            first_visit_arrival = calculated_arrival
-
-        # 終了時刻の上限
-        end_limit = datetime.combine(
-            datetime.today(),
-            datetime.strptime(f"{daily_end_limit_hour}:{daily_end_limit_minute:02d}", "%H:%M").time()
-        )
-
-        current_time = first_visit_arrival
-        prev_matrix_idx = shacho_idx
-
-        while cursor < len(tsp_order):
-            visit_idx = tsp_order[cursor]
-            visit_matrix_idx = visit_idx + 2
-
-            # 訪問先情報を取得
-            if name_col:
-                point_name = visit_df.iloc[visit_idx][name_col]
-            else:
-                point_name = f"訪問先{visit_idx + 1}"
-
-            layer = visit_df.iloc[visit_idx].get("layer", None) if "layer" in visit_df.columns else None
-            stay_duration = get_stay_duration(point_name, layer, None)
-
-            # 移動時間と到着時刻の計算
-            if len(day_visits) == 0:
-                arrival = first_visit_arrival
-                travel_time = time_matrix_all[shacho_idx][visit_matrix_idx]
-            else:
-                travel_time = time_matrix_all[prev_matrix_idx][visit_matrix_idx]
-                arrival = current_time + timedelta(seconds=travel_time)
-
-            # きたえるーむの17:00固定ルール（地理的順序を維持）
-            if is_kitaeroom(point_name):
-                target_17 = arrival.replace(hour=17, minute=0, second=0, microsecond=0)
-                if arrival < target_17:
-                    arrival = target_17
-
-            # 滞在時間の計算（初回は打ち合わせ時間も加算）
-            if len(day_visits) == 0:
-                departure = arrival + timedelta(minutes=MEETING_DURATION + stay_duration)
-            else:
-                departure = arrival + timedelta(minutes=stay_duration)
-
-            # この訪問先を追加した場合の帰社時刻を予測
-            visit_to_shacho = time_matrix_all[visit_matrix_idx][shacho_idx]
-            shacho_to_o2 = time_matrix_all[shacho_idx][o2_idx]
-            estimated_end = (
-                departure
-                + timedelta(seconds=visit_to_shacho)
-                + timedelta(minutes=SHACHO_HOME["stay_min"])
-                + timedelta(seconds=shacho_to_o2)
-            )
-
-            # 終了時刻が上限を超えるかチェック
-            if estimated_end > end_limit and len(day_visits) > 0:
-                # この訪問先から先は翌日に回す
-                break
-            else:
-                # この日に追加
-                day_visits.append(visit_idx)
-                current_time = departure
-                prev_matrix_idx = visit_matrix_idx
-                cursor += 1
-
-        day_routes[current_day] = day_visits
+    while cursor < len(tsp_order) and current_day < num_days:
+        # 残りを1日で回った場合の行程（きたえるーむは17:00固定、地理的順序を維持）
+        schedule = simulator.simulate(tsp_order[cursor:], kitaeroom_wait=True)
+
+        # その訪問先で切り上げた場合の帰社時刻が上限を超えたら、そこから先は翌日に回す
+        # （1件目は必ずこの日に入れる）
+        day_count = 1
+        end_times = schedule["end_times"]
+        while day_count < len(end_times) and end_times[day_count] <= end_limit:
+            day_count += 1
+
+        day_routes[current_day] = tsp_order[cursor:cursor + day_count]
+        cursor += day_count
         current_day += 1
 
     # まだ残りがある場合は最終日に追加
@@ -1285,22 +3499,14 @@ def global_tsp_time_slice_allocation(
         kitaeroom_stay = FIXED_LOCATIONS.get("きたえるーむ", {}).get("stay_min", 15)
 
         # 17:00目標時刻
-        kitaeroom_target = datetime.combine(
-            datetime.today(),
-            datetime.strptime(KITAEROOM_RECOMMENDED_TIME, "%H:%M").time()
-        )
-
-        end_limit = datetime.combine(
-            datetime.today(),
-            datetime.strptime(f"{daily_end_limit_hour}:{daily_end_limit_minute:02d}", "%H:%M").time()
-        )
+        kitaeroom_target = parse_clock_seconds(KITAEROOM_RECOMMENDED_TIME)
 
         # きたえるーむ訪問後の帰路時間（概算）
         # きたえるーむ → 社長宅（10分） + 社長宅滞在（5分） + 社長宅→O2本社（6分）= 約21分
         kitaeroom_to_end_minutes = 21
 
         # きたえるーむ17:00訪問時の終了予定時刻
-        kitaeroom_end_time = kitaeroom_target + timedelta(minutes=kitaeroom_stay + kitaeroom_to_end_minutes)
+        kitaeroom_end_time = kitaeroom_target + (kitaeroom_stay + kitaeroom_to_end_minutes) * 60
 
         # 各日の最終訪問終了時刻を計算し、待機時間が最小の日を選ぶ
         best_day = -1
@@ -1310,48 +3516,14 @@ def global_tsp_time_slice_allocation(
             if not day_routes[day_idx]:  # その日に訪問がない場合はスキップ
                 continue
 
-            day_visits = day_routes[day_idx]
-
             # シミュレーションで最後の訪問の出発時刻を計算
-            # 最初の訪問先への到着時刻を計算
-            first_idx = day_visits[0]
-            first_matrix_idx = first_idx + 2
-            shacho_to_first_sim = time_matrix_all[shacho_idx][first_matrix_idx]
-            o2_to_shacho_sim = time_matrix_all[o2_idx][shacho_idx]
-
-            min_dep = datetime.combine(datetime.today(),
-                                       datetime.strptime(DEPARTURE_MIN_TIME, "%H:%M").time())
-            min_arr = datetime.combine(datetime.today(),
-                                       datetime.strptime(FIRST_VISIT_MIN_ARRIVAL_TIME, "%H:%M").time())
-            total_travel_sim = o2_to_shacho_sim + SHACHO_HOME["stay_min"] * 60 + shacho_to_first_sim
-            calc_arrival = min_dep + timedelta(seconds=total_travel_sim)
-            sim_time = max(calc_arrival, min_arr)
-
-            for i, visit_idx in enumerate(day_visits):
-                if name_col and visit_df is not None:
-                    point_name = visit_df.iloc[visit_idx][name_col]
-                else:
-                    point_name = f"訪問先{visit_idx + 1}"
-
-                layer = visit_df.iloc[visit_idx].get("layer", None) if visit_df is not None and "layer" in visit_df.columns else None
-                stay = get_stay_duration(point_name, layer, None)
-
-                if i == 0:
-                    # 最初の訪問は打ち合わせ時間も加算
-                    sim_time = sim_time + timedelta(minutes=MEETING_DURATION + stay)
-                else:
-                    # 移動時間を加算
-                    prev_idx = day_visits[i - 1]
-                    travel = time_matrix_all[prev_idx + 2][visit_idx + 2]
-                    sim_time = sim_time + timedelta(seconds=travel) + timedelta(minutes=stay)
-
-            last_departure = sim_time
+            last_departure = simulator.simulate(day_routes[day_idx])["departures"][-1]
 
             # この日の最後の訪問終了時刻が17:00より前なら、きたえるーむを17:00に訪問可能
             # また、きたえるーむ訪問後の終了時刻が制限内であること
             if last_departure <= kitaeroom_target and kitaeroom_end_time <= end_limit:
                 # 待機時間を計算（17:00 - 最終訪問終了時刻）
-                wait_minutes = (kitaeroom_target - last_departure).total_seconds() / 60
+                wait_minutes = (kitaeroom_target - last_departure) / 60
 
                 # 待機時間が最小の日を選択
                 if wait_minutes < min_wait_minutes:
@@ -1374,7 +3546,8 @@ def global_tsp_time_slice_allocation(
     return day_routes
 
 
-def reoptimize_day_route(visit_indices, time_matrix_all, shacho_idx, visit_df=None, name_col=None):
+def reoptimize_day_route(visit_indices, time_matrix_all, shacho_idx, visit_df=None, name_col=None,
+                         budget_mode="adaptive", solver_stats=None, site_table=None):
     """
     指定された訪問先インデックスリストをTSPで再最適化
     （きたえるーむは常に最後尾に配置）
@@ -1385,6 +3558,9 @@ def reoptimize_day_route(visit_indices, time_matrix_all, shacho_idx, visit_df=No
         shacho_idx: 社長宅のインデックス
         visit_df: 訪問先データフレーム（きたえるーむ判定用）
         name_col: 名前カラム名
+        budget_mode: TSPの探索時間の配分（SOLVER_BUDGET_MODES のキー）
+        solver_stats: リストを渡すと、TSPの探索規模・所要時間を追記する
+        site_table: 訪問先属性テーブル（Noneの場合はvisit_dfから作成）
 
     Returns:
         optimized_indices: TSP最適化後の訪問先インデックスリスト
@@ -1392,17 +3568,16 @@ def reoptimize_day_route(visit_indices, time_matrix_all, shacho_idx, visit_df=No
     if len(visit_indices) <= 1:
         return list(visit_indices)
 
+    if site_table is None and visit_df is not None and name_col:
+        site_table = build_site_table(visit_df, name_col)
+
     # きたえるーむを分離
     kitaeroom_indices = []
     normal_indices = []
 
     for idx in visit_indices:
-        if visit_df is not None and name_col:
-            point_name = visit_df.iloc[idx][name_col]
-            if is_kitaeroom(point_name):
-                kitaeroom_indices.append(idx)
-            else:
-                normal_indices.append(idx)
+        if site_table is not None and site_table.is_kitaeroom[idx]:
+            kitaeroom_indices.append(idx)
         else:
             normal_indices.append(idx)
 
@@ -1411,23 +3586,16 @@ def reoptimize_day_route(visit_indices, time_matrix_all, shacho_idx, visit_df=No
         return list(kitaeroom_indices)
 
     # きたえるーむ以外でTSP最適化
-    local_size = 1 + len(normal_indices)
-    local_matrix = [[0] * local_size for _ in range(local_size)]
-
-    for i in range(local_size):
-        for j in range(local_size):
-            if i == 0:
-                orig_full_idx = shacho_idx
-            else:
-                orig_full_idx = normal_indices[i - 1] + 2
-            if j == 0:
-                dest_full_idx = shacho_idx
-            else:
-                dest_full_idx = normal_indices[j - 1] + 2
-            local_matrix[i][j] = time_matrix_all[orig_full_idx][dest_full_idx]
+    local_matrix = as_travel_matrix(time_matrix_all).submatrix(
+        [shacho_idx] + [idx + 2 for idx in normal_indices]
+    )
 
     # TSP計算
-    tsp_result = solve_tsp_optimal_order(local_matrix, depot_idx=0)
+    # 現在の並び順を初期解にする
+    tsp_result = solve_tsp_optimal_order(
+        local_matrix, depot_idx=0, budget_mode=budget_mode, solver_stats=solver_stats,
+        initial_route=list(range(1, len(normal_indices) + 1))
+    )
 
     # 結果を元のインデックスに変換
     optimized_indices = [normal_indices[idx - 1] for idx in tsp_result]
@@ -1438,7 +3606,8 @@ def reoptimize_day_route(visit_indices, time_matrix_all, shacho_idx, visit_df=No
     return optimized_indices
 
 
-def optimize_gap_filling_moves(day_routes, visit_df, time_matrix_all, o2_idx, shacho_idx, name_col):
+def optimize_gap_filling_moves(day_routes, visit_df, time_matrix_all, o2_idx, shacho_idx, name_col,
+                               site_table=None):
     """
     Gap Filling用のタスク移動処理
 
@@ -1452,6 +3621,7 @@ def optimize_gap_filling_moves(day_routes, visit_df, time_matrix_all, o2_idx, sh
         o2_idx: O2本社のインデックス（通常0）
         shacho_idx: 社長宅のインデックス（通常1）
         name_col: 名前カラム名
+        site_table: 訪問先属性テーブル（Noneの場合はvisit_dfから作成）
 
     Returns:
         optimized_day_routes: 最適化後の日程ルート
@@ -1459,6 +3629,10 @@ def optimize_gap_filling_moves(day_routes, visit_df, time_matrix_all, o2_idx, sh
     if not name_col:
         return day_routes
 
+    time_matrix_all = as_travel_matrix(time_matrix_all)
+    if site_table is None:
+        site_table = build_site_table(visit_df, name_col)
+
     # 結果用にコピー
     optimized_routes = [list(route) for route in day_routes]
 
@@ -1470,8 +3644,7 @@ def optimize_gap_filling_moves(day_routes, visit_df, time_matrix_all, o2_idx, sh
 
     for day_idx, route in enumerate(optimized_routes):
         for pos, visit_idx in enumerate(route):
-            point_name = visit_df.iloc[visit_idx][name_col]
-            if is_kitaeroom(point_name):
+            if site_table.is_kitaeroom[visit_idx]:
                 kitaeroom_day = day_idx
                 kitaeroom_idx_in_route = pos
                 break
@@ -1487,76 +3660,22 @@ def optimize_gap_filling_moves(day_routes, visit_df, time_matrix_all, o2_idx, sh
     # ============================================
     route_with_kitaeroom = optimized_routes[kitaeroom_day]
 
-    # きたえるーむの直前までのスケジュールをシミュレーション
-    # 最初の訪問先への到着時刻を計算
-    first_visit_idx = route_with_kitaeroom[0]
-    first_visit_matrix_idx_gap = first_visit_idx + 2
-    shacho_to_first_gap = time_matrix_all[shacho_idx][first_visit_matrix_idx_gap]
-    o2_to_shacho_gap = time_matrix_all[o2_idx][shacho_idx]
-
-    min_departure_gap = datetime.combine(datetime.today(),
-                                         datetime.strptime(DEPARTURE_MIN_TIME, "%H:%M").time())
-    min_arrival_gap = datetime.combine(datetime.today(),
-                                       datetime.strptime(FIRST_VISIT_MIN_ARRIVAL_TIME, "%H:%M").time())
-    total_travel_gap = o2_to_shacho_gap + SHACHO_HOME["stay_min"] * 60 + shacho_to_first_gap
-    calculated_arrival_gap = min_departure_gap + timedelta(seconds=total_travel_gap)
-    first_visit_arrival = max(calculated_arrival_gap, min_arrival_gap)
-
-    current_time = first_visit_arrival
-    prev_matrix_idx = shacho_idx
-    lunch_added_gap = False  # 昼休みを追加したかどうか
-    lunch_start_time_gap = datetime.combine(datetime.today(),
-                                            datetime.strptime(f"{LUNCH_START_HOUR}:{LUNCH_START_MINUTE}", "%H:%M").time())
-
-    # きたえるーむ直前まで処理
-    for i, visit_idx in enumerate(route_with_kitaeroom):
-        visit_matrix_idx = visit_idx + 2
-        point_name = visit_df.iloc[visit_idx][name_col]
-
-        # きたえるーむに到達したら終了
-        if is_kitaeroom(point_name):
-            break
-
-        layer = visit_df.iloc[visit_idx].get("layer", None) if "layer" in visit_df.columns else None
-        stay_duration = get_stay_duration(point_name, layer, None)
-
-        if i == 0:
-            arrival = first_visit_arrival
-        else:
-            travel_time = time_matrix_all[prev_matrix_idx][visit_matrix_idx]
-            arrival = current_time + timedelta(seconds=travel_time)
-
-        # 初回は打ち合わせ時間も加算
-        if i == 0:
-            departure = arrival + timedelta(minutes=MEETING_DURATION + stay_duration)
-        else:
-            departure = arrival + timedelta(minutes=stay_duration)
-
-        # 昼休みの判定：11:30を過ぎたら60分追加（1回だけ）
-        if not lunch_added_gap and departure >= lunch_start_time_gap:
-            departure = departure + timedelta(minutes=LUNCH_DURATION)
-            lunch_added_gap = True
-
-        current_time = departure
-        prev_matrix_idx = visit_matrix_idx
-
-    # きたえるーむへの移動時間を計算
-    kitaeroom_visit_idx = route_with_kitaeroom[kitaeroom_idx_in_route]
-    kitaeroom_matrix_idx = kitaeroom_visit_idx + 2
+    # きたえるーむまでのスケジュールをシミュレーション（昼休み60分を1回加算）
+    simulator = DayScheduleSimulator(time_matrix_all, site_table, o2_idx, shacho_idx)
+    schedule = simulator.simulate(route_with_kitaeroom[:kitaeroom_idx_in_route + 1], lunch=True)
 
+    # きたえるーむへの到着時刻
     if kitaeroom_idx_in_route > 0:
-        prev_visit_idx = route_with_kitaeroom[kitaeroom_idx_in_route - 1]
-        prev_matrix_idx = prev_visit_idx + 2
-        travel_to_kitaeroom = time_matrix_all[prev_matrix_idx][kitaeroom_matrix_idx]
+        kitaeroom_arrival = schedule["arrivals"][kitaeroom_idx_in_route]
     else:
-        travel_to_kitaeroom = time_matrix_all[shacho_idx][kitaeroom_matrix_idx]
-
-    kitaeroom_arrival = current_time + timedelta(seconds=travel_to_kitaeroom)
-    target_17 = kitaeroom_arrival.replace(hour=17, minute=0, second=0, microsecond=0)
+        kitaeroom_visit_idx = route_with_kitaeroom[kitaeroom_idx_in_route]
+        kitaeroom_arrival = schedule["first_arrival"] + time_matrix_all[shacho_idx, kitaeroom_visit_idx + 2]
+    # 到着した日の17:00（日付をまたいだ場合も到着日の17:00）
+    target_17 = kitaeroom_arrival - kitaeroom_arrival % 86400 + parse_clock_seconds(KITAEROOM_RECOMMENDED_TIME)
 
     # 空き時間を計算
     if kitaeroom_arrival < target_17:
-        gap_minutes = int((target_17 - kitaeroom_arrival).total_seconds() / 60)
+        gap_minutes = int((target_17 - kitaeroom_arrival) / 60)
     else:
         gap_minutes = 0
 
@@ -1586,14 +3705,12 @@ def optimize_gap_filling_moves(day_routes, visit_df, time_matrix_all, o2_idx, sh
             continue
 
         for pos, visit_idx in enumerate(route):
-            point_name = visit_df.iloc[visit_idx][name_col]
-
             # O2本社を検索（出発・帰社ではないもの）
-            if o2_found is None and is_o2_honsha_task(point_name):
+            if o2_found is None and site_table.is_o2_task[visit_idx]:
                 o2_found = (day_idx, pos, visit_idx)
 
             # 藤沢倉庫を検索
-            if fujisawa_found is None and is_fujisawa_souko(point_name):
+            if fujisawa_found is None and site_table.is_fujisawa[visit_idx]:
                 fujisawa_found = (day_idx, pos, visit_idx)
 
     # ============================================
@@ -1623,23 +3740,20 @@ def optimize_gap_filling_moves(day_routes, visit_df, time_matrix_all, o2_idx, sh
     # きたえるーむのインデックスを再計算（削除により変わっている可能性）
     new_kitaeroom_pos = None
     for pos, visit_idx in enumerate(optimized_routes[kitaeroom_day]):
-        point_name = visit_df.iloc[visit_idx][name_col]
-        if is_kitaeroom(point_name):
+        if site_table.is_kitaeroom[visit_idx]:
             new_kitaeroom_pos = pos
             break
 
     if new_kitaeroom_pos is not None:
         # O2本社を先に挿入（藤沢倉庫より前に来るように）
         for visit_idx in tasks_to_add:
-            point_name = visit_df.iloc[visit_idx][name_col]
-            if is_o2_honsha_task(point_name):
+            if site_table.is_o2_task[visit_idx]:
                 optimized_routes[kitaeroom_day].insert(new_kitaeroom_pos, visit_idx)
                 new_kitaeroom_pos += 1  # 挿入したのでずらす
 
         # 藤沢倉庫を挿入
         for visit_idx in tasks_to_add:
-            point_name = visit_df.iloc[visit_idx][name_col]
-            if is_fujisawa_souko(point_name):
+            if site_table.is_fujisawa[visit_idx]:
                 optimized_routes[kitaeroom_day].insert(new_kitaeroom_pos, visit_idx)
                 new_kitaeroom_pos += 1
 
@@ -1651,23 +3765,31 @@ def optimize_gap_filling_moves(day_routes, visit_df, time_matrix_all, o2_idx, sh
 # ========================================
 
 def create_day_timetable(day_num, visit_indices, visit_df, time_matrix_all,
-                         o2_idx, shacho_idx, name_col, api_key=None):
-    """1日分のタイムテーブルを作成"""
+                         o2_idx, shacho_idx, name_col, restaurants_by_cell=None, site_table=None):
+    """1日分のタイムテーブルを作成（site_table を渡すと訪問先属性の再計算を省略）
+
+    昼食のお店は restaurants_by_cell（prefetch_nearby_restaurants の結果）から引くだけで、
+    ここではAPIを呼ばない。お店を表示できる昼食の地点は metrics["lunch_point"] に入る。
+    """
     timetable = []
     calendar_text = []
 
     if not visit_indices:
         return pd.DataFrame(), "", []
 
+    time_matrix_all = as_travel_matrix(time_matrix_all)
+    if site_table is None:
+        site_table = build_site_table(visit_df, name_col)
+
     # ============================================
     # 訪問先リストを事務所→現場の順に並べ替え
     # ============================================
-    filtered_visit_indices = reorder_office_genba_pairs(list(visit_indices), visit_df, name_col)
+    filtered_visit_indices = reorder_office_genba_pairs(list(visit_indices), visit_df, name_col, site_table)
 
     first_visit_matrix_idx = filtered_visit_indices[0] + 2
 
-    shacho_to_first_time = time_matrix_all[shacho_idx][first_visit_matrix_idx]
-    o2_to_shacho_time = time_matrix_all[o2_idx][shacho_idx]
+    shacho_to_first_time = time_matrix_all[shacho_idx, first_visit_matrix_idx]
+    o2_to_shacho_time = time_matrix_all[o2_idx, shacho_idx]
 
     # ============================================
     # きたえるーむがある場合、17:00固定到着になるよう出発時刻を調整
@@ -1680,74 +3802,29 @@ def create_day_timetable(day_num, visit_indices, visit_df, time_matrix_all,
     has_kitaeroom = False
     kitaeroom_position = -1
     for idx, visit_idx in enumerate(filtered_visit_indices):
-        if name_col:
-            pname = visit_df.iloc[visit_idx][name_col]
-        else:
-            pname = f"訪問先{visit_idx + 1}"
-        if is_kitaeroom(pname):
+        if site_table.is_kitaeroom[visit_idx]:
             has_kitaeroom = True
             kitaeroom_position = idx
             break
 
     if has_kitaeroom:
-        # きたえるーむまでの所要時間をシミュレーション
-        sim_min_departure = datetime.combine(datetime.today(),
-                                             datetime.strptime(DEPARTURE_MIN_TIME, "%H:%M").time())
-        sim_total_travel = o2_to_shacho_time + SHACHO_HOME["stay_min"] * 60 + shacho_to_first_time
-        sim_first_arrival = sim_min_departure + timedelta(seconds=sim_total_travel)
-
-        # 8:00より早い場合は8:00に調整
-        sim_min_arrival = datetime.combine(datetime.today(),
-                                           datetime.strptime(FIRST_VISIT_MIN_ARRIVAL_TIME, "%H:%M").time())
-        if sim_first_arrival < sim_min_arrival:
-            sim_first_arrival = sim_min_arrival
-
-        # きたえるーむまでの時間を計算（昼休みも考慮）
-        sim_time = sim_first_arrival
-        prev_matrix_idx = shacho_idx
-        lunch_added = False  # 昼休みを追加したかどうか
-        lunch_start_time = datetime.combine(datetime.today(),
-                                            datetime.strptime(f"{LUNCH_START_HOUR}:{LUNCH_START_MINUTE}", "%H:%M").time())
+        # きたえるーむまでの所要時間をシミュレーション（昼休み60分を1回加算）
+        simulator = DayScheduleSimulator(time_matrix_all, site_table, o2_idx, shacho_idx)
+        schedule = simulator.simulate(filtered_visit_indices[:kitaeroom_position + 1], lunch=True)
+
+        # きたえるーむに到着する予定時刻（出発時刻から滞在分を戻す）
+        kitaeroom_visit_idx = filtered_visit_indices[kitaeroom_position]
+        kitaeroom_arrival_sim = (
+            schedule["departures"][kitaeroom_position] - simulator.stay[kitaeroom_visit_idx]
+        )
+        kitaeroom_target = parse_clock_seconds(KITAEROOM_RECOMMENDED_TIME)
 
-        for idx, visit_idx in enumerate(filtered_visit_indices):
-            if name_col:
-                pname = visit_df.iloc[visit_idx][name_col]
-            else:
-                pname = f"訪問先{visit_idx + 1}"
-            player = visit_df.iloc[visit_idx].get("layer", None) if "layer" in visit_df.columns else None
-            pdesc = visit_df.iloc[visit_idx].get("description", None) if "description" in visit_df.columns else None
-            pstay = get_stay_duration(pname, player, pdesc)
-
-            visit_matrix_idx = visit_idx + 2
-            if idx == 0:
-                # 最初の訪問先は打ち合わせ10分を加算
-                sim_time = sim_time + timedelta(minutes=MEETING_DURATION + pstay)
-            else:
-                travel = time_matrix_all[prev_matrix_idx][visit_matrix_idx]
-                sim_time = sim_time + timedelta(seconds=travel) + timedelta(minutes=pstay)
-
-            # 昼休みの判定：11:30を過ぎたら60分追加（1回だけ）
-            if not lunch_added and sim_time >= lunch_start_time:
-                sim_time = sim_time + timedelta(minutes=LUNCH_DURATION)
-                lunch_added = True
-
-            prev_matrix_idx = visit_matrix_idx
-
-            if is_kitaeroom(pname):
-                # きたえるーむに到着する予定時刻
-                # この時点でsim_timeはきたえるーむ出発時刻なので、到着時刻は滞在分戻す
-                kitaeroom_arrival_sim = sim_time - timedelta(minutes=pstay)
-                kitaeroom_target = datetime.combine(datetime.today(), datetime.strptime("17:00", "%H:%M").time())
-
-                if kitaeroom_arrival_sim < kitaeroom_target:
-                    # 17:00より早く着く場合、その分出発を遅らせる（正の値）
-                    wait_diff = (kitaeroom_target - kitaeroom_arrival_sim).total_seconds() / 60
-                    kitaeroom_time_adjustment = int(wait_diff)
-                elif kitaeroom_arrival_sim > kitaeroom_target:
-                    # 17:00より遅く着く場合、その分出発を繰り上げる（負の値）
-                    early_diff = (kitaeroom_arrival_sim - kitaeroom_target).total_seconds() / 60
-                    kitaeroom_time_adjustment = -int(early_diff)
-                break
+        if kitaeroom_arrival_sim < kitaeroom_target:
+            # 17:00より早く着く場合、その分出発を遅らせる（正の値）
+            kitaeroom_time_adjustment = int((kitaeroom_target - kitaeroom_arrival_sim) / 60)
+        elif kitaeroom_arrival_sim > kitaeroom_target:
+            # 17:00より遅く着く場合、その分出発を繰り上げる（負の値）
+            kitaeroom_time_adjustment = -int((kitaeroom_arrival_sim - kitaeroom_target) / 60)
 
     # 出発時刻を7:00以降で計算し、到着時刻を算出
     min_departure = datetime.combine(datetime.today(),
@@ -1812,20 +3889,16 @@ def create_day_timetable(day_num, visit_indices, visit_df, time_matrix_all,
     # 3. 訪問先リスト
     current_time = first_visit_arrival
     lunch_inserted = False
+    lunch_point = None
     total_travel_seconds = o2_to_shacho_time + shacho_to_first_time
     total_stay_minutes = SHACHO_HOME["stay_min"]
     first_regular_visit_done = False  # 最初の通常訪問先（固定ロケーション以外）の打ち合わせ済みフラグ
 
     for i, visit_idx in enumerate(filtered_visit_indices):
-        if name_col:
-            point_name = visit_df.iloc[visit_idx][name_col]
-        else:
-            point_name = f"訪問先{visit_idx + 1}"
-
-        layer = visit_df.iloc[visit_idx].get("layer", None) if "layer" in visit_df.columns else None
-        description = visit_df.iloc[visit_idx].get("description", None) if "description" in visit_df.columns else None
-
-        stay_duration = get_stay_duration(point_name, layer, description)
+        point_name = site_table.names[visit_idx]
+        layer = site_table.layers[visit_idx]
+        stay_duration = site_table.stay_minutes[visit_idx]
+        visit_is_kitaeroom = site_table.is_kitaeroom[visit_idx]
         visit_matrix_idx = visit_idx + 2
 
         if i == 0:
@@ -1833,7 +3906,7 @@ def create_day_timetable(day_num, visit_indices, visit_df, time_matrix_all,
             arrival = first_visit_arrival
         else:
             prev_matrix_idx = filtered_visit_indices[i - 1] + 2
-            travel_time = time_matrix_all[prev_matrix_idx][visit_matrix_idx]
+            travel_time = time_matrix_all[prev_matrix_idx, visit_matrix_idx]
             arrival = current_time + timedelta(seconds=travel_time)
             total_travel_seconds += travel_time
 
@@ -1848,7 +3921,7 @@ def create_day_timetable(day_num, visit_indices, visit_df, time_matrix_all,
         lunch_break_adjusted = False
 
         # きたえるーむは17:00固定なので昼休み調整の対象外
-        if not is_kitaeroom(point_name):
+        if not visit_is_kitaeroom:
             # 1件目の場合は打ち合わせ+滞在時間、2件目以降は滞在時間のみ
             if i == 0:
                 total_stay_for_check = MEETING_DURATION + stay_duration
@@ -1870,12 +3943,10 @@ def create_day_timetable(day_num, visit_indices, visit_df, time_matrix_all,
                                             datetime.strptime(f"{LUNCH_START_HOUR}:{LUNCH_START_MINUTE}", "%H:%M").time())
 
         # 同じ場所（事務所→現場）の間には昼食を挟まない
-        prev_point_name = ""
-        if i > 0:
-            prev_visit_idx = filtered_visit_indices[i - 1]
-            prev_point_name = visit_df.iloc[prev_visit_idx][name_col] if name_col else ""
-
-        skip_lunch_for_same_location = is_same_location(prev_point_name, point_name)
+        skip_lunch_for_same_location = (
+            bool(name_col) and i > 0 and
+            site_table.same_location(filtered_visit_indices[i - 1], visit_idx)
+        )
 
         # 昼食挿入条件：到着時刻が11:30以降（調整後の到着時刻を使用）
         # または昼休み調整が行われた場合も昼食休憩を表示
@@ -1901,8 +3972,8 @@ def create_day_timetable(day_num, visit_indices, visit_df, time_matrix_all,
             # 昼食時間が30分以上確保できる場合のみ挿入
             if actual_lunch_duration >= 30:
                 prev_visit_idx = filtered_visit_indices[i - 1]
-                prev_lat = visit_df.iloc[prev_visit_idx]["lat"]
-                prev_lon = visit_df.iloc[prev_visit_idx]["lon"]
+                prev_lat = site_table.lats[prev_visit_idx]
+                prev_lon = site_table.lons[prev_visit_idx]
 
                 # 移動時間を計算
                 move_time_min = travel_min
@@ -1912,10 +3983,10 @@ def create_day_timetable(day_num, visit_indices, visit_df, time_matrix_all,
                     restaurant_name = f"（60分）昼食休憩【移動：{move_time_min}分】"
                 else:
                     restaurant_name = f"（60分）昼食休憩"
-                    if api_key:
-                        restaurants, _ = find_nearby_restaurant(prev_lat, prev_lon, api_key)
-                        if restaurants:
-                            restaurant_name = f"昼食：{restaurants[0]['name']}（{actual_lunch_duration}分）"
+                    lunch_point = (prev_lat, prev_lon)
+                    restaurants = lookup_nearby_restaurants(restaurants_by_cell, prev_lat, prev_lon)
+                    if restaurants:
+                        restaurant_name = f"昼食：{restaurants[0]['name']}（{actual_lunch_duration}分）"
 
                 timetable.append({
                     "順番": "🍽️",
@@ -1940,7 +4011,7 @@ def create_day_timetable(day_num, visit_indices, visit_df, time_matrix_all,
         # ============================================
         wait_minutes = 0
         remark = ""
-        if is_kitaeroom(point_name):
+        if visit_is_kitaeroom:
             target_time = arrival.replace(hour=17, minute=0, second=0, microsecond=0)
             if arrival < target_time:
                 # 17:00より早く着いた場合は待機
@@ -1955,7 +4026,7 @@ def create_day_timetable(day_num, visit_indices, visit_df, time_matrix_all,
         if is_first_regular:
             # 最初の通常訪問先の場合（きたえるーむでも適用後の時刻で処理）
             # 打ち合わせ可能な場所かどうかを判定（発注先レイヤーは打ち合わせ不可）
-            should_have_meeting = can_have_meeting(point_name, layer)
+            should_have_meeting = site_table.can_meet[visit_idx]
 
             # 待機時間を合算（きたえるーむ待機 + 昼休み待機）
             total_wait = wait_minutes + lunch_break_wait
@@ -2065,7 +4136,7 @@ def create_day_timetable(day_num, visit_indices, visit_df, time_matrix_all,
     # （訪問先ループ後でも昼食が挿入されていない場合）
     # ============================================
     last_visit_matrix_idx = filtered_visit_indices[-1] + 2
-    last_to_shacho_time = time_matrix_all[last_visit_matrix_idx][shacho_idx]
+    last_to_shacho_time = time_matrix_all[last_visit_matrix_idx, shacho_idx]
     last_to_shacho_min = int(last_to_shacho_time) // 60
     total_travel_seconds += last_to_shacho_time
 
@@ -2087,18 +4158,18 @@ def create_day_timetable(day_num, visit_indices, visit_df, time_matrix_all,
         # 昼食時間が30分以上確保できる場合のみ挿入
         if actual_lunch_duration >= 30:
             last_visit_idx = filtered_visit_indices[-1]
-            last_lat = visit_df.iloc[last_visit_idx]["lat"]
-            last_lon = visit_df.iloc[last_visit_idx]["lon"]
+            last_lat = site_table.lats[last_visit_idx]
+            last_lon = site_table.lons[last_visit_idx]
 
             # 表示名を決定
             if last_to_shacho_min > 0:
                 restaurant_name = f"（60分）昼食休憩【移動：{last_to_shacho_min}分】"
             else:
                 restaurant_name = f"（60分）昼食休憩"
-                if api_key:
-                    restaurants, _ = find_nearby_restaurant(last_lat, last_lon, api_key)
-                    if restaurants:
-                        restaurant_name = f"昼食：{restaurants[0]['name']}（{actual_lunch_duration}分）"
+                lunch_point = (last_lat, last_lon)
+                restaurants = lookup_nearby_restaurants(restaurants_by_cell, last_lat, last_lon)
+                if restaurants:
+                    restaurant_name = f"昼食：{restaurants[0]['name']}（{actual_lunch_duration}分）"
 
             timetable.append({
                 "順番": "🍽️",
@@ -2133,7 +4204,7 @@ def create_day_timetable(day_num, visit_indices, visit_df, time_matrix_all,
     order += 1
 
     # 5. O2本社（帰社）
-    shacho_to_o2_time = time_matrix_all[shacho_idx][o2_idx]
+    shacho_to_o2_time = time_matrix_all[shacho_idx, o2_idx]
     shacho_to_o2_min = int(shacho_to_o2_time) // 60
     total_travel_seconds += shacho_to_o2_time
     o2_return_arrival = shacho_return_departure + timedelta(seconds=shacho_to_o2_time)
@@ -2159,12 +4230,100 @@ def create_day_timetable(day_num, visit_indices, visit_df, time_matrix_all,
         "total_travel_seconds": total_travel_seconds,
         "total_stay_minutes": total_stay_minutes,
         "start_time": o2_departure,
-        "end_time": o2_return_arrival
+        "end_time": o2_return_arrival,
+        "lunch_point": lunch_point
     }
 
     return pd.DataFrame(timetable), calendar_output, metrics
 
 
+def find_cheapest_insertion(day_routes, new_idx, visit_df, time_matrix_all, o2_idx, shacho_idx, name_col,
+                            daily_end_limit_hour=17, daily_end_limit_minute=30, return_deadlines=None,
+                            site_table=None):
+    """1件の訪問先を既存の日程に挿入する位置を探す（他の訪問の並び・日程は変更しない）
+
+    各日・各位置に挿入した行程を create_day_timetable と同じ時間計算で評価し、
+    帰社時刻が上限（帰宅希望時刻があればその時刻）以内で移動時間の増加が最小の位置を選ぶ。
+    きたえるーむは最後尾のまま、その手前までを挿入位置の候補とする。
+    上限内に収まる位置がない場合は、帰社時刻の超過が最小の位置を選ぶ。
+
+    Args:
+        day_routes: 各日の訪問先インデックスリスト
+        new_idx: 挿入する訪問先のインデックス（visit_df内）
+        visit_df: 訪問先データフレーム（挿入する訪問先を含む）
+        time_matrix_all: 全地点の移動時間行列（挿入する訪問先を含む）
+        o2_idx: O2本社のインデックス（通常0）
+        shacho_idx: 社長宅のインデックス（通常1）
+        name_col: 名前カラム名
+        daily_end_limit_hour: 1日の終了時刻上限（時）
+        daily_end_limit_minute: 1日の終了時刻上限（分）
+        return_deadlines: {日番号: 帰宅希望時刻(time)}
+        site_table: 訪問先属性テーブル（Noneの場合はvisit_dfから作成）
+
+    Returns:
+        new_day_routes: 挿入後の日程ルート
+        insertion: {"day_idx", "position", "added_travel_seconds", "end_time", "feasible"}
+    """
+    time_matrix_all = as_travel_matrix(time_matrix_all)
+    return_deadlines = return_deadlines or {}
+    if site_table is None:
+        site_table = build_site_table(visit_df, name_col)
+
+    default_end_limit = datetime.combine(
+        datetime.today(),
+        datetime.strptime(f"{daily_end_limit_hour}:{daily_end_limit_minute:02d}", "%H:%M").time()
+    )
+    new_is_kitaeroom = site_table.is_kitaeroom[new_idx]
+
+    best_key = None
+    insertion = None
+    for day_idx, route in enumerate(day_routes):
+        day_num = day_idx + 1
+        end_limit = default_end_limit
+        if day_num in return_deadlines:
+            end_limit = datetime.combine(datetime.today(), return_deadlines[day_num])
+
+        base_travel = 0
+        if route:
+            _, _, metrics = create_day_timetable(
+                day_num, route, visit_df, time_matrix_all, o2_idx, shacho_idx, name_col,
+                site_table=site_table
+            )
+            base_travel = metrics["total_travel_seconds"]
+
+        # きたえるーむより前だけを候補にする（きたえるーむ自体の追加は最後尾のみ）
+        last_position = len(route)
+        while last_position > 0 and site_table.is_kitaeroom[route[last_position - 1]]:
+            last_position -= 1
+        positions = [len(route)] if new_is_kitaeroom else range(last_position + 1)
+
+        for position in positions:
+            candidate = list(route[:position]) + [new_idx] + list(route[position:])
+            _, _, metrics = create_day_timetable(
+                day_num, candidate, visit_df, time_matrix_all, o2_idx, shacho_idx, name_col,
+                site_table=site_table
+            )
+            added_travel = metrics["total_travel_seconds"] - base_travel
+            overflow = max(0, (metrics["end_time"] - end_limit).total_seconds())
+
+            # 上限内の候補を優先し、その中で移動時間の増加が最小のもの
+            key = (overflow, added_travel)
+            if best_key is None or key < best_key:
+                best_key = key
+                insertion = {
+                    "day_idx": day_idx,
+                    "position": position,
+                    "added_travel_seconds": added_travel,
+                    "end_time": metrics["end_time"],
+                    "feasible": overflow == 0,
+                }
+
+    new_day_routes = [list(route) for route in day_routes]
+    if insertion is not None:
+        new_day_routes[insertion["day_idx"]].insert(insertion["position"], new_idx)
+    return new_day_routes, insertion
+
+
 def get_name_column(df):
     """名前列を特定"""
     for col in ["name", "名前", "地点名", "名称", "title"]:
@@ -2173,6 +4332,330 @@ def get_name_column(df):
     return None
 
 
+# ========================================
+# 結果表示（計画の指紋によるメモ化）
+# ========================================
+
+def make_plan_fingerprint(day_routes, visit_df, time_matrix, extra=None):
+    """計画（日程・訪問先・移動時間行列）が同じかどうかを判定するためのハッシュ
+
+    Args:
+        day_routes: 各日の訪問先インデックスリスト
+        visit_df: 訪問先データフレーム
+        time_matrix: 移動時間行列（バイアス適用後、Noneも可）
+        extra: 結果に影響するその他の値（JSONにできるもの）
+    """
+    digest = hashlib.sha256()
+    digest.update(json.dumps(
+        {"day_routes": [[int(idx) for idx in route] for route in day_routes], "extra": extra},
+        ensure_ascii=False, default=str
+    ).encode("utf-8"))
+    try:
+        digest.update(pd.util.hash_pandas_object(visit_df, index=False).to_numpy().tobytes())
+    except TypeError:
+        # ハッシュ化できない型の列がある場合（保存データの読み込み時など）
+        digest.update(visit_df.to_json(force_ascii=False).encode("utf-8"))
+    digest.update(list(visit_df.columns).__repr__().encode("utf-8"))
+    if time_matrix is not None:
+        digest.update(as_travel_matrix(time_matrix).values.tobytes())
+    return digest.hexdigest()
+
+
+def find_nav_coordinates(location_name, visit_df, name_col):
+    """タイムテーブルの場所名からナビ用の座標を探す（見つからない場合は (None, None)）"""
+    location_name = str(location_name)
+    # 固定ロケーション
+    if "O2本社" in location_name:
+        return O2_HONSHA["lat"], O2_HONSHA["lon"]
+    if "直樹さん宅" in location_name:
+        return SHACHO_HOME["lat"], SHACHO_HOME["lon"]
+    if "藤沢倉庫" in location_name:
+        return FUJISAWA_SOUKO["lat"], FUJISAWA_SOUKO["lon"]
+
+    names = visit_df[name_col].tolist() if name_col else [""] * len(visit_df)
+    lats = visit_df["lat"].tolist()
+    lons = visit_df["lon"].tolist()
+    for sel_name, lat, lon in zip(names, lats, lons):
+        sel_name = str(sel_name)
+        if "きたえるーむ" in location_name:
+            # きたえるーむは選択された訪問先から探す
+            if "きたえるーむ" in sel_name:
+                return lat, lon
+        # その他の訪問先は名前で検索
+        elif sel_name in location_name or location_name in sel_name:
+            return lat, lon
+    return None, None
+
+
+def build_nav_links(timetable_df, visit_df, name_col):
+    """1日分のタイムテーブルからナビリンク（Markdown）のリストを作成"""
+    links = []
+    # タイムテーブルの順番通りにナビリンクを作成
+    prev_lat = O2_HONSHA["lat"]
+    prev_lon = O2_HONSHA["lon"]
+
+    for row in timetable_df.to_dict(orient="records"):
+        location_name = row.get("場所名", "")
+        order = row.get("順番", "")
+
+        # 昼食休憩の場合は周辺検索リンク
+        if order == "🍽️" or "昼食" in str(location_name):
+            lunch_search_url = f"https://www.google.com/maps/search/食事/@{prev_lat},{prev_lon},15z"
+            links.append(f"**🍽️ 昼食休憩** - [🔍 周辺のお店を検索]({lunch_search_url})")
+            continue
+
+        lat, lon = find_nav_coordinates(location_name, visit_df, name_col)
+        if lat is not None and lon is not None:
+            nav_url = f"https://www.google.com/maps/dir/?api=1&destination={lat},{lon}&travelmode=driving"
+            links.append(f"**{order}. {location_name}** - [📍 ナビを開く]({nav_url})")
+            prev_lat, prev_lon = lat, lon
+        else:
+            # 座標が見つからない場合は表示のみ
+            links.append(f"**{order}. {location_name}**")
+    return links
+
+
+def build_result_view(day_routes, num_days, visit_df, time_matrix, name_col, api_key, site_table):
+    """結果表示に使うタイムテーブル・カレンダーテキスト・CSV・ナビリンクをまとめて作成
+
+    Returns:
+        dict: {"timetables": [(日番号, タイムテーブル, メトリクス), ...], "calendar_texts",
+               "total_travel_seconds", "total_stay_minutes", "timetables_for_save", "csv_data", "nav_links"}
+    """
+    def build_day(day_num, restaurants_by_cell=None):
+        return create_day_timetable(
+            day_num, day_routes[day_num - 1], visit_df, time_matrix,
+            o2_idx=0, shacho_idx=1, name_col=name_col,
+            restaurants_by_cell=restaurants_by_cell, site_table=site_table
+        )
+
+    day_results = {
+        day_num: build_day(day_num)
+        for day_num in range(1, num_days + 1)
+        if day_num - 1 < len(day_routes) and day_routes[day_num - 1]
+    }
+
+    # 昼食のお店は全日分の地点をまとめて先に取得し、該当する日だけ作り直す
+    lunch_days = [day_num for day_num, (_, _, metrics) in day_results.items() if metrics["lunch_point"]]
+    if api_key and lunch_days:
+        restaurants_by_cell = prefetch_nearby_restaurants(
+            [day_results[day_num][2]["lunch_point"] for day_num in lunch_days], api_key
+        )
+        for day_num in lunch_days:
+            if lookup_nearby_restaurants(restaurants_by_cell, *day_results[day_num][2]["lunch_point"]):
+                day_results[day_num] = build_day(day_num, restaurants_by_cell)
+
+    total_travel_seconds_all = 0
+    total_stay_minutes_all = 0
+    all_calendar_text = []
+    all_timetables = []
+
+    for day_num, (timetable_df, calendar_text, metrics) in day_results.items():
+        total_travel_seconds_all += metrics["total_travel_seconds"]
+        total_stay_minutes_all += metrics["total_stay_minutes"]
+        all_calendar_text.append(calendar_text)
+        all_timetables.append((day_num, timetable_df, metrics))
+
+    # 保存機能用（route_result["timetables"] に入れる形式）
+    timetables_for_save = []
+    for day_num, timetable_df, metrics in all_timetables:
+        timetables_for_save.append({
+            "day_num": day_num,
+            "timetable": timetable_df.to_dict(orient="records"),
+            "metrics": {
+                "total_travel_seconds": metrics["total_travel_seconds"],
+                "total_stay_minutes": metrics["total_stay_minutes"]
+            }
+        })
+
+    csv_data = None
+    if all_timetables:
+        all_data = []
+        for day_num, timetable_df, _ in all_timetables:
+            timetable_df = timetable_df.copy()
+            timetable_df.insert(0, "日程", f"Day {day_num}")
+            all_data.append(timetable_df)
+        csv_data = pd.concat(all_data, ignore_index=True).to_csv(index=False, encoding="utf-8-sig")
+
+    return {
+        "timetables": all_timetables,
+        "calendar_texts": all_calendar_text,
+        "total_travel_seconds": total_travel_seconds_all,
+        "total_stay_minutes": total_stay_minutes_all,
+        "timetables_for_save": timetables_for_save,
+        "csv_data": csv_data,
+        "nav_links": {
+            day_num: build_nav_links(timetable_df, visit_df, name_col)
+            for day_num, timetable_df, _ in all_timetables
+        },
+    }
+
+
+# ========================================
+# 結果地図
+# ========================================
+
+def simplify_polyline(points, tolerance):
+    """Douglas–Peucker法でポリラインの点を間引く
+
+    経度は平均緯度の縮尺で補正した平面近似で距離を測る。
+
+    Args:
+        points: [(緯度, 経度), ...]
+        tolerance: 許容する線からのずれ（度）
+
+    Returns:
+        間引き後の [(緯度, 経度), ...]（始点・終点は必ず残す）
+    """
+    if len(points) <= 2:
+        return [tuple(point) for point in points]
+
+    coords = np.asarray(points, dtype=np.float64)
+    xy = np.column_stack([coords[:, 1] * math.cos(math.radians(coords[:, 0].mean())), coords[:, 0]])
+    keep = np.zeros(len(xy), dtype=bool)
+    keep[0] = keep[-1] = True
+
+    stack = [(0, len(xy) - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        segment = xy[end] - xy[start]
+        offsets = xy[start + 1:end] - xy[start]
+        segment_length = math.hypot(segment[0], segment[1])
+        if segment_length == 0:
+            distances = np.hypot(offsets[:, 0], offsets[:, 1])
+        else:
+            distances = np.abs(segment[0] * offsets[:, 1] - segment[1] * offsets[:, 0]) / segment_length
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            split = start + 1 + farthest
+            keep[split] = True
+            stack.append((start, split))
+            stack.append((split, end))
+
+    return [tuple(point) for point in coords[keep]]
+
+
+def build_day_route_geojson(day_num, route_points, stops):
+    """1日分のルート線と訪問先をGeoJSONのFeatureCollectionにまとめる
+
+    Args:
+        day_num: 日番号
+        route_points: ルート形状 [(緯度, 経度), ...]（Noneの場合は線なし）
+        stops: 訪問先 [(緯度, 経度, 名前), ...]（訪問順）
+    """
+    digits = MAP_COORD_DECIMALS
+    features = []
+    if route_points:
+        tolerance = 360 / (256 * 2 ** MAP_SIMPLIFY_ZOOM)
+        features.append({
+            "type": "Feature",
+            "geometry": {
+                "type": "LineString",
+                "coordinates": [
+                    [round(lon, digits), round(lat, digits)]
+                    for lat, lon in simplify_polyline(route_points, tolerance)
+                ],
+            },
+            "properties": {"day": day_num},
+        })
+    for order, (lat, lon, name) in enumerate(stops, start=1):
+        features.append({
+            "type": "Feature",
+            "geometry": {"type": "Point", "coordinates": [round(float(lon), digits), round(float(lat), digits)]},
+            "properties": {"day": day_num, "order": order, "label": f"Day{day_num}-{order}: {name}"},
+        })
+    return {"type": "FeatureCollection", "features": features}
+
+
+# 訪問先の番号を丸印の上に常に表示し、クリックで名前を表示
+ROUTE_STOP_ON_EACH_FEATURE = """
+function(feature, layer) {
+    if (feature.geometry.type === "Point") {
+        layer.bindTooltip(String(feature.properties.order),
+                          {permanent: true, direction: "center", className: "route-stop-label"});
+        layer.bindPopup(feature.properties.label);
+    }
+}
+"""
+
+ROUTE_STOP_LABEL_CSS = """
+<style>
+.route-stop-label {background: transparent; border: 0; box-shadow: none; padding: 0;
+                   color: white; font-size: 9pt; font-weight: bold;}
+.route-stop-label:before {display: none;}
+</style>
+"""
+
+
+def build_result_map(day_routes, visit_df, point_names, api_key):
+    """全日程のルート地図を作成（1日ごとに1つのGeoJSONレイヤー）
+
+    Returns:
+        (地図, 全日のルート形状を取得できたか)
+    """
+    all_lats = [O2_HONSHA["lat"], SHACHO_HOME["lat"]] + visit_df["lat"].tolist()
+    all_lons = [O2_HONSHA["lon"], SHACHO_HOME["lon"]] + visit_df["lon"].tolist()
+    center_lat = sum(all_lats) / len(all_lats)
+    center_lon = sum(all_lons) / len(all_lons)
+
+    m = folium.Map(location=[center_lat, center_lon], zoom_start=9)
+    m.get_root().header.add_child(folium.Element(ROUTE_STOP_LABEL_CSS))
+
+    folium.Marker(
+        location=[O2_HONSHA["lat"], O2_HONSHA["lon"]],
+        popup=f"🏢 {O2_HONSHA['name']}",
+        icon=folium.Icon(color="green")
+    ).add_to(m)
+
+    folium.Marker(
+        location=[SHACHO_HOME["lat"], SHACHO_HOME["lon"]],
+        popup=f"🏠 {SHACHO_HOME['name']}",
+        icon=folium.Icon(color="purple")
+    ).add_to(m)
+
+    lats = visit_df["lat"].to_numpy()
+    lons = visit_df["lon"].to_numpy()
+    all_routes_found = True
+    for day_idx, visit_indices in enumerate(day_routes):
+        if not visit_indices:
+            continue
+
+        color = ROUTE_COLORS[day_idx % len(ROUTE_COLORS)]
+        day_num = day_idx + 1
+
+        # ルート形状（1日分を経由地つきの1リクエストで取得）
+        poly, _ = get_day_route_polyline(make_day_route_stops(visit_indices, visit_df), api_key)
+        all_routes_found = all_routes_found and bool(poly)
+        stops = [(lats[idx], lons[idx], point_names[idx]) for idx in visit_indices]
+
+        folium.GeoJson(
+            build_day_route_geojson(day_num, poly, stops),
+            name=f"Day {day_num}",
+            style_function=lambda feature, color=color: (
+                {"color": color, "weight": 3, "opacity": 0.7}
+                if feature["geometry"]["type"] == "LineString"
+                else {"color": "white", "weight": 1, "fill": True, "fillColor": color, "fillOpacity": 1}
+            ),
+            marker=folium.CircleMarker(radius=11),
+            on_each_feature=folium.JsCode(ROUTE_STOP_ON_EACH_FEATURE),
+        ).add_to(m)
+
+    return m, all_routes_found
+
+
+def make_result_map_fingerprint(day_routes, visit_df, point_names):
+    """地図の内容（日程・座標・名前）が同じかどうかを判定するためのハッシュ"""
+    content = json.dumps({
+        "day_routes": [[int(idx) for idx in route] for route in day_routes],
+        "lat": visit_df["lat"].round(MAP_COORD_DECIMALS).tolist(),
+        "lon": visit_df["lon"].round(MAP_COORD_DECIMALS).tolist(),
+        "names": [str(name) for name in point_names],
+    }, ensure_ascii=False)
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
 # ========================================
 # メインアプリケーション
 # ========================================
@@ -2209,15 +4692,30 @@ st.sidebar.markdown("---")
 
 # 移動時間バイアス表示
 st.sidebar.subheader("🚗 移動時間設定")
-current_month = datetime.now().month
-is_winter = current_month in WINTER_MONTHS
-bias = get_travel_time_bias()
-bias_percent = int((bias - 1) * 100)
+# 行列はバイアス適用前の値で保持しているため、切り替えても再取得は不要
+travel_bias_mode = st.sidebar.selectbox(
+    "移動時間バイアス",
+    options=list(TRAVEL_BIAS_MODES.keys()),
+    format_func=lambda mode: TRAVEL_BIAS_MODES[mode],
+    key="travel_bias_mode"
+)
+bias = get_travel_time_bias(travel_bias_mode)
+is_winter = bias == TRAVEL_TIME_BIAS_WINTER
+bias_percent = int(round((bias - 1) * 100))
 
 if is_winter:
-    st.sidebar.warning(f"❄️ **冬季モード適用中**\n移動時間 +{bias_percent}%（12月〜3月）")
+    season_info = "（12月〜3月）" if travel_bias_mode == "auto" else ""
+    st.sidebar.warning(f"❄️ **冬季モード適用中**\n移動時間 +{bias_percent}%{season_info}")
 else:
-    st.sidebar.info(f"☀️ **通常モード**\n移動時間 +{int((TRAVEL_TIME_BIAS_BASE - 1) * 100)}%")
+    st.sidebar.info(f"☀️ **通常モード**\n移動時間 +{bias_percent}%")
+
+# 最適化の探索時間（小規模は厳密解、中規模は改善が止まったら打ち切り）
+solver_budget_mode = st.sidebar.selectbox(
+    "最適化の探索時間",
+    options=list(SOLVER_BUDGET_MODES.keys()),
+    format_func=lambda mode: SOLVER_BUDGET_MODES[mode],
+    key="solver_budget_mode"
+)
 
 st.sidebar.markdown("---")
 
@@ -2250,6 +4748,7 @@ st.sidebar.subheader("💾 保存・読み込み")
 supabase_client = get_supabase_client()
 if supabase_client:
     st.sidebar.success("✅ DB接続済み")
+    resume_supabase_writes()
 
     # スケジュール保存
     st.sidebar.markdown("**📁 スケジュールを保存**")
@@ -2314,8 +4813,16 @@ if supabase_client:
             optimize_mode = route_result.get("optimize_mode", "distance") if route_result else "distance"
             timetables = route_result.get("timetables") if route_result else None
             calendar_texts = route_result.get("calendar_texts") if route_result else None
+            # 行列も保存して、読み込み時の再計算（API呼び出し）を省く
+            travel_matrices = None
+            if route_result and route_result.get("full_time_matrix_raw") is not None \
+                    and route_result.get("full_dist_matrix") is not None:
+                travel_matrices = pack_travel_matrices(
+                    route_result["full_time_matrix_raw"], route_result["full_dist_matrix"]
+                )
 
-            sch_id, err = save_schedule(
+            # 書き込みキューに積むだけで戻る（Supabaseへの送信・再送は裏のスレッドで行う）
+            job_id, err = enqueue_supabase_write("schedule", make_schedule_row(
                 schedule_name_to_save,
                 current_selection,
                 result_num_days,
@@ -2323,23 +4830,72 @@ if supabase_client:
                 selected_df,
                 optimize_mode,
                 timetables,
-                calendar_texts
-            )
+                calendar_texts,
+                travel_matrices
+            ))
             if err:
                 st.sidebar.error(f"保存失敗: {err}")
             else:
-                st.sidebar.success("✅ 保存しました")
+                st.session_state.setdefault("supabase_write_jobs", []).append(job_id)
             # フラグをクリア
             st.session_state.save_pending = False
         else:
             st.sidebar.warning("保存名と訪問先を入力してください")
             st.session_state.save_pending = False
 
+    # 書き込みキューの状態（完了は1回だけ表示、失敗は再送ボタン付きで残す）
+    write_job_ids = st.session_state.get("supabase_write_jobs", [])
+    if write_job_ids:
+        write_jobs = load_supabase_write_jobs(write_job_ids)
+        remaining_job_ids = []
+        for job_id in write_job_ids:
+            job = write_jobs.get(job_id)
+            if job is None:
+                continue
+            label = "保存" if job["kind"] == "schedule" else "履歴の記録"
+            if job["status"] == "done":
+                st.sidebar.success(f"✅ {label}が完了しました")
+                continue
+            remaining_job_ids.append(job_id)
+            if job["status"] == "failed":
+                st.sidebar.error(f"{label}に失敗しました: {job['last_error']}")
+                if st.sidebar.button("🔁 再送", key=f"btn_retry_write_{job_id}", use_container_width=True):
+                    retry_supabase_write(job_id)
+                    st.rerun()
+            elif job["attempts"] > 0:
+                st.sidebar.warning(f"⏳ {label}を再送待ち（{job['attempts']}回失敗: {job['last_error']}）")
+            else:
+                st.sidebar.info(f"⏳ {label}を送信中...")
+        st.session_state.supabase_write_jobs = remaining_job_ids
+        if any(write_jobs[job_id]["status"] == "pending" for job_id in remaining_job_ids):
+            if st.sidebar.button("🔄 送信状況を更新", key="btn_refresh_write_jobs", use_container_width=True):
+                st.rerun()
+
     st.sidebar.markdown("---")
 
     # スケジュール読み込み
     st.sidebar.markdown("**📂 スケジュールを読み込み**")
-    schedules, err = load_schedules()
+    schedule_search = st.sidebar.text_input(
+        "保存名で検索", placeholder="前方一致（例：12月）", key="schedule_search"
+    ).strip()
+    # 検索条件が変わったら先頭ページに戻す（カーソルは表示中のページまでのスタック）
+    if st.session_state.get("schedule_list_search") != schedule_search:
+        st.session_state.schedule_list_search = schedule_search
+        st.session_state.schedule_list_cursors = [None]
+    schedule_list_cursors = st.session_state.setdefault("schedule_list_cursors", [None])
+    schedules, next_schedule_cursor, err = load_schedules(schedule_search, schedule_list_cursors[-1])
+
+    if len(schedule_list_cursors) > 1 or next_schedule_cursor:
+        col_prev_page, col_next_page = st.sidebar.columns(2)
+        with col_prev_page:
+            if len(schedule_list_cursors) > 1 and st.button("◀ 前へ", key="btn_schedule_prev_page", use_container_width=True):
+                schedule_list_cursors.pop()
+                st.rerun()
+        with col_next_page:
+            if next_schedule_cursor and st.button("次へ ▶", key="btn_schedule_next_page", use_container_width=True):
+                schedule_list_cursors.append(next_schedule_cursor)
+                st.rerun()
+
     if schedules:
         schedule_options = {f"{s['name']} ({s['created_at'][:10]})": s['id'] for s in schedules}
         selected_sch = st.sidebar.selectbox("選択", options=[""] + list(schedule_options.keys()), key="load_schedule")
@@ -2348,24 +4904,36 @@ if supabase_client:
             sch_id = schedule_options[selected_sch]
             sch_data, err = load_schedule_by_id(sch_id)
             if sch_data:
+                matrix_restored = False
+                loaded_df, loaded_timetables = unpack_schedule_plan(sch_data)
                 # 計算結果があれば復元
-                if sch_data.get('day_routes') and sch_data.get('selected_df'):
-                    loaded_df = pd.DataFrame(sch_data['selected_df'])
+                if sch_data.get('day_routes') and loaded_df is not None:
+                    # 保存した行列が訪問先と一致すれば、そのまま使う（再構築しない）
+                    loaded_time_matrix, loaded_dist_matrix = unpack_travel_matrices(
+                        sch_data.get('travel_matrices'), schedule_matrix_locations(loaded_df)
+                    )
+                    matrix_restored = loaded_time_matrix is not None
                     st.session_state.route_result = {
                         "day_routes": sch_data['day_routes'],
                         "selected_df": loaded_df,
                         "num_days": sch_data['num_days'],
                         "optimize_mode": sch_data.get('optimize_mode', 'distance'),
                         "name_col": "name" if "name" in loaded_df.columns else loaded_df.columns[0] if len(loaded_df.columns) > 0 else None,
-                        "timetables": sch_data.get('timetables'),
+                        "timetables": loaded_timetables,
                         "calendar_texts": sch_data.get('calendar_texts'),
-                        "needs_matrix_rebuild": True  # 読み込み時はマトリクス再構築が必要
+                        "full_time_matrix_raw": loaded_time_matrix,
+                        "full_dist_matrix": loaded_dist_matrix,
+                        "travel_bias": bias if matrix_restored else None,
+                        "needs_matrix_rebuild": not matrix_restored  # 行列が保存されていない場合は再構築が必要
                     }
                 # 選択状態を復元
                 if sch_data.get('selected_points'):
                     st.session_state.loaded_selection = sch_data
                     st.session_state.restore_selection_pending = True  # 選択復元フラグ
-                st.sidebar.success(f"✅ 読み込みました（マトリクス再構築中...）")
+                if matrix_restored:
+                    st.sidebar.success("✅ 読み込みました")
+                else:
+                    st.sidebar.success(f"✅ 読み込みました（マトリクス再構築中...）")
                 st.rerun()
         if selected_sch and st.sidebar.button("🗑️ 削除", key="btn_del_schedule", use_container_width=True):
             sch_id = schedule_options[selected_sch]
@@ -2397,11 +4965,12 @@ if supabase_client:
         exec_date = st.date_input("実行日", key="history_date")
         exec_notes = st.text_input("メモ", placeholder="変更点など", key="history_notes")
         if st.button("📝 記録", key="btn_save_history", use_container_width=True):
-            h_id, err = save_history(str(exec_date), None, exec_notes)
+            job_id, err = enqueue_supabase_write("history", make_history_row(str(exec_date), None, exec_notes))
             if err:
                 st.error(f"失敗: {err}")
             else:
-                st.success("記録しました")
+                st.session_state.setdefault("supabase_write_jobs", []).append(job_id)
+                st.success("記録を受け付けました")
 
 else:
     st.sidebar.info("💡 Supabase設定で保存機能が有効になります")
@@ -2419,10 +4988,11 @@ if "route_result" not in st.session_state:
 # ========================================
 
 map_df = None
+map_content_hash = None
 
 try:
     with st.spinner("マイマップからデータを取得中..."):
-        df, error = fetch_data_from_mymap(DEFAULT_MAP_ID)
+        df, map_content_hash, error = fetch_data_from_mymap(DEFAULT_MAP_ID)
 
     if error:
         st.error(f"❌ Googleマイマップを読み込めませんでした。\n\nマップIDまたは公開設定を確認してください。\n\n**エラー詳細:** {error}")
@@ -2430,6 +5000,25 @@ try:
     elif df is not None and len(df) > 0:
         st.success(f"✅ {len(df)}件のデータを取得しました")
         map_df = df
+
+        # 裏での更新確認でマイマップが変わっていたら、変更内容を1回だけ表示
+        mymap_source = load_mymap_source(DEFAULT_MAP_ID)
+        if mymap_source:
+            seen_revision = st.session_state.get("mymap_revision")
+            mymap_diff = mymap_source["last_diff"]
+            if seen_revision is not None and seen_revision != mymap_source["revision"] and mymap_diff:
+                st.info(
+                    f"🗺️ マイマップが更新されました（追加 {len(mymap_diff['added'])}件・"
+                    f"削除 {len(mymap_diff['removed'])}件・内容変更 {len(mymap_diff['changed'])}件）"
+                )
+                planned_names = set((st.session_state.route_result or {}).get("selected_point_names", []))
+                affected = planned_names & set(mymap_diff["removed"])
+                if affected:
+                    st.warning(
+                        "⚠️ 計算済みのルートに、削除・移動された地点が含まれています: "
+                        + "、".join(sorted(affected)) + "（再計算をおすすめします）"
+                    )
+            st.session_state.mymap_revision = mymap_source["revision"]
     else:
         st.error("❌ データが取得できませんでした。マイマップの公開設定を確認してください。")
         st.stop()
@@ -2443,19 +5032,14 @@ except Exception as e:
 # ========================================
 
 if map_df is not None and len(map_df) > 0:
-    name_col = get_name_column(map_df)
-    map_df = override_coordinates(map_df, name_col)
-
-    # レイヤーカラムがない場合は追加
-    if "layer" not in map_df.columns:
-        map_df["layer"] = "その他"
-
-    # レイヤー名を正規化
-    map_df["layer"] = map_df["layer"].fillna("その他").replace("", "その他")
-    map_df["layer_normalized"] = map_df["layer"].apply(normalize_text)
-
-    # 対象レイヤーのデータのみ抽出
-    existing_layers = map_df["layer_normalized"].unique().tolist()
+    # 座標上書き・レイヤー正規化・対象レイヤーの抽出（KMLが変わらない間は前回の結果を使う）
+    if map_content_hash:
+        map_data = preprocess_map_data_cached(map_content_hash, map_df)
+    else:
+        map_data = preprocess_map_data(map_df)
+    name_col = map_data["name_col"]
+    map_df = map_data["map_df"]
+    existing_layers = map_data["existing_layers"]
 
     # 不足レイヤーの警告（O2/02は同一扱い）
     def check_layer_exists(target, existing):
@@ -2475,19 +5059,6 @@ if map_df is not None and len(map_df) > 0:
     if missing_layers:
         st.warning(f"⚠️ 以下のレイヤーがデータ内に見つかりませんでした: {', '.join(missing_layers)}")
 
-    # 対象レイヤーのデータをフィルタ
-    def is_target_layer(layer_normalized):
-        for target in TARGET_LAYERS_NORMALIZED:
-            if target in layer_normalized:
-                return True
-        return False
-
-    filtered_df = map_df[map_df["layer_normalized"].apply(is_target_layer)].copy()
-
-    # 社長宅を除外
-    if name_col:
-        filtered_df = filtered_df[~filtered_df[name_col].str.contains("社長宅", na=False)]
-
     # ========================================
     # 訪問先選択UI
     # ========================================
@@ -2496,24 +5067,9 @@ if map_df is not None and len(map_df) > 0:
 
     selected_rows_list = []
 
-    # UI表示用：実際のレイヤー名でグループ化（O2/02の重複を避ける）
-    displayed_layers = set()
-
-    for target in TARGET_LAYERS_NORMALIZED:
-        layer_df = filtered_df[filtered_df["layer_normalized"].str.contains(target, na=False)].copy()
-
-        if len(layer_df) == 0:
-            continue
-
-        # 実際のレイヤー名を取得（重複チェック用）
+    # 対象レイヤーごと（実際のレイヤー名でO2/02の重複を除いたもの、場所名順）
+    for target, layer_df in map_data["layer_frames"]:
         actual_layer_name = layer_df["layer"].iloc[0]
-        if actual_layer_name in displayed_layers:
-            continue  # 既に表示済みのレイヤーはスキップ
-        displayed_layers.add(actual_layer_name)
-
-        # 場所名で並び替え（あいうえお順）
-        if name_col and name_col in layer_df.columns:
-            layer_df = layer_df.sort_values(by=name_col, key=lambda x: x.str.lower()).reset_index(drop=True)
 
         # 施工中工事の命名規則チェック
         if target == "施工中工事" and name_col:
@@ -2619,6 +5175,23 @@ if map_df is not None and len(map_df) > 0:
             st.write("")  # スペーサー
             add_btn = st.button("🔍 住所を検索して追加", key="btn_add_manual_visit", use_container_width=True)
 
+        # 計算済みのルートがあれば、全体を再計算せずに最も効率のよい位置へ挿入できる
+        plan_result = st.session_state.get("route_result")
+        can_insert_into_plan = (
+            plan_result is not None
+            and plan_result.get("full_time_matrix_raw") is not None
+            and plan_result.get("full_dist_matrix") is not None
+        )
+        insert_into_plan = st.checkbox(
+            "計算済みのルートに挿入する（他の日程は変更しない）",
+            value=True,
+            disabled=not can_insert_into_plan,
+            key="manual_insert_into_plan"
+        ) and can_insert_into_plan
+
+        if st.session_state.get("manual_insert_message"):
+            st.success(st.session_state.pop("manual_insert_message"))
+
         if add_btn:
             if not manual_name:
                 st.error("場所の名前を入力してください")
@@ -2647,7 +5220,70 @@ if map_df is not None and len(map_df) > 0:
                     }
                     st.session_state.manual_visits.append(new_visit)
                     st.success(f"✅ 「{display_name}」を追加しました（{geo_result['formatted_address']}）")
-                    st.rerun()
+
+                    if insert_into_plan:
+                        plan_df = plan_result["selected_df"]
+                        plan_name_col = plan_result.get("name_col")
+                        plan_locations = [
+                            (O2_HONSHA["lat"], O2_HONSHA["lon"]),
+                            (SHACHO_HOME["lat"], SHACHO_HOME["lon"]),
+                        ] + list(zip(plan_df["lat"], plan_df["lon"]))
+
+                        # 新しい地点との往復区間だけを取得
+                        with st.spinner("計算済みのルートに挿入中..."):
+                            new_time_matrix_raw, new_dist_matrix, extend_error = extend_distance_matrix(
+                                plan_result["full_time_matrix_raw"],
+                                plan_result["full_dist_matrix"],
+                                tuple(plan_locations),
+                                (geo_result["lat"], geo_result["lon"]),
+                                api_key
+                            )
+
+                        if extend_error:
+                            # 訪問先は追加済みなので、全体の再計算時には反映される
+                            st.error(f"❌ ルートへの挿入に失敗しました: {extend_error}")
+                        else:
+                            new_plan_df = pd.concat(
+                                [plan_df, make_manual_visit_row(new_visit, plan_name_col)], ignore_index=True
+                            )
+                            new_site_table = build_site_table(new_plan_df, plan_name_col)
+                            new_day_routes, insertion = find_cheapest_insertion(
+                                plan_result["day_routes"],
+                                len(plan_df),
+                                new_plan_df,
+                                apply_travel_time_bias(new_time_matrix_raw, bias),
+                                o2_idx=0,
+                                shacho_idx=1,
+                                name_col=plan_name_col,
+                                return_deadlines=return_deadline_times,
+                                site_table=new_site_table
+                            )
+
+                            plan_result["day_routes"] = new_day_routes
+                            plan_result["selected_df"] = new_plan_df
+                            plan_result["site_table"] = new_site_table
+                            plan_result["selected_point_names"] = list(plan_result.get("selected_point_names", [])) + [display_name]
+                            plan_result["full_time_matrix_raw"] = new_time_matrix_raw
+                            plan_result["full_dist_matrix"] = new_dist_matrix
+                            # タイムテーブルは次のrerun時に再計算されるので、一旦クリア
+                            plan_result["timetables"] = None
+                            plan_result["calendar_texts"] = None
+                            st.session_state.route_result = plan_result
+
+                            if insertion:
+                                message = (
+                                    f"✅ 「{display_name}」を{insertion['day_idx'] + 1}日目の"
+                                    f"{insertion['position'] + 1}件目に挿入しました"
+                                    f"（移動 +{int(insertion['added_travel_seconds']) // 60}分、"
+                                    f"帰社 {format_time(insertion['end_time'])}）"
+                                )
+                                if not insertion["feasible"]:
+                                    message += " ⚠️ 終了時刻の上限を超えています"
+                                st.session_state.manual_insert_message = message
+
+                            st.rerun()
+                    else:
+                        st.rerun()
 
         # 追加済みの手動訪問先を表示
         if st.session_state.manual_visits:
@@ -2669,15 +5305,7 @@ if map_df is not None and len(map_df) > 0:
     # 手動追加訪問先をselected_dfに統合
     if st.session_state.manual_visits:
         for visit in st.session_state.manual_visits:
-            manual_row = pd.DataFrame([{
-                name_col if name_col else "name": visit["name"],
-                "lat": visit["lat"],
-                "lon": visit["lon"],
-                "layer": "手動追加",
-                "layer_normalized": "手動追加",
-                "description": f"手動追加（{visit['stay_minutes']}分）",
-                "manual_stay_minutes": visit["stay_minutes"]
-            }])
+            manual_row = make_manual_visit_row(visit, name_col)
             selected_df = pd.concat([selected_df, manual_row], ignore_index=True)
             if visit["name"] not in selected_point_names:
                 selected_point_names.append(visit["name"])
@@ -2728,7 +5356,7 @@ if map_df is not None and len(map_df) > 0:
             progress_bar.progress(progress)
             status_text.text(message)
 
-        full_time_matrix, full_dist_matrix, error = create_distance_matrix_google_batched(
+        full_time_matrix_raw, full_dist_matrix, error = create_distance_matrix_google_batched(
             tuple(all_locations), api_key, progress_callback=update_progress
         )
 
@@ -2737,8 +5365,14 @@ if map_df is not None and len(map_df) > 0:
 
         if error:
             st.error(f"❌ Google APIエラー: {error}")
-        elif full_time_matrix:
+        elif full_time_matrix_raw:
+            # バイアスは最適化の直前に適用（行列はバイアス適用前の値で保持）
+            full_time_matrix = apply_travel_time_bias(full_time_matrix_raw, bias)
             mode_label = "移動時間優先" if optimize_mode == "time" else "距離優先"
+            solver_runs = []
+            solve_started_at = time.monotonic()
+            # 訪問先ごとの属性（滞在時間・種別）は最適化の前に1回だけ求める
+            site_table = build_site_table(selected_df, name_col)
             with st.spinner(f"Global TSP & Time Slicing で最適化中（{mode_label}）..."):
                 # 全体TSP → 時間による日程分割（地理的に近い場所は同じ日に）
                 day_routes_converted = global_tsp_time_slice_allocation(
@@ -2749,7 +5383,10 @@ if map_df is not None and len(map_df) > 0:
                     name_col=name_col,
                     num_days=num_days,
                     dist_matrix_all=full_dist_matrix,
-                    optimize_mode=optimize_mode
+                    optimize_mode=optimize_mode,
+                    budget_mode=solver_budget_mode,
+                    solver_stats=solver_runs,
+                    site_table=site_table
                 )
 
                 # Gap Filling最適化：他の日からO2本社・藤沢倉庫を移動
@@ -2759,18 +5396,28 @@ if map_df is not None and len(map_df) > 0:
                     time_matrix_all=full_time_matrix,
                     o2_idx=0,
                     shacho_idx=1,
-                    name_col=name_col
+                    name_col=name_col,
+                    site_table=site_table
                 )
 
             st.session_state.route_result = {
                 "day_routes": day_routes_converted,
-                "full_time_matrix": full_time_matrix,
+                # 自動計算した訪問順序（リセット時の再計算で初期解に使う）
+                "tsp_order": [idx for route in day_routes_converted for idx in route],
+                "full_time_matrix_raw": full_time_matrix_raw,
                 "full_dist_matrix": full_dist_matrix,
+                "travel_bias": bias,
                 "selected_df": selected_df,
+                "site_table": site_table,
                 "selected_point_names": selected_point_names,
                 "name_col": name_col,
                 "num_days": num_days,
-                "optimize_mode": optimize_mode
+                "optimize_mode": optimize_mode,
+                "solver_stats": {
+                    "budget_mode": solver_budget_mode,
+                    "elapsed_seconds": round(time.monotonic() - solve_started_at, 3),
+                    "runs": solver_runs,
+                },
             }
 
     # ========================================
@@ -2780,7 +5427,9 @@ if map_df is not None and len(map_df) > 0:
     if st.session_state.route_result is not None:
         result = st.session_state.route_result
         day_routes = result["day_routes"]
-        full_time_matrix = result.get("full_time_matrix")  # 読み込み時はNoneの場合あり
+        full_time_matrix_raw = result.get("full_time_matrix_raw")  # 読み込み時はNoneの場合あり
+        # 現在のバイアス設定で換算（ルート計算時と異なる場合もAPIの再取得は不要）
+        full_time_matrix = apply_travel_time_bias(full_time_matrix_raw, bias) if full_time_matrix_raw is not None else None
         result_selected_df = result["selected_df"]
         result_point_names = result.get("selected_point_names", result_selected_df[result.get("name_col", "name")].tolist() if result.get("name_col") and result.get("name_col") in result_selected_df.columns else [])
         result_name_col = result.get("name_col")
@@ -2797,32 +5446,29 @@ if map_df is not None and len(map_df) > 0:
         if not result_point_names and result_name_col and result_name_col in result_selected_df.columns:
             result_point_names = result_selected_df[result_name_col].tolist()
 
+        # 訪問先属性テーブル（保存データの読み込み・手動挿入で訪問先が変わった場合は作り直す）
+        result_site_table = result.get("site_table")
+        if result_site_table is None or len(result_site_table) != len(result_selected_df):
+            result_site_table = build_site_table(result_selected_df, result_name_col)
+            st.session_state.route_result["site_table"] = result_site_table
+
         # 読み込みデータでマトリクス再構築が必要な場合
         if full_time_matrix is None and result.get("needs_matrix_rebuild"):
             st.info("📂 保存データを読み込み中... マトリクスを再構築しています")
             with st.spinner("距離・時間マトリクスを再計算中..."):
                 try:
                     # 座標リストを取得（O2本社と社長宅を先頭に追加）
-                    coords_for_matrix = [
-                        (O2_HONSHA["lat"], O2_HONSHA["lon"]),  # index 0: O2本社
-                        (SHACHO_HOME["lat"], SHACHO_HOME["lon"]),  # index 1: 社長宅
-                    ]
-                    for _, row in result_selected_df.iterrows():
-                        lat = row.get("lat") or row.get("latitude") or row.get("緯度")
-                        lng = row.get("lng") or row.get("lon") or row.get("longitude") or row.get("経度")
-                        if lat and lng:
-                            coords_for_matrix.append((float(lat), float(lng)))
-                        else:
-                            coords_for_matrix.append(None)
+                    coords_for_matrix = schedule_matrix_locations(result_selected_df)
 
                     # マトリクス計算
                     if api_key and all(c is not None for c in coords_for_matrix):
-                        full_time_matrix, full_dist_matrix, matrix_error = create_distance_matrix_google_batched(coords_for_matrix, api_key)
+                        full_time_matrix_raw, full_dist_matrix, matrix_error = create_distance_matrix_google_batched(coords_for_matrix, api_key)
                         if matrix_error:
                             st.error(f"マトリクス計算エラー: {matrix_error}")
-                        elif full_time_matrix:
-                            st.session_state.route_result["full_time_matrix"] = full_time_matrix
+                        elif full_time_matrix_raw:
+                            st.session_state.route_result["full_time_matrix_raw"] = full_time_matrix_raw
                             st.session_state.route_result["full_dist_matrix"] = full_dist_matrix
+                            st.session_state.route_result["travel_bias"] = bias
                             st.session_state.route_result["needs_matrix_rebuild"] = False
                             st.session_state.route_result["selected_point_names"] = result_point_names
                             # 古いtimetablesをクリアして再計算させる
@@ -2836,6 +5482,25 @@ if map_df is not None and len(map_df) > 0:
 
         st.success(f"✅ {result_num_days}日間のルートが計算されました！")
 
+        # ルート計算時と現在のバイアス設定が異なる場合の案内
+        result_bias = result.get("travel_bias")
+        if full_time_matrix is not None and result_bias is not None and result_bias != bias:
+            st.info(f"💡 タイムテーブルは現在の移動時間バイアス（+{bias_percent}%）で表示しています。"
+                    f"日程の割り振りはルート計算時（+{int(round((result_bias - 1) * 100))}%）のままです。"
+                    f"「🔄 自動計算結果にリセット」で現在のバイアスで再計算できます（APIの再取得なし）。")
+
+        # 最適化にかかった時間（探索時間の配分の確認用）
+        solver_stats = result.get("solver_stats")
+        if solver_stats:
+            tiers = "・".join(
+                f"{run['nodes']}地点:{run['tier']}" for run in solver_stats.get("runs", [])
+            )
+            st.caption(
+                f"⏱️ 最適化 {solver_stats['elapsed_seconds']:.1f}秒"
+                f"（{SOLVER_BUDGET_MODES.get(solver_stats.get('budget_mode'), '')}"
+                f"{' / ' + tiers if tiers else ''}）"
+            )
+
         # full_time_matrixがない場合（読み込みデータ・マトリクス再構築失敗時）
         if full_time_matrix is None:
             # 保存されているtimetablesとcalendar_textsがあれば表示
@@ -2948,40 +5613,34 @@ if map_df is not None and len(map_df) > 0:
             st.stop()
 
         # 以下はfull_time_matrixがある場合のみ実行
+        # タイムテーブル等は計画（日程・訪問先・行列）が変わったときだけ作り直す
+        # （サイドバーの操作など、計画に関係しないrerunでは前回の結果を使う）
+        plan_fingerprint = make_plan_fingerprint(
+            day_routes, result_selected_df, full_time_matrix,
+            extra=[result_num_days, result_name_col, bool(api_key), datetime.today().date().isoformat()]
+        )
+        result_view_cache = st.session_state.get("result_view_cache")
+        if (not result_view_cache or result_view_cache["fingerprint"] != plan_fingerprint
+                or st.session_state.route_result.get("timetables") is None):
+            result_view_cache = {
+                "fingerprint": plan_fingerprint,
+                "view": build_result_view(
+                    day_routes, result_num_days, result_selected_df, full_time_matrix,
+                    result_name_col, api_key, result_site_table
+                ),
+            }
+            st.session_state.result_view_cache = result_view_cache
+            # タイムテーブルとカレンダーテキストをroute_resultに保存（後で保存機能で使用）
+            st.session_state.route_result["timetables"] = result_view_cache["view"]["timetables_for_save"]
+            st.session_state.route_result["calendar_texts"] = result_view_cache["view"]["calendar_texts"]
+        result_view = result_view_cache["view"]
+
         # メトリクス表示用の集計
         total_locations = len(result_point_names)
-        total_travel_seconds_all = 0
-        total_stay_minutes_all = 0
-        all_calendar_text = []
-        all_timetables = []
-
-        for day_num in range(1, result_num_days + 1):
-            day_idx = day_num - 1
-            visit_indices = day_routes[day_idx] if day_idx < len(day_routes) else []
-
-            if visit_indices:
-                timetable_df, calendar_text, metrics = create_day_timetable(
-                    day_num, visit_indices, result_selected_df, full_time_matrix,
-                    o2_idx=0, shacho_idx=1, name_col=result_name_col, api_key=api_key
-                )
-                total_travel_seconds_all += metrics["total_travel_seconds"]
-                total_stay_minutes_all += metrics["total_stay_minutes"]
-                all_calendar_text.append(calendar_text)
-                all_timetables.append((day_num, timetable_df, metrics))
-
-        # タイムテーブルとカレンダーテキストをroute_resultに保存（後で保存機能で使用）
-        timetables_for_save = []
-        for day_num, timetable_df, metrics in all_timetables:
-            timetables_for_save.append({
-                "day_num": day_num,
-                "timetable": timetable_df.to_dict(orient="records"),
-                "metrics": {
-                    "total_travel_seconds": metrics["total_travel_seconds"],
-                    "total_stay_minutes": metrics["total_stay_minutes"]
-                }
-            })
-        st.session_state.route_result["timetables"] = timetables_for_save
-        st.session_state.route_result["calendar_texts"] = all_calendar_text
+        total_travel_seconds_all = result_view["total_travel_seconds"]
+        total_stay_minutes_all = result_view["total_stay_minutes"]
+        all_calendar_text = result_view["calendar_texts"]
+        all_timetables = result_view["timetables"]
 
         # メトリクス表示
         st.subheader("📊 サマリー")
@@ -3323,6 +5982,10 @@ if map_df is not None and len(map_df) > 0:
             # 再計算（保存された最適化モードを使用）
             saved_optimize_mode = st.session_state.route_result.get("optimize_mode", "time")
             saved_dist_matrix = st.session_state.route_result.get("full_dist_matrix")
+            # 前回の自動計算結果の訪問順序をTSPの初期解にする（手動調整は反映しない）
+            previous_order = st.session_state.route_result.get("tsp_order")
+            solver_runs = []
+            solve_started_at = time.monotonic()
             with st.spinner("ルートを再計算中..."):
                 day_routes_reset = global_tsp_time_slice_allocation(
                     visit_df=result_selected_df,
@@ -3332,7 +5995,11 @@ if map_df is not None and len(map_df) > 0:
                     name_col=result_name_col,
                     num_days=result_num_days,
                     dist_matrix_all=saved_dist_matrix,
-                    optimize_mode=saved_optimize_mode
+                    optimize_mode=saved_optimize_mode,
+                    budget_mode=solver_budget_mode,
+                    solver_stats=solver_runs,
+                    initial_order=previous_order,
+                    site_table=result_site_table
                 )
                 # Gap Filling最適化：他の日からO2本社・藤沢倉庫を移動
                 day_routes_reset = optimize_gap_filling_moves(
@@ -3341,9 +6008,17 @@ if map_df is not None and len(map_df) > 0:
                     time_matrix_all=full_time_matrix,
                     o2_idx=0,
                     shacho_idx=1,
-                    name_col=result_name_col
+                    name_col=result_name_col,
+                    site_table=result_site_table
                 )
             st.session_state.route_result["day_routes"] = day_routes_reset
+            st.session_state.route_result["tsp_order"] = [idx for route in day_routes_reset for idx in route]
+            st.session_state.route_result["travel_bias"] = bias
+            st.session_state.route_result["solver_stats"] = {
+                "budget_mode": solver_budget_mode,
+                "elapsed_seconds": round(time.monotonic() - solve_started_at, 3),
+                "runs": solver_runs,
+            }
             # タイムテーブルは次のrerun時に再計算されるので、一旦クリア
             st.session_state.route_result["timetables"] = None
             st.session_state.route_result["calendar_texts"] = None
@@ -3353,21 +6028,12 @@ if map_df is not None and len(map_df) > 0:
         st.subheader("📋 カレンダー用テキスト（コピー用）")
 
         # CSVダウンロードボタンを小さく右寄せで配置
-        if all_timetables:
-            all_data = []
-            for day_num, timetable_df, _ in all_timetables:
-                timetable_df = timetable_df.copy()
-                timetable_df.insert(0, "日程", f"Day {day_num}")
-                all_data.append(timetable_df)
-
-            combined_df = pd.concat(all_data, ignore_index=True)
-            csv_data = combined_df.to_csv(index=False, encoding="utf-8-sig")
-
+        if result_view["csv_data"] is not None:
             col_text, col_btn = st.columns([4, 1])
             with col_btn:
                 st.download_button(
                     label="📥 CSV",
-                    data=csv_data,
+                    data=result_view["csv_data"],
                     file_name=f"schedule_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
                     mime="text/csv",
                     help="スケジュールをCSVでダウンロード"
@@ -3385,146 +6051,28 @@ if map_df is not None and len(map_df) > 0:
         st.subheader("🚗 ナビで開く（タップで案内開始）")
         st.info("各訪問先をタップするとGoogleマップのナビが起動します")
 
-        for day_num, timetable_df, _ in all_timetables:
+        for day_num, _, _ in all_timetables:
             with st.expander(f"📅 {day_num}日目 のナビリンク", expanded=False):
                 # タイムテーブルの順番通りにナビリンクを表示
-                prev_lat = O2_HONSHA["lat"]
-                prev_lon = O2_HONSHA["lon"]
-
-                for _, row in timetable_df.iterrows():
-                    location_name = row.get("場所名", "")
-                    order = row.get("順番", "")
-
-                    # 昼食休憩の場合は周辺検索リンク
-                    if order == "🍽️" or "昼食" in str(location_name):
-                        lunch_search_url = f"https://www.google.com/maps/search/食事/@{prev_lat},{prev_lon},15z"
-                        st.markdown(f"**🍽️ 昼食休憩** - [🔍 周辺のお店を検索]({lunch_search_url})")
-                    else:
-                        # 通常の訪問先
-                        # 座標を取得（固定ロケーションまたは選択された訪問先から）
-                        lat, lon = None, None
-
-                        # O2本社
-                        if "O2本社" in str(location_name):
-                            lat, lon = O2_HONSHA["lat"], O2_HONSHA["lon"]
-                        # 直樹さん宅
-                        elif "直樹さん宅" in str(location_name):
-                            lat, lon = SHACHO_HOME["lat"], SHACHO_HOME["lon"]
-                        # 藤沢倉庫
-                        elif "藤沢倉庫" in str(location_name):
-                            lat, lon = FUJISAWA_SOUKO["lat"], FUJISAWA_SOUKO["lon"]
-                        # きたえるーむ
-                        elif "きたえるーむ" in str(location_name):
-                            # きたえるーむは選択された訪問先から探す
-                            for idx, sel_row in result_selected_df.iterrows():
-                                sel_name = sel_row[result_name_col] if result_name_col else ""
-                                if "きたえるーむ" in str(sel_name):
-                                    lat, lon = sel_row["lat"], sel_row["lon"]
-                                    break
-                        else:
-                            # その他の訪問先は名前で検索
-                            for idx, sel_row in result_selected_df.iterrows():
-                                sel_name = sel_row[result_name_col] if result_name_col else ""
-                                if str(sel_name) in str(location_name) or str(location_name) in str(sel_name):
-                                    lat, lon = sel_row["lat"], sel_row["lon"]
-                                    break
-
-                        if lat is not None and lon is not None:
-                            nav_url = f"https://www.google.com/maps/dir/?api=1&destination={lat},{lon}&travelmode=driving"
-                            st.markdown(f"**{order}. {location_name}** - [📍 ナビを開く]({nav_url})")
-                            prev_lat, prev_lon = lat, lon
-                        else:
-                            # 座標が見つからない場合は表示のみ
-                            st.markdown(f"**{order}. {location_name}**")
+                for nav_link in result_view["nav_links"][day_num]:
+                    st.markdown(nav_link)
 
         # 地図表示
         st.subheader("🗺️ 全日程ルート地図")
 
-        all_lats = [O2_HONSHA["lat"], SHACHO_HOME["lat"]] + result_selected_df["lat"].tolist()
-        all_lons = [O2_HONSHA["lon"], SHACHO_HOME["lon"]] + result_selected_df["lon"].tolist()
-        center_lat = sum(all_lats) / len(all_lats)
-        center_lon = sum(all_lons) / len(all_lons)
-
-        m = folium.Map(location=[center_lat, center_lon], zoom_start=9)
-
-        folium.Marker(
-            location=[O2_HONSHA["lat"], O2_HONSHA["lon"]],
-            popup=f"🏢 {O2_HONSHA['name']}",
-            icon=folium.Icon(color="green")
-        ).add_to(m)
-
-        folium.Marker(
-            location=[SHACHO_HOME["lat"], SHACHO_HOME["lon"]],
-            popup=f"🏠 {SHACHO_HOME['name']}",
-            icon=folium.Icon(color="purple")
-        ).add_to(m)
-
-        for day_idx, visit_indices in enumerate(day_routes):
-            if not visit_indices:
-                continue
-
-            color = ROUTE_COLORS[day_idx % len(ROUTE_COLORS)]
-            day_num = day_idx + 1
-
-            # ルート描画
-            poly, _ = get_route_polyline(
-                (O2_HONSHA["lat"], O2_HONSHA["lon"]),
-                (SHACHO_HOME["lat"], SHACHO_HOME["lon"]),
-                api_key
-            )
-            if poly:
-                folium.PolyLine(locations=poly, color=color, weight=3, opacity=0.7).add_to(m)
-
-            if visit_indices:
-                first_visit = result_selected_df.iloc[visit_indices[0]]
-                poly, _ = get_route_polyline(
-                    (SHACHO_HOME["lat"], SHACHO_HOME["lon"]),
-                    (first_visit["lat"], first_visit["lon"]),
-                    api_key
-                )
-                if poly:
-                    folium.PolyLine(locations=poly, color=color, weight=3, opacity=0.7).add_to(m)
-
-                for i in range(len(visit_indices) - 1):
-                    from_row = result_selected_df.iloc[visit_indices[i]]
-                    to_row = result_selected_df.iloc[visit_indices[i + 1]]
-                    poly, _ = get_route_polyline(
-                        (from_row["lat"], from_row["lon"]),
-                        (to_row["lat"], to_row["lon"]),
-                        api_key
-                    )
-                    if poly:
-                        folium.PolyLine(locations=poly, color=color, weight=3, opacity=0.7).add_to(m)
-
-                last_visit = result_selected_df.iloc[visit_indices[-1]]
-                poly, _ = get_route_polyline(
-                    (last_visit["lat"], last_visit["lon"]),
-                    (SHACHO_HOME["lat"], SHACHO_HOME["lon"]),
-                    api_key
-                )
-                if poly:
-                    folium.PolyLine(locations=poly, color=color, weight=3, opacity=0.7).add_to(m)
-
-            poly, _ = get_route_polyline(
-                (SHACHO_HOME["lat"], SHACHO_HOME["lon"]),
-                (O2_HONSHA["lat"], O2_HONSHA["lon"]),
-                api_key
+        # 日程・座標が変わったときだけ地図を作り直す（他のウィジェット操作によるrerunでは使い回す）
+        map_fingerprint = make_result_map_fingerprint(day_routes, result_selected_df, result_point_names)
+        result_map_cache = st.session_state.get("result_map_cache")
+        if not result_map_cache or result_map_cache["fingerprint"] != map_fingerprint:
+            result_map, all_routes_found = build_result_map(
+                day_routes, result_selected_df, result_point_names, api_key
             )
-            if poly:
-                folium.PolyLine(locations=poly, color=color, weight=3, opacity=0.7).add_to(m)
-
-            for order, visit_idx in enumerate(visit_indices):
-                lat = result_selected_df.iloc[visit_idx]["lat"]
-                lon = result_selected_df.iloc[visit_idx]["lon"]
-                point_name = result_point_names[visit_idx]
-
-                folium.Marker(
-                    location=[lat, lon],
-                    popup=f"Day{day_num}-{order+1}: {point_name}",
-                    icon=folium.DivIcon(html=f'<div style="font-size: 9pt; color: white; background-color: {color}; border-radius: 50%; width: 22px; height: 22px; text-align: center; line-height: 22px;">{order+1}</div>')
-                ).add_to(m)
+            result_map_cache = {"fingerprint": map_fingerprint, "map": result_map}
+            # ルート形状の取得に失敗した日がある場合は、次のrerunで取り直す
+            st.session_state.result_map_cache = result_map_cache if all_routes_found else None
 
-        st_folium(m, width=None, height=700, key="result_map")
+        # 地図の操作（移動・拡大）でrerunしないよう、戻り値は受け取らない
+        st_folium(result_map_cache["map"], width=None, height=700, key="result_map", returned_objects=[])
 
         # 凡例
         st.write("**凡例:**")
@@ -0,0 +1,139 @@
+"""OR-Toolsで1つの探索戦略を解く処理（TSPの戦略並列化で子プロセスから呼ばれる）
+
+子プロセスは forkserver / spawn で起動するため、app.py（Streamlitの画面描画を含む）ではなく
+このモジュールを import して関数を解決する。
+"""
+import time
+
+from ortools.constraint_solver import routing_enums_pb2
+from ortools.constraint_solver import pywrapcp
+
+
+def register_transit_matrix(routing, manager, matrix):
+    """遷移コスト行列をOR-Toolsに登録（探索中のコスト評価をC++側で完結させる）
+
+    RegisterTransitMatrix がない古いOR-Toolsでは、平坦化した配列を参照する
+    コールバックで代替する（IndexToNode も事前計算しておく）。
+
+    Args:
+        routing: RoutingModel
+        manager: RoutingIndexManager
+        matrix: ノード番号で引くコスト行列（入れ子リスト）
+
+    Returns:
+        登録したコールバックのインデックス
+    """
+    if hasattr(routing, "RegisterTransitMatrix"):
+        return routing.RegisterTransitMatrix(matrix)
+
+    n = len(matrix)
+    flat = [value for row in matrix for value in row]
+    node_of_index = [manager.IndexToNode(index) for index in range(routing.Size() + routing.vehicles())]
+
+    def transit_callback(from_index, to_index):
+        return flat[node_of_index[from_index] * n + node_of_index[to_index]]
+
+    return routing.RegisterTransitCallback(transit_callback)
+
+
+def add_search_cutoff_callback(routing, no_improvement_seconds=None, stop_event=None):
+    """探索の打ち切り条件を解発見時のコールバックとして登録（見つかった最良解は保持される）
+
+    Args:
+        routing: RoutingModel
+        no_improvement_seconds: この秒数だけ目的関数が改善しなければ打ち切る（Noneなら無効）
+        stop_event: セットされたら打ち切るイベント（Noneなら無効）
+    """
+    if no_improvement_seconds is None and stop_event is None:
+        return
+
+    state = {"best": None, "improved_at": time.monotonic()}
+
+    def on_solution():
+        if stop_event is not None and stop_event.is_set():
+            routing.solver().FinishCurrentSearch()
+            return
+        if no_improvement_seconds is None:
+            return
+
+        cost = routing.CostVar().Value()
+        now = time.monotonic()
+        if state["best"] is None or cost < state["best"]:
+            state["best"] = cost
+            state["improved_at"] = now
+        elif now - state["improved_at"] >= no_improvement_seconds:
+            routing.solver().FinishCurrentSearch()
+
+    routing.AddAtSolutionCallback(on_solution)
+
+
+def solve_tsp_with_strategy(cost_matrix, depot_idx, first_strategy, local_search,
+                            time_limit_seconds, stop_event=None, no_improvement_seconds=None,
+                            initial_route=None):
+    """1つの探索戦略でTSPを解く（並列実行時は子プロセスで呼ばれる）
+
+    Args:
+        cost_matrix: コスト行列（入れ子リスト）
+        depot_idx: 出発地点のインデックス
+        first_strategy: 初期解の戦略名（FirstSolutionStrategy の名前）
+        local_search: 局所探索の戦略名（LocalSearchMetaheuristic の名前）
+        time_limit_seconds: 探索時間の上限
+        stop_event: セットされたら探索を打ち切るイベント（Noneなら打ち切らない）
+        no_improvement_seconds: この秒数だけ改善がなければ打ち切る（Noneなら時間上限まで探索）
+        initial_route: 初期解とする巡回順序（depotを除く）。指定時は first_strategy を使わず
+                       この順序から局所探索を始める
+
+    Returns:
+        (総コスト, depotを除く巡回順序) / 解なしの場合は None
+    """
+    n = len(cost_matrix)
+    manager = pywrapcp.RoutingIndexManager(n, 1, depot_idx)
+    routing = pywrapcp.RoutingModel(manager)
+
+    transit_callback_index = register_transit_matrix(routing, manager, cost_matrix)
+    routing.SetArcCostEvaluatorOfAllVehicles(transit_callback_index)
+
+    add_search_cutoff_callback(
+        routing, no_improvement_seconds=no_improvement_seconds, stop_event=stop_event
+    )
+
+    search_parameters = pywrapcp.DefaultRoutingSearchParameters()
+    search_parameters.first_solution_strategy = getattr(
+        routing_enums_pb2.FirstSolutionStrategy, first_strategy
+    )
+    search_parameters.local_search_metaheuristic = getattr(
+        routing_enums_pb2.LocalSearchMetaheuristic, local_search
+    )
+    search_parameters.time_limit.seconds = time_limit_seconds
+
+    solution = None
+    if initial_route:
+        routing.CloseModelWithParameters(search_parameters)
+        initial_assignment = routing.ReadAssignmentFromRoutes(
+            [[manager.NodeToIndex(node) for node in initial_route]], True
+        )
+        if initial_assignment:
+            solution = routing.SolveFromAssignmentWithParameters(initial_assignment, search_parameters)
+    if not solution:
+        solution = routing.SolveWithParameters(search_parameters)
+    if not solution:
+        return None
+
+    route = []
+    index = routing.Start(0)
+    while not routing.IsEnd(index):
+        node = manager.IndexToNode(index)
+        if node != depot_idx:
+            route.append(node)
+        index = solution.Value(routing.NextVar(index))
+    return solution.ObjectiveValue(), route
+
+
+def tsp_strategy_worker(conn, *args):
+    """子プロセスで1つの戦略を解き、結果をパイプで返す"""
+    try:
+        conn.send(solve_tsp_with_strategy(*args))
+    except Exception:
+        conn.send(None)
+    finally:
+        conn.close()
@@ -21,9 +21,11 @@ CREATE TABLE IF NOT EXISTS route_schedules (
 
     -- 計算結果
     day_routes JSONB,  -- 日別ルート（インデックスリスト）
-    selected_df JSONB,  -- 訪問先データ（DataFrame形式）
-    timetables JSONB,  -- タイムテーブルデータ
+    selected_df JSONB,  -- 訪問先データ（DataFrame形式・旧形式）
+    timetables JSONB,  -- タイムテーブルデータ（旧形式）
+    plan_data JSONB,  -- 訪問先データ＋タイムテーブル（列形式で圧縮、selected_df・timetables の代わり）
     calendar_texts JSONB,  -- カレンダー用テキスト
+    travel_matrices JSONB,  -- 移動時間・距離行列（圧縮済み、読み込み時の再計算を省く）
     optimize_mode VARCHAR(20) DEFAULT 'distance',  -- 最適化モード
 
     -- メタデータ
@@ -31,6 +33,10 @@ CREATE TABLE IF NOT EXISTS route_schedules (
     updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
 );
 
+-- 既存のテーブルに列を追加（旧SQLで作成済みの場合）
+ALTER TABLE route_schedules ADD COLUMN IF NOT EXISTS travel_matrices JSONB;
+ALTER TABLE route_schedules ADD COLUMN IF NOT EXISTS plan_data JSONB;
+
 -- ========================================
 -- 実行履歴テーブル
 -- ========================================
@@ -43,18 +49,38 @@ CREATE TABLE IF NOT EXISTS route_history (
     created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
 );
 
+-- ========================================
+-- 移動時間キャッシュテーブル（全ユーザー共有）
+-- ========================================
+-- 座標（小数点以下5桁に丸め）の組み合わせごとに所要時間・距離を保存
+CREATE TABLE IF NOT EXISTS travel_time_cache (
+    origin_key VARCHAR(40) NOT NULL,  -- 出発地キー（例: "39.29462_141.11325"）
+    dest_key VARCHAR(40) NOT NULL,  -- 目的地キー
+    mode VARCHAR(20) NOT NULL DEFAULT 'driving',  -- 移動手段
+    duration INTEGER NOT NULL,  -- 所要時間（秒・バイアス適用前）
+    distance INTEGER NOT NULL,  -- 距離（メートル）
+    fetched_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),  -- 取得日時（有効期限の判定に使用）
+    PRIMARY KEY (origin_key, dest_key, mode)
+);
+
 -- ========================================
 -- インデックス作成
 -- ========================================
 CREATE INDEX IF NOT EXISTS idx_route_schedules_name ON route_schedules(name);
-CREATE INDEX IF NOT EXISTS idx_route_schedules_created ON route_schedules(created_at DESC);
+-- 一覧のキーセットページング（created_at, id の降順）用（旧SQLの created_at のみの定義を置き換える）
+DROP INDEX IF EXISTS idx_route_schedules_created;
+CREATE INDEX IF NOT EXISTS idx_route_schedules_created ON route_schedules(created_at DESC, id DESC);
+-- 保存名の前方一致検索（LIKE 'xxx%'）用
+CREATE INDEX IF NOT EXISTS idx_route_schedules_name_prefix ON route_schedules(name varchar_pattern_ops);
 CREATE INDEX IF NOT EXISTS idx_route_history_date ON route_history(execution_date DESC);
+CREATE INDEX IF NOT EXISTS idx_travel_time_cache_fetched ON travel_time_cache(fetched_at);
 
 -- ========================================
 -- RLS (Row Level Security) 有効化
 -- ========================================
 ALTER TABLE route_schedules ENABLE ROW LEVEL SECURITY;
 ALTER TABLE route_history ENABLE ROW LEVEL SECURITY;
+ALTER TABLE travel_time_cache ENABLE ROW LEVEL SECURITY;
 
 -- 匿名ユーザー向けのポリシー
 CREATE POLICY "Allow all access to route_schedules" ON route_schedules
@@ -63,6 +89,9 @@ CREATE POLICY "Allow all access to route_schedules" ON route_schedules
 CREATE POLICY "Allow all access to route_history" ON route_history
     FOR ALL USING (true) WITH CHECK (true);
 
+CREATE POLICY "Allow all access to travel_time_cache" ON travel_time_cache
+    FOR ALL USING (true) WITH CHECK (true);
+
 -- ========================================
 -- 使用方法
 -- ========================================
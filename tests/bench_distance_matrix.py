@@ -0,0 +1,145 @@
+"""距離行列取得のベンチマーク（逐次取得 vs スレッドプールでの並列取得）
+
+固定の遅延を入れた Distance Matrix のスタブに対して、
+以前の逐次取得（1リクエストずつ送信し、間に0.1秒待つ）と fetch_travel_cells の所要時間を比べる。
+あわせて、両者の取得結果が一致すること、progress_callback の呼び出し方
+（リクエストごとに1回・単調増加・最後は1.0）を確認する。
+
+使い方:
+    python tests/bench_distance_matrix.py [--stops 40] [--latency 0.2]
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from conftest import load_app_definitions  # noqa: E402
+
+
+class FixedLatencyDistanceMatrixClient:
+    """1リクエストごとに latency 秒かかる Distance Matrix のスタブ（スレッドセーフ）"""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def distance_matrix(self, origins, destinations, **kwargs):
+        with self.lock:
+            self.requests += 1
+        time.sleep(self.latency)
+        rows = []
+        for origin in origins:
+            elements = []
+            for dest in destinations:
+                # 座標から決まる値にして、取得方法が違っても同じ結果になるようにする
+                distance = int((abs(origin[0] - dest[0]) + abs(origin[1] - dest[1])) * 100000)
+                elements.append({
+                    "status": "OK",
+                    "duration": {"value": distance // 10},
+                    "distance": {"value": distance},
+                })
+            rows.append({"elements": elements})
+        return {"status": "OK", "rows": rows}
+
+
+def make_locations(n_stops):
+    """重複しない座標を n_stops 件作成"""
+    return [(35.0 + (i // 10) * 0.01, 139.0 + (i % 10) * 0.01) for i in range(n_stops)]
+
+
+def fetch_travel_cells_serial(app, client, missing_pairs, coords_by_key, progress_callback=None):
+    """以前の取得方法（リクエストを1件ずつ送信し、リクエスト間に0.1秒待つ）"""
+    requests_plan = app.plan_distance_matrix_requests(missing_pairs)
+    total_requests = len(requests_plan)
+    cells = {}
+    for current_request, (origin_keys, dest_keys) in enumerate(requests_plan, start=1):
+        if progress_callback:
+            progress_callback(current_request / total_requests,
+                              f"距離行列取得中... ({current_request}/{total_requests})")
+        result = client.distance_matrix(
+            origins=[coords_by_key[k] for k in origin_keys],
+            destinations=[coords_by_key[k] for k in dest_keys],
+            mode="driving",
+            language="ja"
+        )
+        cells.update(app.collect_distance_matrix_cells(origin_keys, dest_keys, result))
+        if current_request < total_requests:
+            time.sleep(0.1)
+    return cells
+
+
+def check_progress_calls(calls, total_requests):
+    """progress_callback がリクエストごとに1回、単調増加で呼ばれ、最後が1.0であることを確認"""
+    assert len(calls) == total_requests, f"呼び出し回数 {len(calls)} != リクエスト数 {total_requests}"
+    progresses = [progress for progress, _ in calls]
+    assert all(a < b for a, b in zip(progresses, progresses[1:])), "進捗が単調増加していません"
+    assert progresses[-1] == 1.0, "最後の進捗が1.0ではありません"
+    assert calls[-1][1].endswith(f"({total_requests}/{total_requests})")
+
+
+def run_benchmark(n_stops=40, latency=0.2):
+    """逐次取得と並列取得の所要時間を計測
+
+    Returns:
+        dict: リクエスト数・各方式の所要時間（秒）
+    """
+    app = load_app_definitions()
+    client = FixedLatencyDistanceMatrixClient(latency)
+    app.get_gmaps_client = lambda api_key, **kwargs: client
+
+    locations = make_locations(n_stops)
+    coords_by_key = {app.make_location_key(lat, lon): (lat, lon) for lat, lon in locations}
+    keys = list(coords_by_key)
+    missing_pairs = {(o, d) for o in keys for d in keys if o != d}
+    total_requests = len(app.plan_distance_matrix_requests(missing_pairs))
+
+    serial_calls = []
+    start = time.perf_counter()
+    serial_cells = fetch_travel_cells_serial(
+        app, client, missing_pairs, coords_by_key,
+        progress_callback=lambda progress, message: serial_calls.append((progress, message)))
+    serial_seconds = time.perf_counter() - start
+
+    concurrent_calls = []
+    start = time.perf_counter()
+    concurrent_cells = app.fetch_travel_cells(
+        missing_pairs, coords_by_key, "AIzaBENCH",
+        progress_callback=lambda progress, message: concurrent_calls.append((progress, message)))
+    concurrent_seconds = time.perf_counter() - start
+
+    assert concurrent_cells == serial_cells, "逐次取得と並列取得の結果が一致しません"
+    check_progress_calls(serial_calls, total_requests)
+    check_progress_calls(concurrent_calls, total_requests)
+
+    # 2回目はキャッシュから取得されるので、リクエストは0件・進捗は1.0が1回だけ
+    cached_calls = []
+    app.fetch_travel_cells(set(), coords_by_key, "AIzaBENCH",
+                           progress_callback=lambda progress, message: cached_calls.append((progress, message)))
+    assert [progress for progress, _ in cached_calls] == [1.0]
+
+    return {
+        "requests": total_requests,
+        "serial_seconds": serial_seconds,
+        "concurrent_seconds": concurrent_seconds,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--stops", type=int, default=40, help="地点数")
+    parser.add_argument("--latency", type=float, default=0.2, help="1リクエストあたりの遅延（秒）")
+    args = parser.parse_args()
+
+    result = run_benchmark(args.stops, args.latency)
+    print(f"{args.stops}地点・{result['requests']}リクエスト（遅延 {args.latency * 1000:.0f}ms）")
+    print(f"  逐次取得: {result['serial_seconds']:.2f}秒")
+    print(f"  並列取得: {result['concurrent_seconds']:.2f}秒 "
+          f"（{result['serial_seconds'] / result['concurrent_seconds']:.1f}倍）")
+    print("  取得結果の一致・progress_callback の呼び出し: OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""探索コストの登録方法による局所探索の反復回数の比較（Pythonコールバック vs RegisterTransitMatrix）
+
+固定の乱数シードで作った合成の移動時間行列に対して、solve_tsp_with_strategy（TSP_TIME_LIMIT_SECONDS）と
+solve_vrp_multi_day（VRP_TIME_LIMIT_SECONDS）を同じ時間上限で実行し、
+探索中の分岐数（局所探索で評価した近傍の数の目安）と発見した解の数を比べる。
+
+- closure: 以前の方式。探索中の各辺のコストをPythonの関数で返す（IndexToNode を2回呼ぶ）
+- matrix:  register_transit_matrix（RegisterTransitMatrix でC++側に行列を渡す）
+
+使い方:
+    python tests/bench_solver_transit.py [--nodes 40] [--days 3] [--seed 0]
+"""
+import argparse
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from conftest import load_app_definitions  # noqa: E402
+
+
+def register_transit_closure(routing, manager, matrix):
+    """以前の方式: 辺ごとにPythonのコールバックでコストを返す"""
+    def transit_callback(from_index, to_index):
+        return matrix[manager.IndexToNode(from_index)][manager.IndexToNode(to_index)]
+
+    return routing.RegisterTransitCallback(transit_callback)
+
+
+def make_travel_matrix(n, seed=0):
+    """30km四方に散らばった地点間の移動時間行列（秒・時速30km相当）を作成"""
+    rng = np.random.RandomState(seed)
+    coords = rng.uniform(0, 30000, size=(n, 2))
+    distance = np.abs(coords[:, np.newaxis, :] - coords[np.newaxis, :, :]).sum(axis=2)
+    return (distance / 30000 * 3600).astype(np.int64).tolist()
+
+
+def run_solver(app, register, solve):
+    """register でコストを登録して solve を実行し、探索の統計を返す"""
+    models = []
+
+    def recording_register(routing, manager, matrix):
+        models.append(routing)
+        return register(routing, manager, matrix)
+
+    # TSPは route_solver、VRPは app.py 側の名前で参照されるので両方を差し替える
+    import route_solver
+    modules = (app, route_solver)
+    original_register = app.register_transit_matrix
+    for module in modules:
+        module.register_transit_matrix = recording_register
+    try:
+        objective = solve()
+    finally:
+        for module in modules:
+            module.register_transit_matrix = original_register
+
+    solver = models[0].solver()
+    return {
+        "branches": solver.Branches(),
+        "solutions": solver.Solutions(),
+        "wall_seconds": solver.WallTime() / 1000,
+        "objective": objective,
+    }
+
+
+def run_benchmark(n_nodes=40, num_days=3, seed=0):
+    """TSP・VRPそれぞれで2つの登録方法を比較
+
+    Returns:
+        dict: {("tsp"|"vrp", "closure"|"matrix"): 探索の統計}
+    """
+    app = load_app_definitions()
+    travel = make_travel_matrix(n_nodes, seed)
+
+    def solve_tsp():
+        result = app.solve_tsp_with_strategy(
+            travel, 0, "PATH_CHEAPEST_ARC", "GUIDED_LOCAL_SEARCH", app.TSP_TIME_LIMIT_SECONDS
+        )
+        return result[0] if result else None
+
+    def solve_vrp():
+        solver_stats = []
+        app.solve_vrp_multi_day(travel, num_days, budget_mode="thorough", solver_stats=solver_stats)
+        return solver_stats[0]["objective"]
+
+    results = {}
+    for kind, solve in (("tsp", solve_tsp), ("vrp", solve_vrp)):
+        for name, register in (("closure", register_transit_closure),
+                               ("matrix", app.register_transit_matrix)):
+            results[(kind, name)] = run_solver(app, register, solve)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--nodes", type=int, default=40, help="地点数（depotを含む）")
+    parser.add_argument("--days", type=int, default=3, help="VRPの日数")
+    parser.add_argument("--seed", type=int, default=0, help="合成行列の乱数シード")
+    args = parser.parse_args()
+
+    results = run_benchmark(args.nodes, args.days, args.seed)
+    for kind in ("tsp", "vrp"):
+        closure = results[(kind, "closure")]
+        matrix = results[(kind, "matrix")]
+        print(f"{kind.upper()}（{args.nodes}地点、探索時間 {matrix['wall_seconds']:.1f}秒）")
+        for name, stats in (("closure", closure), ("matrix", matrix)):
+            print(f"  {name:8s} 分岐数 {stats['branches']:>10,}  解の数 {stats['solutions']:>8,}  "
+                  f"目的関数 {stats['objective']}")
+        print(f"  分岐数の比: {matrix['branches'] / max(closure['branches'], 1):.1f}倍")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,37 @@
+"""app.py の関数定義部分（画面描画より前）だけを読み込むテスト用の設定"""
+import os
+import sys
+import types
+import tempfile
+
+import pytest
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app.py")
+
+
+def load_app_definitions():
+    """app.py の画面描画より前（定数・関数・クラス定義）だけを実行したモジュールを返す
+
+    ローカルキャッシュ（SQLite）は一時ディレクトリに作る（ROUTE_APP_CACHE_DIR が未設定の場合）。
+    ベンチマークのスクリプトからも使う。
+    """
+    os.environ.setdefault("ROUTE_APP_CACHE_DIR", tempfile.mkdtemp())
+    # app.py と同じディレクトリのモジュール（route_solver）を import できるようにする
+    app_dir = os.path.dirname(APP_PATH)
+    if app_dir not in sys.path:
+        sys.path.insert(0, app_dir)
+    with open(APP_PATH, encoding="utf-8") as f:
+        source = f.read()
+    source = source[:source.index('st.title("🏗️')]
+    module = types.ModuleType("app_definitions")
+    module.__file__ = APP_PATH
+    sys.modules["app_definitions"] = module
+    exec(compile(source, APP_PATH, "exec"), module.__dict__)
+    return module
+
+
+@pytest.fixture(scope="session")
+def app():
+    # ローカルキャッシュ（SQLite）はテスト実行ごとの一時ディレクトリに作る
+    os.environ["ROUTE_APP_CACHE_DIR"] = tempfile.mkdtemp()
+    return load_app_definitions()
@@ -0,0 +1,20 @@
+"""マイマップのデータの前処理のテスト"""
+import pandas as pd
+import pytest
+
+
+@pytest.mark.parametrize("columns", [
+    {"name": ["O2本社(事務所)", "現場A(現場)"], "lat": [39.0, 39.1], "lon": [141.0, 141.1]},
+    # 名前列がない場合（座標の上書きをしない）
+    {"lat": [39.0, 39.1], "lon": [141.0, 141.1]},
+])
+def test_preprocess_map_data_does_not_modify_input(app, columns):
+    map_df = pd.DataFrame(columns)
+    original = map_df.copy()
+
+    result = app.preprocess_map_data(map_df)
+
+    pd.testing.assert_frame_equal(map_df, original)
+    assert "layer_normalized" in result["map_df"].columns
+    if "name" in columns:
+        assert result["map_df"].loc[0, "lat"] == app.FIXED_LOCATIONS["O2本社"]["lat"]
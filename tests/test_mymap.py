@@ -0,0 +1,45 @@
+"""マイマップ地点ストア（KMLの条件付き取得・差分更新）のテスト"""
+from array import array
+
+
+KML_WITHOUT_PLACEMARKS = b"""<?xml version="1.0" encoding="UTF-8"?>
+<kml xmlns="http://www.opengis.net/kml/2.2"><Document><Folder><name>layer</name></Folder></Document></kml>
+"""
+
+
+class StubResponse:
+    def __init__(self, content, headers):
+        self.status_code = 200
+        self.content = content
+        self.headers = headers
+
+    def raise_for_status(self):
+        pass
+
+
+class StubSession:
+    def __init__(self, response):
+        self.response = response
+
+    def get(self, url, **kwargs):
+        return self.response
+
+
+def test_kml_without_placemarks_updates_checked_at(app, monkeypatch):
+    map_id = "empty-map"
+    placemarks = {
+        "name": ["現場A"], "description": [""], "layer": ["layer"],
+        "lat": array("d", [39.1]), "lon": array("d", [141.1]),
+    }
+    app.save_stored_mymap(map_id, placemarks, None, None, "old-hash", None)
+    _, source = app.load_stored_mymap(map_id)
+
+    response = StubResponse(KML_WITHOUT_PLACEMARKS, {"ETag": '"v2"'})
+    monkeypatch.setattr(app, "get_http_session", lambda: StubSession(response))
+    stored, diff, error = app.refresh_mymap_store(map_id)
+
+    assert error == "KMLからデータを抽出できませんでした"
+    assert stored["name"] == ["現場A"]
+    _, touched = app.load_stored_mymap(map_id)
+    assert touched["checked_at"] > source["checked_at"]
+    assert touched["etag"] == '"v2"'
@@ -0,0 +1,36 @@
+"""昼食候補レストランの取得（ジオハッシュ単位のキャッシュ）のテスト"""
+
+
+class StubPlacesClient:
+    """places_nearby の結果を固定で返すクライアント"""
+
+    def __init__(self, results):
+        self.results = results
+        self.calls = []
+
+    def places_nearby(self, location, **kwargs):
+        self.calls.append(location)
+        return {"results": self.results}
+
+
+def convenience_store(name):
+    return {
+        "name": name,
+        "types": ["convenience_store", "food"],
+        "geometry": {"location": {"lat": 39.2, "lng": 141.0}},
+    }
+
+
+def test_convenience_store_only_is_not_an_error(app, monkeypatch):
+    client = StubPlacesClient([convenience_store("コンビニ")])
+    monkeypatch.setattr(app, "get_gmaps_client", lambda api_key, **kwargs: client)
+
+    restaurants, error = app.find_nearby_restaurant(client, 39.2, 141.0)
+    assert restaurants == []
+    assert error is None
+
+    # コンビニしかないセルは「見つからない」としてキャッシュし、再取得しない
+    points = [(39.21, 141.01)]
+    assert app.prefetch_nearby_restaurants(points, "AIzaTEST") == {app.encode_geohash(39.21, 141.01): []}
+    assert app.prefetch_nearby_restaurants(points, "AIzaTEST") == {app.encode_geohash(39.21, 141.01): []}
+    assert len(client.calls) == 2  # find_nearby_restaurant の直接呼び出し＋初回の取得のみ
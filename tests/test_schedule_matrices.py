@@ -0,0 +1,23 @@
+"""スケジュールに保存する行列（圧縮・復元）のテスト"""
+import numpy as np
+
+
+def test_pack_and_unpack_travel_matrices(app):
+    locations = [(39.1, 141.1), (39.2, 141.2), (39.3, 141.3)]
+    keys = [app.make_location_key(lat, lon) for lat, lon in locations]
+    time_matrix = app.TravelMatrix(np.arange(9).reshape(3, 3), keys)
+    dist_matrix = app.TravelMatrix(np.arange(9).reshape(3, 3) * 100, keys)
+
+    packed = app.pack_travel_matrices(time_matrix, dist_matrix)
+    loaded_time, loaded_dist = app.unpack_travel_matrices(packed, locations)
+
+    assert (loaded_time.values == time_matrix.values).all()
+    assert (loaded_dist.values == dist_matrix.values).all()
+    # 訪問先が変わった場合は復元しない
+    assert app.unpack_travel_matrices(packed, locations[::-1]) == (None, None)
+
+
+def test_matrix_without_location_keys_is_not_packed(app):
+    # 入れ子リストの行列はキーが行番号（int）になるので保存対象外
+    matrix = [[0, 60], [60, 0]]
+    assert app.pack_travel_matrices(matrix, matrix) is None
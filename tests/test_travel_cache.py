@@ -0,0 +1,112 @@
+"""移動時間キャッシュ（SQLite）と距離行列の取得のテスト"""
+
+
+class StubDistanceMatrixClient:
+    """緯度40度より北の地点との区間を ZERO_RESULTS にする Distance Matrix のスタブ"""
+
+    def __init__(self):
+        self.elements = 0
+
+    def distance_matrix(self, origins, destinations, **kwargs):
+        self.elements += len(origins) * len(destinations)
+        rows = []
+        for origin in origins:
+            elements = []
+            for dest in destinations:
+                if origin[0] > 40 or dest[0] > 40:
+                    elements.append({"status": "ZERO_RESULTS"})
+                else:
+                    elements.append({"status": "OK", "duration": {"value": 600}, "distance": {"value": 5000}})
+            rows.append({"elements": elements})
+        return {"status": "OK", "rows": rows}
+
+
+def test_unreachable_pairs_are_cached(app, monkeypatch):
+    client = StubDistanceMatrixClient()
+    monkeypatch.setattr(app, "get_gmaps_client", lambda api_key, **kwargs: client)
+    locations = ((39.101, 141.0), (39.201, 141.1), (45.001, 141.0), (39.301, 141.2))
+
+    time_matrix, dist_matrix, error = app.create_distance_matrix_google_batched(locations, "AIzaTEST")
+    assert error is None
+    assert time_matrix.values[2].tolist() == [app.UNREACHABLE_VALUE, app.UNREACHABLE_VALUE, 0, app.UNREACHABLE_VALUE]
+    assert time_matrix[0, 1] == 600
+
+    # 2回目は経路のない区間も含めてキャッシュから取得する
+    client.elements = 0
+    cached_time, _, error = app.create_distance_matrix_google_batched(locations, "AIzaTEST")
+    assert error is None
+    assert client.elements == 0
+    assert (cached_time.values == time_matrix.values).all()
+
+
+def test_unwritable_cache_dir_falls_back_to_no_cache(app, monkeypatch, tmp_path):
+    blocker = tmp_path / "not_a_dir"
+    blocker.write_text("")
+    monkeypatch.setattr(app, "LOCAL_CACHE_DIR", str(blocker / "cache"))
+    monkeypatch.setattr(app, "LOCAL_CACHE_DB_PATH", str(blocker / "cache" / "route_cache.sqlite3"))
+    app.init_local_cache_db.clear()
+    try:
+        keys = [app.make_location_key(39.1, 141.0), app.make_location_key(39.2, 141.1)]
+        assert app.load_cached_travel_times(keys) == {}
+        app.save_cached_travel_times({(keys[0], keys[1]): (600, 5000)})
+        assert app.load_cached_route_geometry("missing") is None
+    finally:
+        app.init_local_cache_db.clear()
+
+
+def test_load_cached_travel_times_with_many_locations(app, monkeypatch):
+    # 古いSQLiteと同じ変数の上限（999）にして、2×地点数 が上限を超える件数で確認
+    open_db = app.open_local_cache_db
+
+    def open_db_with_old_limit():
+        conn = open_db()
+        conn.setlimit(app.sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, 999)
+        return conn
+
+    monkeypatch.setattr(app, "open_local_cache_db", open_db_with_old_limit)
+    keys = [app.make_location_key(38.0 + i * 0.0001, 140.0) for i in range(1200)]
+    cells = {(keys[i], keys[i + 1]): (60 + i, 100 + i) for i in range(len(keys) - 1)}
+    app.save_cached_travel_times(cells)
+
+    assert app.load_cached_travel_times(keys) == cells
+    assert app.load_cached_travel_times(keys[:2]) == {(keys[0], keys[1]): (60, 100)}
+
+
+def test_in_flight_chunks_are_cached_when_one_chunk_fails(app, monkeypatch):
+    import threading
+    import time as time_module
+
+    failed = threading.Event()
+    lock = threading.Lock()
+    calls = []
+
+    class FailingFirstChunkClient(StubDistanceMatrixClient):
+        def distance_matrix(self, origins, destinations, **kwargs):
+            with lock:
+                calls.append(len(calls))
+                first = len(calls) == 1
+            if first:
+                failed.set()
+                raise RuntimeError("boom")
+            # 失敗した後も送信済みのリクエストは完了する
+            failed.wait(1)
+            time_module.sleep(0.05)
+            return super().distance_matrix(origins, destinations, **kwargs)
+
+    monkeypatch.setattr(app, "get_gmaps_client", lambda api_key, **kwargs: FailingFirstChunkClient())
+    locations = [(38.5 + i * 0.01, 140.5) for i in range(20)]
+    keys = [app.make_location_key(lat, lon) for lat, lon in locations]
+    coords_by_key = dict(zip(keys, locations))
+    missing = {(o, d) for o in keys for d in keys if o != d}
+
+    try:
+        app.fetch_travel_cells(missing, coords_by_key, "AIzaTEST")
+    except RuntimeError:
+        pass
+    else:
+        raise AssertionError("1件目のチャンクの失敗が送出されていない")
+
+    # 失敗した時点で送信済みだったリクエストの結果はキャッシュに残る
+    cached = app.load_cached_travel_times(keys)
+    assert len(calls) >= 2
+    assert len(cached) > 0
@@ -0,0 +1,35 @@
+"""巡回順序の探索（TSPの戦略並列実行・複数日VRP）のテスト"""
+import numpy as np
+
+
+def make_cost_matrix(n, seed=0):
+    rng = np.random.RandomState(seed)
+    coords = rng.uniform(0, 10000, size=(n, 2))
+    return np.abs(coords[:, np.newaxis, :] - coords[np.newaxis, :, :]).sum(axis=2).astype(np.int64)
+
+
+def test_parallel_strategies_run_in_batches_of_max_workers(app):
+    cost_matrix = make_cost_matrix(12)
+    results = app.solve_tsp_strategies_parallel(
+        cost_matrix, 0, app.TSP_STRATEGIES, 1, max_workers=2, stop_others_on_convergence=False,
+    )
+
+    # 同時実行数より戦略が多くても、すべての戦略が実行される
+    assert len(results) == len(app.TSP_STRATEGIES)
+    assert all(result is not None for result in results)
+    for total_cost, route in results:
+        assert sorted(route) == list(range(1, 12))
+
+    exact_cost, _ = app.solve_tsp_exact(cost_matrix, 0)
+    assert min(total_cost for total_cost, _ in results) == exact_cost
+
+
+def test_small_vrp_is_not_recorded_as_exact(app):
+    cost_matrix = make_cost_matrix(6)
+    solver_stats = []
+    routes, _ = app.solve_vrp_multi_day(cost_matrix, 2, solver_stats=solver_stats)
+
+    assert sorted(node for route in routes for node in route) == list(range(1, 6))
+    # VRPには厳密解法がないので、TSPで厳密解となる規模でも "exact" とは記録しない
+    assert solver_stats[0]["solver"] == "vrp"
+    assert solver_stats[0]["tier"] == "medium"